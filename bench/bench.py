@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+    Throughput benchmarks of git_recycle_bin.py against synthetic local repos.
+
+    Source and bin repos are built by `git fast-import`, with local bare repos acting as remotes, so results
+    measure our own work rather than a network. Each command is run as its own process and reported with:
+        wall_s         Wall time in seconds
+        git_processes  Git processes started, counted by trace2, including those started by git itself
+        bytes_received Growth of the receiving object store: The bin remote for push, the local bin repo otherwise
+        peak_rss_kb    Peak resident memory of the command or any of its children
+
+    Results are JSON on stdout (or --out), to be tracked between releases.
+    Run by `just bench`, e.g. `just bench --preset full --out bench.json`.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(HERE), "src")
+sys.path.insert(0, SRC)
+from commit_msg import emit_commit_msg  # noqa: E402
+from util_string import parse_size  # noqa: E402
+
+TOOL = [sys.executable, os.path.join(SRC, "git_recycle_bin.py")]
+DATE = "Thu, 27 Jul 2023 13:15:26 +0200"
+
+PRESETS = {
+    # Artifacts on the bin remote; shapes of the pushed artifact as files x size
+    "quick": {"artifacts": [10, 1000], "shapes": ["1x1K", "1000x1K", "1x10M"]},
+    "full":  {"artifacts": [10, 1000, 100000], "shapes": ["1x1K", "1000x1K", "1000000x1K", "1x1G"]},
+}
+
+
+def git(*args, cwd=None, input=None) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, input=input, check=True, capture_output=True,
+                          text=not isinstance(input, bytes)).stdout
+
+
+def du(path: str) -> int:
+    """ Bytes in files under path """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def measure(argv: list[str], cwd: str, received: str) -> dict:
+    """ Run argv, with its resource usage kept apart from other runs' """
+    before = du(received)
+    with tempfile.NamedTemporaryFile(suffix=".trace2") as trace, tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        env = os.environ | {"GIT_TRACE2_EVENT": trace.name}
+        start = time.monotonic()
+        proc = subprocess.Popen(argv, cwd=cwd, env=env, stdout=stdout, stderr=stderr)
+        # Reap it ourselves, as wait4 has the resource usage of this process and its children alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        processes = sum(1 for line in open(trace.name, errors="replace") if '"event":"start"' in line)
+        stdout.seek(0)
+        stderr.seek(0)
+        return {
+            "wall_s": round(wall, 4),
+            "git_processes": processes,
+            "bytes_received": du(received) - before,  # Object store growth
+            "peak_rss_kb": usage.ru_maxrss,
+            "exit_code": proc.returncode,
+            "stdout": stdout.read().decode(errors="replace"),
+            "stderr": stderr.read().decode(errors="replace"),
+        }
+
+
+def build_src(root: str, files: int, size: int) -> tuple[str, str]:
+    """ Source repo with an upstream, and an ignored artifact of files x size at obj/. Returns its path and HEAD """
+    origin, src = os.path.join(root, "origin.git"), os.path.join(root, "src")
+    git("init", "-q", "--bare", "-b", "main", origin)
+    git("init", "-q", "-b", "main", src)
+    git("remote", "add", "origin", origin, cwd=src)
+    with open(os.path.join(src, ".gitignore"), "w") as file:
+        file.write("obj/\n")
+    git("add", ".gitignore", cwd=src)
+    git("commit", "-q", "-m", "Benchmark source", cwd=src)
+    git("push", "-q", "-u", "origin", "main", cwd=src)
+
+    for i in range(files):
+        chunk = os.urandom(min(size, 1 << 20))  # Incompressible and unique per file, as build outputs mostly are
+        path = os.path.join(src, "obj", f"{i // 1000:04}", f"{i:07}.bin") if files > 1 else os.path.join(src, "obj", "file.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            for offset in range(0, size, len(chunk)):
+                file.write(chunk[:size - offset])
+    return src, git("rev-parse", "HEAD", cwd=src).strip()
+
+
+def artifact_meta(src_sha: str, i: int) -> str:
+    return emit_commit_msg({
+        'src_repo': "origin.git", 'src_sha': src_sha, 'src_sha_short': src_sha[:10], 'src_sha_title': "Benchmark source",
+        'src_sha_msg': "Benchmark source", 'artifact_name': f"artifact-{i}", 'artifact_mime': "directory",
+        'artifact_relpath_nca': f"obj/{i}", 'artifact_relpath_src': f"obj/{i}", 'src_time_author': DATE,
+        'src_time_commit': DATE, 'src_branch': "main", 'src_repo_url': "origin.git", 'src_commits_ahead': "0",
+        'src_commits_behind': "0", 'src_status': "",
+    })
+
+
+def build_bin(root: str, src_sha: str, artifacts: int) -> str:
+    """
+        Bare bin remote with artifacts of src_sha, each a branch, a commit and a meta-for-commit ref.
+        Every other branch has expired; a tenth of the meta-for-commit refs more are orphaned.
+    """
+    bin_repo = os.path.join(root, "bin.git")
+    git("init", "-q", "--bare", bin_repo)
+    marks = os.path.join(root, "marks")
+    stream = bytearray()
+    for i in range(artifacts):
+        date = "2000-01-01" if i % 2 else "2999-01-01"
+        content = f"artifact {i}\n".encode()
+        meta = artifact_meta(src_sha, i).encode()
+        stream += b"blob\nmark :%d\ndata %d\n%s\n" % (3*i + 1, len(content), content)
+        stream += b"blob\nmark :%d\ndata %d\n%s\n" % (3*i + 2, len(meta), meta)
+        stream += f"commit refs/heads/artifact/expire/{date}/00.00+0000/origin.git@{src_sha}/{{obj/{i}}}\n".encode()
+        stream += b"mark :%d\ncommitter bench <bench> 1690456526 +0200\ndata %d\n%s\n" % (3*i + 3, len(meta), meta)
+        stream += f"M 100644 :{3*i + 1} obj/{i}/file\n\n".encode()
+    for i in range(artifacts + artifacts // 10):
+        stream += b"commit refs/heads/orphan\nmark :%d\ncommitter bench <bench> 1690456526 +0200\ndata 0\n\n" % (3*artifacts + i + 1)
+    subprocess.run(["git", "fast-import", "--quiet", f"--export-marks={marks}"], env=os.environ | {"GIT_DIR": bin_repo},
+                   input=bytes(stream), check=True)
+
+    sha_of = dict(line.split() for line in open(marks))
+    updates = [f"create refs/artifact/meta-for-commit/{src_sha}/{sha_of[f':{3*i + 3}']} {sha_of[f':{3*i + 2}']}\n" for i in range(artifacts)]
+    # Orphans: Metadata of artifacts whose commits are not on any branch
+    meta = sha_of[":2"] if artifacts else git("hash-object", "-w", "--stdin", input="", cwd=bin_repo).strip()
+    updates += [f"create refs/artifact/meta-for-commit/{src_sha}/{sha_of[f':{3*artifacts + i + 1}']} {meta}\n" for i in range(artifacts // 10)]
+    updates.append("delete refs/heads/orphan\n")
+    subprocess.run(["git", "update-ref", "--stdin"], env=os.environ | {"GIT_DIR": bin_repo}, input="".join(updates), text=True, check=True)
+    return bin_repo
+
+
+def fresh_copy(bin_repo: str, name: str) -> str:
+    """ Copy of bin repo, for commands which change it """
+    copy = os.path.join(os.path.dirname(bin_repo), name)
+    shutil.rmtree(copy, ignore_errors=True)
+    shutil.copytree(bin_repo, copy, symlinks=True)
+    return copy
+
+
+def run(scenario: str, params: dict, argv: list[str], cwd: str, received: str) -> dict:
+    print(f"bench: {scenario} {params} ...", file=sys.stderr)
+    # Each run starts without a local bin repo, which is then kept to measure what it received
+    shutil.rmtree(os.path.join(cwd, ".rbgit"), ignore_errors=True)
+    # Options after the subcommand, as its parser's defaults would override them before
+    result = measure([*TOOL, *argv, "--color=false", "--rm-tmp=false"], cwd, received)
+    if result["exit_code"] != 0:
+        print(result["stderr"], file=sys.stderr)
+    return {"scenario": scenario, "params": params, **result}
+
+
+def bench_remote(root: str, artifacts: int) -> list[dict]:
+    """ list, clean and flush-meta against a bin remote of many artifacts """
+    src, src_sha = build_src(root, 0, 0)
+    bin_repo = build_bin(root, src_sha, artifacts)
+    rbgit = os.path.join(src, ".rbgit", "objects")
+    params = {"artifacts": artifacts}
+    results = [
+        run("list-all", params, ["list", bin_repo], src, rbgit),
+        run("list-name", params, ["list", bin_repo, "--name", f"artifact-{artifacts // 2}"], src, rbgit),
+        run("list-path", params, ["list", bin_repo, "--path", f"obj/{artifacts // 2}"], src, rbgit),
+    ]
+    remote = fresh_copy(bin_repo, "clean.git")
+    results.append(run("clean", params, ["clean", remote, "--flush-meta=false"], src, rbgit))
+    # Expired branches are gone now, so what remains is flushing their and the orphans' metadata
+    results.append(run("flush-meta", params, ["clean", remote], src, rbgit))
+    return results
+
+
+def bench_artifact(root: str, shape: str) -> list[dict]:
+    """ push and download of one artifact of the shape """
+    files, size = shape.lower().split("x")
+    params = {"files": int(files), "size": parse_size(size)}
+    src, _ = build_src(root, params["files"], params["size"])
+    bin_repo = os.path.join(root, "bin.git")
+    git("init", "-q", "--bare", bin_repo)
+
+    push = run("push", params, ["push", bin_repo, "--path", "obj", "--name", "bench", "--add-ignored"], src, bin_repo)
+    match = re.search(r"Artifact commit: ([0-9a-f]{40})", push["stderr"])
+    results = [push]
+    if match:
+        shutil.rmtree(os.path.join(src, "obj"))
+        rbgit = os.path.join(src, ".rbgit", "objects")
+        results.append(run("download", params, ["download", bin_repo, match.group(1)], src, rbgit))
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=PRESETS, default="quick", help="Sizes to run. Default quick.")
+    parser.add_argument("--artifacts", type=str, help="Comma-separated numbers of artifacts on the bin remote, e.g. 10,1000. Overrides preset.")
+    parser.add_argument("--shapes", type=str, help="Comma-separated pushed artifact shapes, files x size, e.g. 1x1K,1000x1K. Overrides preset.")
+    parser.add_argument("--out", type=str, help="Write JSON here rather than to stdout.")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic repos, to inspect them.")
+    args = parser.parse_args()
+
+    artifacts = [int(n) for n in args.artifacts.split(",")] if args.artifacts else PRESETS[args.preset]["artifacts"]
+    shapes = args.shapes.split(",") if args.shapes else PRESETS[args.preset]["shapes"]
+
+    # Reproducible commits, also where no git identity is configured
+    for var in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        os.environ.setdefault(var, "bench")
+    for var in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        os.environ.setdefault(var, "bench@example.com")
+    os.environ |= {"GIT_AUTHOR_DATE": DATE, "GIT_COMMITTER_DATE": DATE}
+
+    workdir = tempfile.mkdtemp(prefix="gitrb-bench-")
+    results = []
+    try:
+        for n in artifacts:
+            results += bench_remote(os.path.join(workdir, f"remote-{n}"), n)
+        for shape in shapes:
+            results += bench_artifact(os.path.join(workdir, f"artifact-{shape}"), shape)
+    finally:
+        if args.keep:
+            print(f"bench: Kept repos in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        del result["stdout"], result["stderr"]
+    report = {
+        "revision": subprocess.run(["git", "describe", "--always", "--dirty"], cwd=HERE, capture_output=True, text=True).stdout.strip(),
+        "git": git("--version").strip(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(result["exit_code"] == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,8 +5,34 @@ from setuptools import setup, find_packages
 setup(
     name="git-recycle-bin",
     version="0.2.5",
-    # Modules to import from other scripts:
-    packages=find_packages(),
+    # Modules to import from other scripts, and from programs using the library:
+    packages=find_packages(where="src"),
+    package_dir={"": "src"},
+    py_modules=[
+        "git_recycle_bin",
+        "rbgit",
+        "printer",
+        "util_string",
+        "util_file",
+        "util_date",
+        "util_sysinfo",
+        "arg_parser",
+        "list",
+        "download",
+        "commit_msg",
+        "util",
+        "cat_file",
+        "remote_refs",
+        "rbgit_cache",
+        "mirror",
+        "stat_cache",
+        "tar_import",
+        "source_snapshot",
+        "tracing",
+        "client",
+        "push",
+        "clean",
+    ],
     install_requires=[
         "maya",
         "colorama",
@@ -26,6 +52,17 @@ setup(
         "src/download.py",
         "src/commit_msg.py",
         "src/util.py",
+        "src/cat_file.py",
+        "src/remote_refs.py",
+        "src/rbgit_cache.py",
+        "src/mirror.py",
+        "src/stat_cache.py",
+        "src/tar_import.py",
+        "src/source_snapshot.py",
+        "src/tracing.py",
+        "src/client.py",
+        "src/push.py",
+        "src/clean.py",
     ],
 )
 
@@ -1,6 +1,8 @@
 import argparse
 import os
+import json
 from printer import printer
+from util_string import parse_size
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -12,6 +14,12 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
+def str2size(v):
+    try:
+        return parse_size(v)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def tuple1(key):
     def f(value):
         return (key, value)
@@ -36,7 +44,17 @@ def parse_args():
     g.add_argument(               "--user-name",       metavar='fullname', required=False, type=str, default=os.getenv('GITRB_USERNAME'), help="Author of artifact commit. Defaults to yourself.")
     g.add_argument(               "--user-email",      metavar='address',  required=False, type=str, default=os.getenv('GITRB_EMAIL'),    help="Author's email of artifact commit. Defaults to your own.")
     dv = 'origin'; g.add_argument("--src-remote-name", metavar='name',     required=False, type=str, default=os.getenv('GITRB_SRC_REMOTE', dv), help=f"Name of src repo's remote. Defaults {dv}.")
+    dv = 'False';  g.add_argument("--src-fsmonitor",   metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_SRC_FSMONITOR', dv), help=f"Use the file system monitor for src repo's status. Default {dv}.")
+    dv = 'False';  g.add_argument("--src-commit-graph", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_SRC_COMMIT_GRAPH', dv), help=f"Write src repo's commit-graph if missing, to count commits ahead/behind upstream faster. Default {dv}.")
     dv = 'True' ;  g.add_argument("--rm-tmp",          metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_RM_TMP', dv), help=f"Remove local bin-repo. Default {dv}.")
+    dv = 'False';  g.add_argument("--cache",           metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_CACHE', dv), help=f"Keep local bin-repo between runs as object cache, overrides --rm-tmp. Default {dv}.")
+    dv = '1G';     g.add_argument("--cache-budget",    metavar='size', type=str2size, default=os.getenv('GITRB_CACHE_BUDGET', dv), help=f"Size of the cache, least recently used artifacts are evicted beyond it. Default {dv}.")
+    dv = 'True' ;  g.add_argument("--ssh-multiplex",   metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_SSH_MULTIPLEX', dv), help=f"Share one ssh connection per host between all remote operations. Not done if ssh is configured for git already. Default {dv}.")
+    g.add_argument(               "--mirror-dir",      metavar='dir',      required=False, type=str, default=os.getenv('GITRB_MIRROR_DIR'), help="Host-wide directory of bin-repo mirrors, shared by all workspaces. Default none.")
+
+    g = top_parser.add_argument_group('performance analysis')
+    g.add_argument("--trace",   metavar='file', required=False, type=str, default=os.getenv('GITRB_TRACE'),   help="Write timings of git commands, by phase, as Chrome trace JSON. Default none.")
+    g.add_argument("--profile", metavar='file', required=False, type=str, default=os.getenv('GITRB_PROFILE'), help="Write cProfile stats of our Python code, e.g. for snakeviz. Default none.")
 
     g = top_parser.add_argument_group('terminal output style')
     g.add_argument("-h", "--help", action="help", default=argparse.SUPPRESS, help="Show this help message and exit.")
@@ -49,9 +67,11 @@ def parse_args():
     commands = parser.add_subparsers(dest='command')
     commands.required = True
     g = commands.add_parser("push", parents=[top_parser], add_help=False, help="push artifact")
-    g.add_argument(                   "remote",                   metavar='URL', type=str, help="Git remote URL")
-    g.add_argument(                   "--path",                   metavar='file|dir', required=True,  type=str, default=os.getenv('GITRB_PATH'),       help="Path to artifact in src-repo. Directory or file.")
-    g.add_argument(                   "--name",                   metavar='string',   required=True,  type=str, default=os.getenv('GITRB_NAME'),       help="Name to assign to the artifact. Will be sanitized.")
+    g.add_argument(                   "remotes",                  metavar='URL', type=str, nargs='+', help="Git remote URL. Several to push the same artifact to each, concurrently.")
+    g.add_argument(                   "--path",                   metavar='file|dir', required=False, action='append', help="Path to artifact in src-repo. Directory or file. Repeat with --name for more artifacts. Default $GITRB_PATH.")
+    g.add_argument(                   "--name",                   metavar='string',   required=False, action='append', help="Name to assign to the artifact. Will be sanitized. One per --path, in the same order. Default $GITRB_NAME.")
+    g.add_argument(                   "--manifest",               metavar='file',     required=False, type=str, default=os.getenv('GITRB_MANIFEST'), help="JSON list of artifacts, as {\"path\": ..., \"name\": ...} objects, pushed in addition to --path/--name.")
+    g.add_argument(                   "--from-tar",               metavar='file|-',   required=False, type=str, default=os.getenv('GITRB_FROM_TAR'),   help="Read artifact's contents from tarball, '-' for stdin, instead of from --path. --path still names where it belongs.")
     dv = 'in 30 days'; g.add_argument("--expire",                 metavar='fuzz',     required=False, type=str, default=os.getenv('GITRB_EXPIRE', dv), help=f"Expiry of artifact's branch. Fuzzy date. Default '{dv}'.")
     dv = 'False';      g.add_argument("--tag",  dest='push_tag',  metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_PUSH_TAG', dv), help=f"Push tag to artifact to remote. Default {dv}.")
     dv = 'False';      g.add_argument("--note", dest='push_note', metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_PUSH_NOTE', dv),     help=f"Push note to src remote. Default {dv}.")
@@ -60,9 +80,13 @@ def parse_args():
     dv = 'False';      g.add_argument("--flush-meta",             metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_RM_FLUSH_META', dv), help=f"Delete expired meta-for-commit refs. Default {dv}.")
     dv = 'False';      g.add_argument("--force-branch",           metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_FORCE_BRANCH', dv), help=f"Force push of branch. Default {dv}.")
     dv = 'False';      g.add_argument("--force-tag",              metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_FORCE_TAG', dv), help=f"Force push of tag. Default {dv}.")
+    dv = '4';          g.add_argument("--jobs",                   metavar='int',  type=int, default=os.getenv('GITRB_JOBS', dv), help=f"Remotes to push to at the same time, when given several. Default {dv}.")
+    dv = 'False';      g.add_argument("--atomic",                 metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_ATOMIC', dv), help=f"Publish branch, meta-data and tag in one all-or-nothing push. Default {dv}.")
 
     g = commands.add_parser("clean", parents=[top_parser], add_help=False, help="clean expired artifacts")
     g.add_argument("remote", metavar='URL', type=str, help="Git remote URL")
+    dv = 'False';      g.add_argument("--dry-run",                metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_DRY_RUN', dv), help=f"Only report what would be deleted, and in how many pushes. Default {dv}.")
+    dv = 'True';       g.add_argument("--flush-meta",             metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_RM_FLUSH_META', dv), help=f"Delete orphaned meta-for-commit refs too. Needs all branches and tags listed. Default {dv}.")
 
     g = commands.add_parser("list", parents=[top_parser], add_help=False, help="list artifacts")
     g.add_argument("remote", metavar='URL', type=str, help="Git remote URL")
@@ -74,6 +98,8 @@ def parse_args():
     g.add_argument("remote", metavar='URL', type=str, help="Git remote URL")
     g.add_argument("artifacts", metavar='artifact', nargs='+', type=str, help="Artifact SHA(s) to download")
     g.add_argument("--force", "-f", action='store_true', help="Force download, even if local files ")
+    dv = 'False'; g.add_argument("--delta", metavar='bool', type=str2bool, nargs='?', const=True, default=os.getenv('GITRB_DELTA', dv), help=f"Only transfer and write files which differ from the artifact currently in the work tree. Default {dv}.")
+    g.add_argument("--only", metavar='glob', action='append', default=None, help="Only download paths matching glob, gitignore-style. Can be repeated. Other files are not transferred.")
 
     args = parser.parse_args()
 
@@ -86,11 +112,20 @@ def parse_args():
     printer.verbosity = args.verbosity
     printer.colorize = args.color
 
+    if args.command == "push":
+        args.remote = args.remotes[0]
+        args.push_artifacts = push_artifacts(args)
+        if args.push_artifacts is None:
+            return None
+
     # Sanity-check
     try:
         if args.force_tag and not args.force_branch:
             printer.error("Error: `--force-tag` requires `--force-branch`")
             return None
+        if args.jobs < 1:
+            printer.error("Error: `--jobs` must be at least 1")
+            return None
     except AttributeError:
         pass
 
@@ -101,3 +136,29 @@ def parse_args():
         return None
 
     return args
+
+
+def push_artifacts(args) -> list[tuple[str, str]] | None:
+    """ Artifacts to push, as (path, name) pairs from --path/--name and --manifest. None if they don't add up """
+    paths = args.path or ([os.environ['GITRB_PATH']] if os.getenv('GITRB_PATH') else [])
+    names = args.name or ([os.environ['GITRB_NAME']] if os.getenv('GITRB_NAME') else [])
+    if len(paths) != len(names):
+        printer.error(f"Error: Each --path needs a --name, got {len(paths)} paths and {len(names)} names")
+        return None
+    artifacts = list(zip(paths, names))
+
+    if args.manifest:
+        try:
+            with open(args.manifest) as file:
+                artifacts += [(entry['path'], entry['name']) for entry in json.load(file)]
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            printer.error(f"Error: Invalid manifest '{args.manifest}': {e!r}")
+            return None
+
+    if not artifacts:
+        printer.error("Error: Nothing to push, give --path and --name, or --manifest")
+        return None
+    if args.from_tar and len(artifacts) > 1:
+        printer.error("Error: `--from-tar` pushes a single artifact")
+        return None
+    return artifacts
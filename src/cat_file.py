@@ -0,0 +1,120 @@
+import sys
+import contextlib
+import subprocess
+import threading
+
+
+class CatFile:
+    """
+        Long-lived `git cat-file --batch` and `--batch-check` processes.
+        Reading many objects costs no new process per object; processes start lazily on first use.
+    """
+
+    def __init__(self, printer, env: dict):
+        self.printer = printer
+        self.env = env
+        self.lock = threading.Lock()
+        self.procs = {}
+
+    def _proc(self, mode: str) -> subprocess.Popen:
+        proc = self.procs.get(mode)
+        if proc is None or proc.poll() is not None:
+            self.printer.debug("Run:", ["rbgit", "cat-file", mode], file=sys.stderr)
+            proc = subprocess.Popen(["git", "cat-file", mode], env=self.env,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.procs[mode] = proc
+        return proc
+
+    @staticmethod
+    def _read_header(proc: subprocess.Popen) -> list[bytes]:
+        """
+            Header of next record, in the same order as requested:
+              <sha> <type> <size>LF
+            or, for objects that could not be resolved:
+              <obj> {missing,ambiguous}LF
+        """
+        line = proc.stdout.readline()
+        if not line:
+            raise RuntimeError("RbGit cat-file exited unexpectedly")
+        return line.split()
+
+    def read_object(self, obj: str) -> bytes | None:
+        """ Raw contents of object, or None if missing """
+        return self.read_many([obj]).get(obj)
+
+    def read_many(self, objs: list[str]) -> dict[str, bytes]:
+        """ Raw contents of many objects. Missing objects are left out """
+        return dict(self.iter_many(objs))
+
+    def iter_many(self, objs: list[str]):
+        """
+            Like `read_many`, but yields (obj, contents) one at a time, so only one object is held in memory.
+            The batch process is ours until the iteration ends, so reads meanwhile, e.g. from within the loop, start another.
+        """
+        if not objs:
+            return
+
+        with self.lock:
+            proc = self._proc("--batch")
+            del self.procs["--batch"]
+
+        # Write requests from another thread, so neither side blocks on a full pipe
+        def write_requests():
+            try:
+                for obj in objs:
+                    proc.stdin.write(f"{obj}\n".encode())
+                proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                pass  # Reading was abandoned and process killed
+        writer = threading.Thread(target=write_requests, daemon=True)
+        writer.start()
+
+        done = False
+        try:
+            for obj in objs:
+                header = self._read_header(proc)
+                if len(header) != 3:
+                    continue
+                size = int(header[2])
+                contents = proc.stdout.read(size)
+                proc.stdout.read(1)  # skip trailing LF
+                yield obj, contents
+            done = True
+        finally:
+            if not done:
+                # Abandoned midway: Unread records would be mistaken for the next request's, so start afresh
+                proc.kill()
+                writer.join()
+                with contextlib.suppress(BrokenPipeError):
+                    proc.stdin.close()
+                proc.stdout.close()
+                proc.wait()
+            else:
+                writer.join()
+                with self.lock:
+                    kept = self.procs.setdefault("--batch", proc)
+                if kept is not proc:
+                    # Another batch process was started meanwhile and kept instead
+                    self._stop(proc)
+
+    def object_size(self, obj: str) -> int | None:
+        """ Size of object in bytes, or None if missing. The object's contents are not read """
+        with self.lock:
+            proc = self._proc("--batch-check")
+            proc.stdin.write(f"{obj}\n".encode())
+            proc.stdin.flush()
+            header = self._read_header(proc)
+        return int(header[2]) if len(header) == 3 else None
+
+    def close(self):
+        """ Shut down processes, by closing their input """
+        with self.lock:
+            for proc in self.procs.values():
+                self._stop(proc)
+            self.procs = {}
+
+    @staticmethod
+    def _stop(proc: subprocess.Popen):
+        proc.stdin.close()
+        proc.wait()
+        proc.stdout.close()
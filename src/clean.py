@@ -0,0 +1,154 @@
+import os
+import sys
+import datetime
+from dateutil.tz import tzlocal
+
+from printer import printer
+from tracing import tracer
+from util_date import (
+    DATE_FMT_EXPIRE,
+    date_prefixes_until,
+    date_parse_formatted,
+    format_timespan,
+    parse_expire_date,
+)
+
+
+# Remote refs holding artifacts, by expiry
+EXPIRE_BRANCH_PREFIX = "artifact/expire/"
+EXPIRE_DATE_SLACK_DAYS = 2  # Expiry dates are in their pusher's time zone, whose date may be up to 2 days ahead of ours
+# Remote refs needed to tell which meta-for-commit refs are orphaned
+FLUSH_META_PREFIXES = ["refs/artifact/meta-for-commit/", "refs/heads/", "refs/tags/"]
+# Deleting many refs: Stay well within command-line limits, which are small on Windows
+DELETE_BATCH_MAX_BYTES = 30000 if os.name == "nt" else 256 * 1024
+PKT_LINE_MAX = 65520      # Largest pkt-line git sends or accepts
+PKT_LINE_OVERHEAD = 4 + 2*40 + 2  # Length header, old and new SHA, separators
+
+
+def clean_command(rbgit, remote_bin_name, flush_meta: bool, dry_run: bool = False):
+    """ Delete expired artifacts from remote, and with flush_meta the meta-data left behind """
+    # List everything we will ask the bin-remote about, in one go
+    with tracer.phase("ls-refs"):
+        rbgit.remote_refs(remote_bin_name, [*expired_branch_prefixes(), *(FLUSH_META_PREFIXES if flush_meta else [])])
+    remote_clean(rbgit, remote_bin_name, rm_expired=True, flush_meta=flush_meta, dry_run=dry_run)
+
+def remote_clean(rbgit, remote_bin_name, rm_expired: bool, flush_meta: bool, dry_run: bool = False):
+    """
+        Delete expired branches and/or orphaned meta-for-commit refs on remote.
+        Everything to delete is collected first, then deleted in as few pushes as possible.
+    """
+    expired = remote_expired_branches(rbgit, remote_bin_name) if rm_expired else []
+    orphaned = remote_orphaned_meta_for_commit(rbgit, remote_bin_name, deleting=expired) if flush_meta else []
+    batches = delete_batches(expired + orphaned)
+
+    if dry_run:
+        printer.high_level(f"Dry-run: Would delete {len(expired)} expired branches and {len(orphaned)} meta-for-commit refs, in {len(batches)} pushes.", file=sys.stderr)
+        for i, batch in enumerate(batches, start=1):
+            printer.high_level(f"Dry-run: Push {i}/{len(batches)} would delete {len(batch)} refs", file=sys.stderr)
+            for ref in batch:
+                printer.detail(f"  {ref}", file=sys.stderr)
+        return
+
+    deleted = []
+    try:
+        for batch in batches:
+            rbgit.cmd("push", remote_bin_name, "--delete", *batch)
+            deleted.extend(batch)
+    finally:
+        # Recorded once, as each recording repacks the whole snapshot
+        rbgit.remote_refs(remote_bin_name).remove_many(deleted)
+
+def delete_batches(refs: list[str], max_bytes: int | None = None) -> list[list[str]]:
+    """
+        Split refs into batches, each small enough to be deleted by a single `git push --delete`.
+        A batch must fit on the command-line, and each ref becomes one pkt-line on the wire.
+    """
+    max_bytes = max_bytes or DELETE_BATCH_MAX_BYTES
+    batches = []
+    batch, size = [], 0
+    for ref in refs:
+        if len(ref) + PKT_LINE_OVERHEAD > PKT_LINE_MAX:
+            raise ValueError(f"Ref too long to push: {ref}")
+        arg_size = len(ref.encode()) + 1  # NUL terminated in argv
+        if batch and size + arg_size > max_bytes:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(ref)
+        size += arg_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def expired_branch_prefixes() -> list[str]:
+    """
+        Ref prefixes of expire-branches dated at or before today, i.e. of every branch which may have expired.
+        Branches expiring later are never listed, so cost scales with the number of expired branches.
+    """
+    last = datetime.datetime.now(tzlocal()).date() + datetime.timedelta(days=EXPIRE_DATE_SLACK_DAYS)
+    return [f"refs/heads/{EXPIRE_BRANCH_PREFIX}{prefix}" for prefix in date_prefixes_until(last)]
+
+def remote_expired_branches(rbgit, remote_bin_name) -> list[str]:
+    """
+        Refs of expired branches on remote. Artifacts may still be kept alive by other refs, e.g. by latest-tag.
+        Reclaiming disk-space on remote, requires running `git gc` or its equivalent -- _Housekeeping_ on GitLab.
+        See https://docs.gitlab.com/ee/administration/housekeeping.html
+    """
+    prefixes = expired_branch_prefixes()
+    remote_refs = rbgit.remote_refs(remote_bin_name, prefixes)
+
+    now = datetime.datetime.now(tzlocal())
+
+    expired = []
+    branches = (branch for prefix in prefixes for branch, _ in remote_refs.items(prefix))
+    for branch in branches:
+
+        # Timezone may be absent, but we insist on date and time
+        date_time_tz = parse_expire_date(branch)
+        if date_time_tz['date'] == None: continue
+        if date_time_tz['time'] == None: continue
+        if date_time_tz['tzoffset'] == None:
+            date_time_tz['tzoffset'] = datetime.datetime.strftime(now, "%z")
+
+        compliant_expire_string = f"{date_time_tz['date']}/{date_time_tz['time']}{date_time_tz['tzoffset']}"
+        expiry = date_parse_formatted(date_string=compliant_expire_string, date_format=DATE_FMT_EXPIRE)
+        delta_formatted = format_timespan(dt_from=now, dt_to=expiry)
+
+        if expiry.timestamp() > now.timestamp():
+            printer.detail("Active", delta_formatted, branch)
+            continue
+
+        printer.high_level("Expired", delta_formatted, branch)
+        expired.append(branch)
+
+    return expired
+
+def remote_orphaned_meta_for_commit(rbgit, remote_bin_name, deleting: list[str] = ()) -> list[str]:
+    """
+        Every artifact has traceability metadata in the commit message. However we can not fetch the commit
+        message without fetching the whole artifact too. Hence we have meta-for-commit refs, which point to
+        blobs of only metadata. This way we can obtain metadata without downloading potentially big artifacts.
+
+        The artifacts are kept clean either by their built-in expiry-dates or by whoever creating the artifact
+        maintaining it, but there is no hook to clean the corresponding meta-for-commit ref.
+
+        This subroutine will scan all existing meta-for-commit references and determine if an artifact is still
+        available, also after the refs in `deleting` are gone. The meta-for-commit refs of unavailable artifacts
+        are returned.
+    """
+    remote_refs = rbgit.remote_refs(remote_bin_name, FLUSH_META_PREFIXES)
+
+    # Artifact commits which are still kept alive by a branch or tag. As 20-byte binary SHAs, for a million refs.
+    # An annotated tag keeps alive the commit it points to, listed as its peeled `^{}` ref
+    deleting = {ref.encode() for ref in deleting}
+    alive = {sha for prefix in ("refs/heads/", "refs/tags/") for ref, sha in remote_refs.binary_items(prefix) if ref not in deleting}
+
+    # Meta-for-commit refs end in the SHA of the artifact commit they describe
+    sha_len = 40
+    return [ref.decode() for ref, _ in remote_refs.binary_items("refs/artifact/meta-for-commit/") if sha_bytes(ref[-sha_len:]) not in alive]
+
+def sha_bytes(sha: bytes) -> bytes | None:
+    """ Binary form of hex SHA, or None if not a SHA """
+    try:
+        return bytes.fromhex(sha.decode())
+    except ValueError:
+        return None
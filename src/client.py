@@ -0,0 +1,122 @@
+import os
+import sys
+from types import SimpleNamespace
+
+from rbgit import RbGit
+from mirror import Mirror
+from printer import printer
+from list import query_artifacts
+from download import download_command
+from push import PushOptions, commit_artifacts, publish_artifacts
+from clean import clean_command
+from util import exec
+from util_file import rmtree_background
+
+
+class RecycleBinClient:
+    """
+        Session with a bin remote, for programs which would otherwise run the CLI many times over.
+        The local bin repo, snapshots of remote refs, the object reader and ssh connections are set up once and shared
+        by all calls, and pushes, listings and downloads run in-process.
+
+        Like the CLI, the client works on the source repo of the current directory:
+
+            with RecycleBinClient("git@example.com:bin.git") as client:
+                artifacts = client.push([("obj/docs", "docs")], tag=True)
+                client.list(name="docs")
+
+        Methods raise RuntimeError on failure. The local bin repo is placed in root, by default the source repo's root;
+        artifacts outside it need a root above both.
+    """
+
+    def __init__(self, remote: str, root: str | None = None, src_remote_name: str = "origin",
+                 user_name: str | None = None, user_email: str | None = None,
+                 cache: bool = False, cache_budget: int = 1 << 30, mirror_dir: str | None = None, rm_tmp: bool = True,
+                 src_fsmonitor: bool = False, src_commit_graph: bool = False, ssh_multiplex: bool = True):
+        self.remote = resolve_remote(remote)
+        self.remote_bin_name = "recyclebin"
+        self.src_remote_name = src_remote_name
+        self.user_name = user_name
+        self.user_email = user_email
+        self.src_fsmonitor = src_fsmonitor
+        self.src_commit_graph = src_commit_graph
+        # Keep local bin repo between sessions, so objects already present need no hashing nor transfer
+        self.rm_tmp = rm_tmp and not cache
+
+        # Source git's root, fully qualified path.
+        self.root = root or exec(["git", "rev-parse", "--show-toplevel"])
+        self.rbgit_dir = f"{self.root}/.rbgit"
+        if self.rm_tmp and os.path.exists(self.rbgit_dir):
+            printer.high_level(f"Deleting local bin repo, {self.rbgit_dir}, to start from clean-slate.", file=sys.stderr)
+            rmtree_background(self.rbgit_dir)
+
+        self.rbgit = RbGit(printer, rbgit_dir=self.rbgit_dir, rbgit_work_tree=self.root, cache_budget=cache_budget if cache else None,
+                           ssh_multiplex=ssh_multiplex)
+        if user_name:
+            self.rbgit.cmd("config", "--local", "user.name", user_name)
+        if user_email:
+            self.rbgit.cmd("config", "--local", "user.email", user_email)
+        self.rbgit.add_remote_idempotent(name=self.remote_bin_name, url=self.remote)
+        if mirror_dir:
+            self.rbgit.use_mirror(Mirror(printer, mirror_dir, self.remote, env=self.rbgit.ssh_env))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ End the session: Stop the object reader, trim the cache to budget, and delete the local bin repo unless cached """
+        self.rbgit.close()
+        if self.rbgit.cache:
+            self.rbgit.cache.evict()
+        if self.rm_tmp and os.path.exists(self.rbgit_dir):
+            printer.high_level(f"Deleting local bin repo, {self.rbgit_dir}, to free-up disk-space.", file=sys.stderr)
+            rmtree_background(self.rbgit_dir)
+
+    def push(self, artifacts: list[tuple[str, str]], remotes: list[str] = (), expire: str = "in 30 days",
+             tag: bool = False, note: bool = False, add_ignored: bool = False, atomic: bool = False,
+             force_branch: bool = False, force_tag: bool = False, rm_expired: bool = False, flush_meta: bool = False,
+             from_tar: str | None = None, jobs: int = 4) -> list[dict]:
+        """
+            Commit artifacts, given as (path, name) pairs, and push them to our remote and any further remotes.
+            Returns the artifacts' metadata, e.g. 'bin_sha_commit' and 'bin_branch_name'. Raises if any remote failed.
+        """
+        options = PushOptions([self.remote, *map(resolve_remote, remotes)], expire=expire, push_tag=tag, push_note=note,
+                              add_ignored=add_ignored, atomic=atomic, force_branch=force_branch, force_tag=force_tag,
+                              rm_expired=rm_expired, flush_meta=flush_meta, from_tar=from_tar, jobs=jobs,
+                              src_remote_name=self.src_remote_name, src_fsmonitor=self.src_fsmonitor, src_commit_graph=self.src_commit_graph,
+                              user_name=self.user_name, user_email=self.user_email)
+        ds = commit_artifacts(options, self.rbgit, artifacts)
+        failed = publish_artifacts(options, ds, self.rbgit, self.remote_bin_name)
+        if failed:
+            raise RuntimeError(f"Push failed to {', '.join(failed)}")
+        return ds
+
+    def download(self, artifacts: list[str], force: bool = False, delta: bool = False, only: list[str] | None = None):
+        """ Check out artifacts, by SHA or branch or tag name, into the work tree. See the CLI's download for the options """
+        args = SimpleNamespace(artifacts=list(artifacts), force=force, delta=delta, only=only)
+        if download_command(args, self.rbgit, self.remote_bin_name):
+            raise RuntimeError("Download would overwrite local files")
+
+    def clean(self, flush_meta: bool = True, dry_run: bool = False):
+        """ Delete expired artifacts from remote, and with flush_meta the meta-data left behind """
+        clean_command(self.rbgit, self.remote_bin_name, flush_meta, dry_run)
+
+    def list(self, name: str | None = None, path: str | None = None, with_meta: bool = True):
+        """
+            Artifacts of the source commit checked out, optionally only those of a name or source path.
+            Yields (artifact_sha_commit, meta) with meta-data parsed, as keys like 'artifact-name'; empty without with_meta.
+        """
+        query = ("name", name) if name is not None else ("path", path) if path is not None else ("all", None)
+        return query_artifacts(self.rbgit, self.remote_bin_name, query, with_meta)
+
+
+def resolve_remote(remote: str) -> str:
+    """ URL of remote, where "." is the source repo itself """
+    if remote != ".":
+        return remote
+    src_git_dir = exec(["git", "rev-parse", "--absolute-git-dir"])
+    printer.high_level(f"Will push artifact to local src-git, {src_git_dir}. Mostly used for testing.", file=sys.stderr)
+    return src_git_dir
@@ -1,15 +1,185 @@
+import os
+import re
+import sys
 from printer import printer
+from stat_cache import StatCache
 
 def download_command(args, rbgit, remote_bin_name):
+    # Stat data of files we wrote, kept next to .rbgit
+    stat_cache = StatCache(f"{rbgit.rbgit_dir}.statcache", rbgit.rbgit_work_tree)
+
+    left_sparse = rbgit.sparse_checkout(args.only)
+
     for artifact in args.artifacts:
-        rbgit.cmd("fetch", remote_bin_name, artifact)
+        sha = resolve_artifact(rbgit, remote_bin_name, artifact)
+        if sha and work_tree_has_artifact(rbgit, stat_cache, sha, args.only):
+            printer.high_level(f"Artifact {artifact} is already in the work tree. Nothing to download.", file=sys.stderr)
+            continue
+
+        if sha and args.delta and not args.only:
+            try:
+                if download_delta(args, rbgit, remote_bin_name, stat_cache, sha):
+                    continue
+            except RuntimeError as e:
+                printer.error(e)
+                printer.error("Use --force to overwrite local files.")
+                return 1
+
+        if args.only:
+            # Trees only. Checkout fetches the blobs of matching paths, in one batch
+            rbgit.enable_partial_clone(remote_bin_name)
+            rbgit.cmd("fetch", "--filter=blob:none", remote_bin_name, artifact)
+            if rbgit.cache:
+                rbgit.cache.keep(rbgit.fetch_head())
+        elif rbgit.mirror:
+            # Objects arrive through the host-wide mirror, which our bin repo borrows from
+            artifact = rbgit.mirror.fetch(artifact)
+            if rbgit.cache:
+                rbgit.cache.keep(artifact)
+        elif rbgit.cache and is_sha(artifact) and rbgit.has_object(f"{artifact}^{{commit}}"):
+            printer.high_level(f"Artifact {artifact} already in local bin repo cache.")
+            rbgit.cache.keep(artifact)
+        else:
+            rbgit.cmd("fetch", remote_bin_name, artifact)
+            if rbgit.cache:
+                rbgit.cache.keep(rbgit.fetch_head())
         if args.force:
             rbgit.cmd("checkout", "-f", artifact)
+            if left_sparse:
+                rbgit.check_out_skipped(force=True)
         else:
             # dont fail with python stack trace if file already exists
             try:
                 rbgit.cmd("checkout", artifact)
+                if left_sparse:
+                    rbgit.check_out_skipped()
             except RuntimeError as e:
                 printer.error(e)
                 printer.error("Use --force to overwrite local files.")
                 return 1
+
+        commit = artifact if is_sha(artifact) else (sha or rbgit.fetch_head())
+        entries = tree_entries(rbgit, commit)
+        if args.only:
+            entries = checked_out_entries(rbgit, entries)
+        stat_cache.record(stat_cache.key(commit, args.only), entries)
+
+def is_sha(artifact: str) -> bool:
+    return re.fullmatch(r"[0-9a-f]{40}", artifact) is not None
+
+def resolve_artifact(rbgit, remote_bin_name, artifact: str) -> str | None:
+    """ Commit SHA of artifact, given by SHA or by branch or tag name. None if the remote has no such ref """
+    if is_sha(artifact):
+        return artifact
+    candidates = [artifact] if artifact.startswith("refs/") else [f"refs/heads/{artifact}", f"refs/tags/{artifact}"]
+    remote_refs = rbgit.remote_refs(remote_bin_name, candidates)
+    return next((sha for sha in map(remote_refs.get, candidates) if sha), None)
+
+def work_tree_has_artifact(rbgit, stat_cache, sha: str, only: list[str] | None = None) -> bool:
+    """
+        Whether the work tree already holds the artifact, or the parts of it matching `only`, so downloading would change nothing.
+        Answered without fetching: By stat data if we checked it out before, else by hashing if we have its tree locally.
+    """
+    key = stat_cache.key(sha, only)
+    if stat_cache.known(key):
+        return stat_cache.matches(rbgit, key)
+    if not only and rbgit.has_object(f"{sha}^{{tree}}"):
+        return stat_cache.adopt(rbgit, sha, tree_entries(rbgit, sha))
+    return False
+
+def tree_entries(rbgit, commit: str) -> list[tuple[str, str, str]]:
+    """ (mode, blob, path) of all files in commit, paths relative to the work tree """
+    entries = []
+    for line in rbgit.stream("ls-tree", "-r", "-z", "--full-tree", commit, sep="\0"):
+        if not line:
+            continue
+        info, path = line.split("\t", 1)
+        mode, kind, obj = info.split()
+        if kind == "blob":
+            entries.append((mode, obj, path))
+    return entries
+
+def checked_out_entries(rbgit, entries: list[tuple[str, str, str]]) -> list[tuple[str, str, str]]:
+    """ Entries not left out by sparse checkout """
+    skipped = {line[2:] for line in rbgit.stream("ls-files", "-t", "-z", sep="\0") if line.startswith("S ")}
+    return [entry for entry in entries if entry[2] not in skipped]
+
+def download_delta(args, rbgit, remote_bin_name, stat_cache, sha: str) -> bool:
+    """
+        Switch the work tree from the artifact currently in it to artifact sha, transferring and writing only files which differ.
+        Trees are fetched without blobs, then only the changed blobs are fetched.
+        Returns False if no artifact we wrote is intact in the work tree, so there is nothing to start from.
+    """
+    current = stat_cache.latest()
+    if current is None or not stat_cache.matches(rbgit, current):
+        return False
+
+    if rbgit.mirror:
+        rbgit.mirror.fetch(sha)
+    elif not rbgit.has_object(f"{sha}^{{tree}}"):
+        rbgit.enable_partial_clone(remote_bin_name)
+        rbgit.cmd("fetch", "--no-tags", "--filter=blob:none", remote_bin_name, sha)
+
+    old = stat_cache.files(current)
+    entries = tree_entries(rbgit, sha)
+    new = {path: (mode, blob) for mode, blob, path in entries}
+    changed = {path: (mode, blob) for path, (mode, blob) in new.items() if old.get(path) != (mode, blob)}
+    removed = [path for path in old if path not in new]
+
+    # Like checkout: Never overwrite files we did not write ourselves
+    clobbered = [path for path in changed if path not in old and os.path.lexists(os.path.join(rbgit.rbgit_work_tree, path))]
+    if clobbered and not args.force:
+        raise RuntimeError(f"Untracked files would be overwritten by artifact {sha}: {', '.join(clobbered[:10])}")
+
+    printer.high_level(f"Delta download of {sha}: {len(changed)} changed, {len(removed)} removed, {len(new) - len(changed)} unchanged files.", file=sys.stderr)
+
+    blobs = {blob for _, blob in changed.values()}
+    missing = sorted(blobs & rbgit.missing_objects(sha))
+    if missing:
+        rbgit.cmd("fetch", "--no-tags", "--no-write-fetch-head", "--stdin", remote_bin_name, input="".join(f"{blob}\n" for blob in missing))
+
+    for path in removed:
+        remove_file(rbgit.rbgit_work_tree, path)
+
+    paths_by_blob = {}
+    for path, (mode, blob) in changed.items():
+        paths_by_blob.setdefault(blob, []).append((path, mode))
+    for blob, contents in rbgit.reader().iter_many(sorted(blobs)):
+        for path, mode in paths_by_blob[blob]:
+            write_file(rbgit.rbgit_work_tree, path, mode, contents)
+
+    # Keep the bin repo's own idea of what is checked out in line with the work tree
+    rbgit.cmd("update-ref", "--no-deref", "HEAD", sha)
+    rbgit.cmd("read-tree", sha)
+    if rbgit.cache:
+        rbgit.cache.keep(sha)
+    stat_cache.record(sha, entries)
+    return True
+
+def write_file(work_tree: str, path: str, mode: str, contents: bytes):
+    """ Replace file at path atomically, as checkout would write it """
+    full = os.path.join(work_tree, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    tmp = f"{full}.gitrb-tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)  # Left over by an interrupted download
+    if mode == "120000":
+        os.symlink(os.fsdecode(contents), tmp)
+    else:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777 if mode == "100755" else 0o666)  # Honors umask
+        with os.fdopen(fd, "wb") as file:
+            file.write(contents)
+    os.replace(tmp, full)
+
+def remove_file(work_tree: str, path: str):
+    """ Remove file at path, and the directories it leaves empty """
+    full = os.path.join(work_tree, path)
+    if os.path.lexists(full):
+        os.remove(full)
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(work_tree, parent))
+        except OSError:
+            break  # Not empty
+        parent = os.path.dirname(parent)
@@ -5,13 +5,28 @@ from commit_msg import parse_commit_msg
 
 
 def list_command(args, rbgit, remote_bin_name):
+    for artifact_sha_commit, _ in query_artifacts(rbgit, remote_bin_name, args.query):
+        print(artifact_sha_commit)
+
+
+def query_artifacts(rbgit, remote_bin_name, query, with_meta: bool = False):
+    """
+        Artifacts matching query, a (flag, value) tuple, e.g. ("name", "docs") or the default ("all", None).
+        Yields (artifact_sha_commit, meta) with meta-data parsed; empty unless asked for or needed to filter, so plain listings stream.
+    """
+    func = filter_funcs[query[0]]
+    if query[0] != "all":
+        printer.debug(f"Filtering artifacts by {query[0]}={query[1]}")
     artifacts = remote_artifacts(rbgit, remote_bin_name)
-    func = filter_funcs[args.query[0]] # query is a tuple of (flag, value) default is ("all", None)
-    if args.query[0] != "all":
-        printer.debug(f"Filtering artifacts by {args.query[0]}={args.query[1]}")
-    artifacts = filter_artifacts(rbgit, remote_bin_name, args.query[1], artifacts, func)
-    for artifact in artifacts:
-        print(artifact[1])
+    if not with_meta:
+        yield from ((artifact[1], {}) for artifact in filter_artifacts(rbgit, remote_bin_name, query[1], artifacts, func))
+        return
+    artifacts = list(artifacts)
+    metas = remote_artifacts_meta(rbgit, remote_bin_name, artifacts)
+    for meta_sha_blob, artifact_sha_commit in artifacts:
+        meta = metas.get(meta_sha_blob, {})
+        if func((meta_sha_blob, artifact_sha_commit), meta=meta, query=query[1]):
+            yield artifact_sha_commit, meta
 
 
 def remote_artifacts(rbgit, remote_bin_name):
@@ -19,38 +34,42 @@ def remote_artifacts(rbgit, remote_bin_name):
     # This schema makes it easy to query which artifact are available for the given commit.
     # This allows us to drastically reduce the meta-data to search through, which
     # can then further be queried.
+    # Artifacts are yielded as (meta_sha_blob, artifact_sha_commit), one by one off the compact ref snapshot.
     src_sha = exec(["git", "rev-parse", "HEAD"])
     search_path = f"refs/artifact/meta-for-commit/{src_sha}/"
-    lines = rbgit.cmd("ls-remote", "--refs", remote_bin_name, f"{search_path}*").splitlines()
-    artifacts = []
-    for line in lines:
-        cols = line.split()
-        meta_sha_blob = cols[0]
-        artifact_sha_commit = cols[1].strip()[len(search_path):]
-        artifacts.append((meta_sha_blob, artifact_sha_commit))
-    return artifacts
+    for ref, meta_sha_blob in rbgit.remote_refs(remote_bin_name).items(search_path):
+        artifact_sha_commit = ref[len(search_path):]
+        yield meta_sha_blob, artifact_sha_commit
+
+
+def remote_artifacts_meta(rbgit, remote_bin_name, artifacts) -> dict[str, dict]:
+    """
+        Fetch and parse the meta-data of all artifacts in one go.
+        Costs a single fetch negotiation and a single cat-file, however many artifacts there are.
+    """
+    contents = rbgit.fetch_cat_pretty_many(remote_bin_name, [meta_sha_blob for meta_sha_blob, _ in artifacts])
+    return {meta_sha_blob: parse_commit_msg(data) for meta_sha_blob, data in contents.items()}
 
 
 def filter_artifacts(rbgit, remote_bin_name, query, artifacts, filter_func):
+    if filter_func not in meta_filter_funcs:
+        # Nothing to fetch first, so artifacts stream straight through
+        return (artifact for artifact in artifacts if filter_func(artifact, meta={}, query=query))
+    artifacts = list(artifacts)
+    metas = remote_artifacts_meta(rbgit, remote_bin_name, artifacts)
     return [
         artifact
         for artifact in artifacts
-        if filter_func(artifact, rbgit=rbgit, remote_bin_name=remote_bin_name, query=query)
+        if filter_func(artifact, meta=metas.get(artifact[0], {}), query=query)
     ]
 
 
 def filter_artifacts_by_name(artifact, **kwargs):
-    rbgit = kwargs['rbgit']
-    remote_bin_name = kwargs['remote_bin_name']
-    data = rbgit.fetch_cat_pretty(remote_bin_name, artifact[0])
-    return parse_commit_msg(data)['artifact-name'] == sanitize_branch_name(kwargs['query'])
+    return kwargs['meta'].get('artifact-name') == sanitize_branch_name(kwargs['query'])
 
 
 def filter_artifacts_by_path(artifact, **kwargs):
-    rbgit = kwargs['rbgit']
-    remote_bin_name = kwargs['remote_bin_name']
-    data = rbgit.fetch_cat_pretty(remote_bin_name, artifact[0])
-    return parse_commit_msg(data)['src-git-relpath'] == kwargs['query']
+    return kwargs['meta'].get('src-git-relpath') == kwargs['query']
 
 
 filter_funcs = {
@@ -58,3 +77,6 @@ filter_funcs = {
     'path': filter_artifacts_by_path,
     'all': lambda artifact, **kwargs: True,
 }
+
+# Filters which look into the meta-data, which must be fetched first
+meta_filter_funcs = (filter_artifacts_by_name, filter_artifacts_by_path)
@@ -0,0 +1,104 @@
+import os
+import re
+import sys
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows, where we run without locking
+
+from util_string import url_redact
+from tracing import tracer
+
+
+class Mirror:
+    """
+        Host-wide bare mirror of a bin remote, shared by all workspaces on the host.
+
+        Each workspace's .rbgit borrows the mirror's objects through `objects/info/alternates`, so an artifact
+        fetched once per host is available to every workspace without network traffic.
+        Fetching into the mirror is serialized by a file lock, as many workspaces may download at once.
+        Objects are never pruned from the mirror, as workspaces rely on them; delete the mirror directory to reclaim space.
+    """
+
+    def __init__(self, printer, mirror_dir: str, url: str, env: dict = {}):
+        self.printer = printer
+        self.url = url
+        self.env = env  # Extra environment of git, e.g. RbGit.ssh_env
+        # Keyed by URL, without credentials which may change between jobs
+        key = hashlib.sha256(url_redact(url).encode()).hexdigest()[:16]
+        name = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(url_redact(url).rstrip("/")))
+        self.path = os.path.join(os.path.abspath(mirror_dir), f"{name}-{key}")
+        self.init_idempotent()
+
+    def cmd(self, *args) -> str:
+        self.printer.debug("Run:", ["mirror", *args], file=sys.stderr)
+        env = {k: v for k, v in os.environ.items() if k not in ("GIT_DIR", "GIT_WORK_TREE", "GIT_INDEX_FILE")}
+        span = tracer.begin(["mirror", *args])
+        result = subprocess.run(["git", *args], env=env | self.env | {"GIT_DIR": self.path}, capture_output=True, text=True)
+        tracer.end(span, result.returncode, result.stdout, result.stderr)
+        if result.returncode != 0:
+            raise RuntimeError(f"Mirror command failed with error: {result.stderr}")
+        return result.stdout
+
+    @contextmanager
+    def lock(self):
+        """ Exclusive access to the mirror, across processes """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", "a") as file:
+            if fcntl:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def init_idempotent(self):
+        if os.path.exists(os.path.join(self.path, "objects")):
+            return
+        with self.lock():
+            if not os.path.exists(os.path.join(self.path, "objects")):
+                subprocess.run(["git", "init", "--quiet", "--bare", self.path], check=True, capture_output=True)
+                self.cmd("config", "gc.auto", "0")  # Never prune objects which workspaces borrow
+
+    def attach(self, rbgit_dir: str):
+        """ Let the bin repo at rbgit_dir borrow our objects """
+        objects = os.path.join(self.path, "objects")
+        alternates = os.path.join(rbgit_dir, "objects", "info", "alternates")
+        try:
+            with open(alternates) as file:
+                if objects in file.read().splitlines():
+                    return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(alternates), exist_ok=True)
+        with open(alternates, "a") as file:
+            file.write(f"{objects}\n")
+
+    def has_commit(self, sha: str) -> bool:
+        try:
+            self.cmd("cat-file", "-e", f"{sha}^{{commit}}")
+            return True
+        except RuntimeError:
+            return False
+
+    def fetch(self, artifact: str) -> str:
+        """ SHA of artifact commit, fetched into the mirror unless already there """
+        is_sha = re.fullmatch(r"[0-9a-f]{40}", artifact) is not None
+        if is_sha and self.has_commit(artifact):
+            self.printer.high_level(f"Artifact {artifact} already in host mirror {self.path}", file=sys.stderr)
+            return artifact
+
+        with self.lock():
+            # Another workspace may have fetched it while we waited
+            if is_sha and self.has_commit(artifact):
+                return artifact
+            self.cmd("fetch", "--no-tags", self.url, artifact)
+            sha = self.cmd("rev-parse", "FETCH_HEAD").strip()
+            # Keep fetched objects referenced, so they are never garbage
+            self.cmd("update-ref", f"refs/gitrb/{sha}", sha)
+        return sha
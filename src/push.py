@@ -0,0 +1,536 @@
+import os
+import sys
+import copy
+import json
+import time
+import random
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from tar_import import open_tar
+from source_snapshot import SourceSnapshot
+from printer import printer
+from tracing import tracer
+from util_string import (
+    sanitize_branch_name,
+    sanitize_slashes,
+)
+from util_file import nca_path, rel_dir, classify_path
+from util_date import (
+    DATE_FMT_GIT,
+    DATE_FMT_EXPIRE,
+    date_fuzzy2expiryformat,
+    date_formatted2unix,
+)
+from util_sysinfo import get_user, get_hostname
+from util import exec, exec_nostderr
+from commit_msg import emit_commit_msg, parse_commit_msg
+from clean import FLUSH_META_PREFIXES, expired_branch_prefixes, remote_clean
+
+
+# Pushing notes which others push too: Retries wait a random delay up to the backoff, which doubles per try
+NOTES_PUSH_TRIES = 10
+NOTES_BACKOFF_S = 0.1
+NOTES_BACKOFF_MAX_S = 5.0
+
+
+class PushOptions:
+    """
+        Options of pushing artifacts, named as the CLI's arguments of push.
+        Artifacts go to each of remotes, jobs of them at a time; remote is the first.
+    """
+
+    def __init__(self, remotes: list[str], expire: str = "in 30 days", push_tag: bool = False, push_note: bool = False,
+                 add_ignored: bool = False, atomic: bool = False, force_branch: bool = False, force_tag: bool = False,
+                 rm_expired: bool = False, flush_meta: bool = False, from_tar: str | None = None, jobs: int = 4,
+                 src_remote_name: str = "origin", src_fsmonitor: bool = False, src_commit_graph: bool = False,
+                 user_name: str | None = None, user_email: str | None = None):
+        if force_tag and not force_branch:
+            raise RuntimeError("Forcing tag requires forcing branch")
+        self.remote = remotes[0]
+        self.remotes = remotes
+        self.expire = expire
+        self.push_tag = push_tag
+        self.push_note = push_note
+        self.add_ignored = add_ignored
+        self.atomic = atomic
+        self.force_branch = force_branch
+        self.force_tag = force_tag
+        self.rm_expired = rm_expired
+        self.flush_meta = flush_meta
+        self.from_tar = from_tar
+        self.jobs = jobs
+        self.src_remote_name = src_remote_name
+        self.src_fsmonitor = src_fsmonitor
+        self.src_commit_graph = src_commit_graph
+        self.user_name = user_name
+        self.user_email = user_email
+
+
+def create_artifact_commit(rbgit, artifact_name: str, binpath: str, expire_branch: str, add_ignored: bool, src_remote_name: str, from_tar: str | None = None,
+                           src_fsmonitor: bool = False, src_commit_graph: bool = False, src: SourceSnapshot | None = None,
+                           root: str | None = None) -> dict[str, str]:
+    """
+        Create Artifact: A binary commit, with builtin traceability and expiry.
+        With from_tar, the artifact's contents are read from that tarball ('-' for stdin) and binpath only tells where they belong.
+        Source metadata is sampled, unless src is given: Artifacts built from the same source share one snapshot.
+        Paths in the bin repo are relative to root, by default the nearest common ancestor of source root and binpath.
+        Artifacts committed together must share a root, that of the bin repo's work tree.
+    """
+    if not from_tar and not os.path.exists(binpath):
+        raise RuntimeError(f"Artifact '{binpath}' does not exist!")
+
+    artifact_name_given = artifact_name
+    artifact_name_sane = sanitize_branch_name(artifact_name)
+    if artifact_name != artifact_name_sane:
+        printer.always(f"Warning: Sanitized '{artifact_name}' to '{artifact_name_sane}'.", file=sys.stderr)
+        artifact_name = artifact_name_sane
+
+    d = {}
+    d['artifact_name'] = artifact_name
+    d['artifact_name_given'] = artifact_name_given  # Notes are named as given
+    d['binpath'] = binpath
+    d['bin_branch_expire'] = date_fuzzy2expiryformat(expire_branch)  # also used by --push-note
+
+    d['artifact_mime'] = "directory" if from_tar else classify_path(binpath)
+
+    if src is None:
+        src = sample_source(src_remote_name, src_fsmonitor, src_commit_graph)
+    d.update(src.fields)
+
+    d['nca_dir'] = root or nca_path(d['src_tree_root'], binpath)                # Longest shared path between gitroot and artifact(s). Is either {gitroot, something outside gitroot}
+    d['artifact_relpath_nca'] = rel_dir(pto=binpath, pfrom=d['nca_dir'])        # Relative path to artifact from nca_dir. Artifact is always within nca_dir
+    d['artifact_relpath_src'] = rel_dir(pto=binpath, pfrom=d['src_tree_root'])  # Relative path to artifact from src-git-root. Artifact might be outside of source git.
+
+    # 'expire' branch ref will be deleted with '--rm-expired' argument.
+    # E.g.: 'artifact/expire/2024-07-20/14.17+0200/project.git@182db9b0696a5e9f97a5800e4866917c5465b2c6/{obj/doc/html}'
+    d['bin_branch_name'] = f"artifact/expire/{d['bin_branch_expire']}/{d['src_repo']}@{d['src_sha']}/{{{d['artifact_relpath_nca']}}}"
+    # 'latest' tag ref will not expire but is overwritten to point to newer SHA.
+    # E.g.: 'artifact/latest/project.git@main/{obj/doc/html}'
+    d['bin_tag_name']    = f"artifact/latest/{d['src_repo']}@{d['src_branch']}/{{{d['artifact_relpath_nca']}}}" if d['src_branch'] != "HEAD" else None
+
+    d['bin_commit_msg'] = emit_commit_msg(d)
+
+    printer.high_level(f"Adding '{from_tar or binpath}' as '{d['artifact_relpath_nca']}' ...", file=sys.stderr)
+    # Set {author,committer}-dates: Make our new commit reproducible by copying from the source; do not sample the current time.
+    # Sampling the current time would lead to new commit SHA every time, thus not idempotent.
+    dates = {"GIT_AUTHOR_DATE": d['src_time_author'], "GIT_COMMITTER_DATE": d['src_time_commit']}
+    if from_tar:
+        with open_tar(from_tar) as stream:
+            d['bin_sha_commit'], changes = rbgit.commit_tar(d['bin_branch_name'], stream, d['artifact_relpath_nca'], d['bin_commit_msg'], env=dates)
+    else:
+        d['bin_sha_commit'], changes = rbgit.commit_path(d['bin_branch_name'], binpath, d['bin_commit_msg'], force=add_ignored, env=dates)
+    if not changes:
+        printer.high_level(f"No changes for the next commit. Already at {d['bin_sha_commit']}", file=sys.stderr)
+    d['bin_time_commit'] = rbgit.cmd("show", "-s", "--format=%cd", f"--date=format:{DATE_FMT_EXPIRE}", d['bin_sha_commit']).strip()
+
+    printer.high_level(f"Artifact commit: {d['bin_sha_commit']}", file=sys.stderr)
+    printer.high_level(f"Artifact branch: {d['bin_branch_name']}", file=sys.stderr)
+    # Now we have a commit, we can set a tag pointing to it
+    if d['bin_tag_name']:
+        rbgit.set_tag(tag_name=d['bin_tag_name'], tag_val=d['bin_sha_commit'])
+        printer.high_level(f"Artifact tag: {d['bin_tag_name']}", file=sys.stderr)
+
+    # Fetching a commit implies fetching its whole tree too, which may be big!
+    # We want light-weight access to the meta-data stored in the commit's message, so we
+    # copy meta-data to a new object which can be fetched standalone - without downloading the whole tree.
+    # NOTE: This meta-data could be augmented with convenient/unstable information - this would not compromise the commit-SHA's stability.
+    d['bin_sha_only_metadata'] = rbgit.cmd("hash-object", "--stdin", "-w", input=d['bin_commit_msg']).strip()
+    # Create new ref for the artifact-commit, pointing to [Meta data]-only.
+    d['bin_ref_only_metadata'] = f"refs/artifact/meta-for-commit/{d['src_sha']}/{d['bin_sha_commit']}"
+    rbgit.cmd("update-ref", d['bin_ref_only_metadata'], d['bin_sha_only_metadata'])
+    if rbgit.cache:
+        rbgit.cache.touch(f"refs/heads/{d['bin_branch_name']}", d['bin_ref_only_metadata'], *([f"refs/tags/{d['bin_tag_name']}"] if d['bin_tag_name'] else []))
+
+    printer.high_level(f"Artifact [meta data]-only ref: {d['bin_ref_only_metadata']}", file=sys.stderr)
+    printer.high_level(f"Artifact [meta data]-only obj: {d['bin_sha_only_metadata']}", file=sys.stderr)
+
+    return d
+
+def sample_source(src_remote_name: str, src_fsmonitor: bool, src_commit_graph: bool) -> SourceSnapshot:
+    with tracer.phase("snapshot"):
+        src = SourceSnapshot(src_remote_name, fsmonitor=src_fsmonitor, commit_graph=src_commit_graph)
+    printer.detail(f"Collected source metadata in {src.elapsed:.2f}s", file=sys.stderr)
+    return src
+def push_command(args, rbgit, remote_bin_name, artifacts: list[tuple[str, str]]) -> int:
+    """
+        Commit artifacts, given as (path, name) pairs, and publish them to each binary remote.
+        Artifacts are built from the same source, so its metadata is sampled once for all of them.
+        More than one artifact is published in a single atomic push.
+        Several remotes are pushed to concurrently, so the slowest remote bounds the time. Returns non-zero if any failed.
+    """
+    ds = commit_artifacts(args, rbgit, artifacts)
+    return 1 if publish_artifacts(args, ds, rbgit, remote_bin_name) else 0
+
+def commit_artifacts(args, rbgit, artifacts: list[tuple[str, str]]) -> list[dict]:
+    """
+        Local artifact commits, of (path, name) pairs. Source metadata is sampled once, for all of them.
+        Their paths are all relative to the bin repo's work tree, the root they share.
+    """
+    src = sample_source(args.src_remote_name, args.src_fsmonitor, args.src_commit_graph)
+    # Git won't add files of the source repo from a work tree above it, as that's another repo's
+    inside = {not rel_dir(pto=path, pfrom=src.fields['src_tree_root']).startswith("..") for path, _ in artifacts}
+    if len(inside) > 1:
+        raise RuntimeError("Artifacts inside and outside the source repo can't be pushed together, push them separately")
+    ds = []
+    for path, name in artifacts:
+        printer.high_level(f"Making local commit of artifact {path} in artifact-repo at {rbgit.rbgit_dir}", file=sys.stderr)
+        ds.append(create_artifact_commit(rbgit, name, path, args.expire, args.add_ignored, args.src_remote_name, from_tar=args.from_tar, src=src,
+                                         root=rbgit.rbgit_work_tree))
+    if len({d['bin_branch_name'] for d in ds}) < len(ds):
+        raise RuntimeError("Artifacts pushed together must have distinct paths")
+    printer.detail(rbgit.cmd("branch", "-vv"))
+    for d in ds:
+        printer.detail(rbgit.cmd("log", "-1", d['bin_branch_name']))
+    return ds
+
+def publish_artifacts(args, ds: list[dict], rbgit, remote_bin_name) -> list[str]:
+    """ Push committed artifacts to each remote in args.remotes, concurrently if several. Returns the URLs which failed """
+    # First remote is the one named on setup, further remotes get numbered names
+    remotes = {remote_bin_name: args.remotes[0]} | {f"{remote_bin_name}{i}": url for i, url in enumerate(args.remotes[1:], 2)}
+    for name, url in remotes.items():
+        rbgit.add_remote_idempotent(name=name, url=url)
+    if len(remotes) == 1:
+        push_remote(args, ds, rbgit, remote_bin_name)
+        return []
+
+    # Each worker only spends its time waiting on git, so threads suffice
+    with ThreadPoolExecutor(max_workers=min(args.jobs, len(remotes))) as pool:
+        futures = {url: pool.submit(tracer.inherit(push_remote), with_remote(args, url), ds, rbgit, name) for name, url in remotes.items()}
+    failed = []
+    for url, future in futures.items():
+        try:
+            future.result()
+            printer.high_level(f"Pushed to {url}", file=sys.stderr)
+        except Exception as e:
+            printer.error(f"Error: Push to {url} failed: {e}", file=sys.stderr)
+            failed.append(url)
+    if failed:
+        printer.error(f"Error: Push failed to {len(failed)} of {len(remotes)} remotes", file=sys.stderr)
+    return failed
+
+def with_remote(args, url: str):
+    """ Copy of args, for pushing to url """
+    args = copy.copy(args)
+    args.remote = url
+    return args
+
+def push_remote(args, ds: list[dict], rbgit, remote_bin_name):
+    """ Publish committed artifacts to binary remote, args.remote, with notes and cleaning as asked for """
+    # List everything we will ask the bin-remote about, in one go
+    with tracer.phase("ls-refs"):
+        rbgit.remote_refs(remote_bin_name, remote_ref_prefixes(args, ds))
+    if args.atomic or len(ds) > 1:
+        push_atomic(args, ds, rbgit, remote_bin_name)
+    else:
+        push_branch(args, ds[0], rbgit, remote_bin_name)
+        if args.push_tag:
+            with tracer.phase("tag"):
+                push_tag(args, ds[0], rbgit, remote_bin_name)
+    if args.push_note:
+        with tracer.phase("notes"):
+            note_append_push(args, ds, rbgit.ssh_env)
+    if args.rm_expired or args.flush_meta:
+        with tracer.phase("clean"):
+            remote_clean(rbgit, remote_bin_name, args.rm_expired, args.flush_meta)
+
+def remote_ref_prefixes(args, ds: list[dict]) -> list[str]:
+    """ Remote refs which pushing the artifacts will ask about, given the arguments """
+    prefixes = []
+    for d in ds:
+        prefixes += [f"refs/heads/{d['bin_branch_name']}", d['bin_ref_only_metadata']]
+        if args.push_tag and d['bin_tag_name']:
+            prefixes.append(f"refs/tags/{d['bin_tag_name']}")
+    if args.rm_expired:
+        prefixes.extend(expired_branch_prefixes())
+    if args.flush_meta:
+        prefixes.extend(FLUSH_META_PREFIXES)
+    return prefixes
+
+def push_branch(args, d, rbgit, remote_bin_name):
+    """
+        Push branch to binary remote.
+
+        Push branch first, then meta-data (we don't want meta-data to be pushed if branch push fails).
+        Branch might exist already upstream.
+        Pushing may take long, so always show stdout and stderr without capture.
+    """
+    updates = {}
+    try:
+        push_branch_refs(args, d, rbgit, remote_bin_name, updates)
+    finally:
+        rbgit.remote_refs(remote_bin_name).set_many(updates)  # Also what got pushed before a failure
+
+
+def push_branch_refs(args, d, rbgit, remote_bin_name, updates: dict):
+    """ Push branch then meta-data, collecting the refs pushed into updates """
+    printer.high_level(f"Pushing to remote artifact-repo: Artifact data on branch {d['bin_branch_name']}", file=sys.stderr)
+    with tracer.phase("push-branch"):
+        if args.force_branch:
+            rbgit.cmd("push", "--force", remote_bin_name, d['bin_branch_name'], capture_output=False)
+            updates[f"refs/heads/{d['bin_branch_name']}"] = d['bin_sha_commit']
+        else:
+            if rbgit.remote_already_has_ref(remote_bin_name, f"refs/heads/{d['bin_branch_name']}"):
+                printer.always(f"Remote artifact-repo already has {d['bin_branch_name']} -- and we won't force push.")
+            else:
+                rbgit.cmd("push",        remote_bin_name, d['bin_branch_name'], capture_output=False)
+                updates[f"refs/heads/{d['bin_branch_name']}"] = d['bin_sha_commit']
+
+    printer.high_level(f"Pushing to remote artifact-repo: Artifact meta-data {d['bin_ref_only_metadata']}", file=sys.stderr)
+    with tracer.phase("push-meta"):
+        if args.force_branch:
+            rbgit.cmd("push", "--force", remote_bin_name, d['bin_ref_only_metadata'], capture_output=False)
+            updates[d['bin_ref_only_metadata']] = d['bin_sha_only_metadata']
+        else:
+            if rbgit.remote_already_has_ref(remote_bin_name, d['bin_ref_only_metadata']):
+                printer.always(f"Remote artifact-repo already has {d['bin_ref_only_metadata']} -- and we won't force push.")
+            else:
+                rbgit.cmd("push",        remote_bin_name, d['bin_ref_only_metadata'], capture_output=False)
+                updates[d['bin_ref_only_metadata']] = d['bin_sha_only_metadata']
+
+
+def push_tag(args, d, rbgit, remote_bin_name):
+    """
+        Push tag to binary remote.
+    """
+    tag_lease = tag_update_lease(args, d, rbgit, remote_bin_name)
+    if tag_lease is None:
+        return
+
+    if tag_lease:
+        rbgit.cmd("push", "--force", remote_bin_name, d['bin_tag_name'])  # Push with force is necessary to update existing tag
+    else:
+        rbgit.cmd("push", remote_bin_name, d['bin_tag_name'])  # Create new tag; push with force is not necessary
+
+    rbgit.remote_refs(remote_bin_name).set(f"refs/tags/{d['bin_tag_name']}", d['bin_sha_commit'])
+
+
+def tag_update_lease(args, d, rbgit, remote_bin_name, remote_metas: dict[str, str] | None = None) -> str | None:
+    """
+        Decide if our 'latest' tag should be published to binary remote.
+        Returns the value the remote tag must still have for us to update it, empty if it must not exist.
+        Returns None if the remote tag should be left as-is.
+        Metadata of the artifact the remote tag points to is fetched, unless found in remote_metas.
+    """
+    if not d['bin_tag_name']:
+        printer.error("Error: You are in Detached HEAD, so you can't push 'latest' tag to bin-remote with name of your source branch.", file=sys.stderr)
+        return None
+
+    if d['src_commits_ahead'] != "" and int(d['src_commits_ahead']) >= 1:
+        printer.error(f"Error: Your local branch is ahead by {d['src_commits_ahead']} commits of its upstream authoritative branch. Won't push tag to bin-remote.", file=sys.stderr)
+        return None
+
+    remote_bin_sha_commit = rbgit.fetch_current_tag_value(remote_bin_name, d['bin_tag_name'])
+    if not remote_bin_sha_commit:
+        printer.high_level(f"Bin-remote does not have a tag named {d['bin_tag_name']} -- we'll publish it.", file=sys.stderr)
+        return ""
+
+    printer.high_level(f"Bin-remote already has a tag named {d['bin_tag_name']} pointing to {remote_bin_sha_commit[:8]}.", file=sys.stderr)
+    if remote_metas is not None and remote_bin_sha_commit in remote_metas:
+        remote_meta = remote_metas[remote_bin_sha_commit]
+    else:
+        remote_meta = rbgit.fetch_meta_for_commit(remote_bin_name, remote_bin_sha_commit)
+
+    commit_time_ours = d['src_time_commit']
+    commit_time_ours_u = date_formatted2unix(commit_time_ours, DATE_FMT_GIT)
+    commit_time_theirs = parse_commit_msg(remote_meta).get('src-git-commit-time-commit')
+    if commit_time_theirs:
+        commit_time_theirs_u = date_formatted2unix(commit_time_theirs, DATE_FMT_GIT)
+    else:
+        printer.high_level(f"Their artifact {remote_bin_sha_commit[:8]} has no meta-data. Treating it as older than ours.", file=sys.stderr)
+        commit_time_theirs_u = float("-inf")
+    printer.high_level(f"Our artifact {d['bin_sha_commit'][:8]} has src committer-time:   {commit_time_ours} ({commit_time_ours_u})", file=sys.stderr)
+    printer.high_level(f"Their artifact {remote_bin_sha_commit[:8]} has src committer-time: {commit_time_theirs} ({commit_time_theirs_u})", file=sys.stderr)
+
+    if commit_time_ours_u > commit_time_theirs_u:
+        printer.high_level(f"Our artifact is newer than theirs. Updating...", file=sys.stderr)
+        return remote_bin_sha_commit
+    if args.force_tag:
+        printer.high_level(f"Our artifact is not newer than theirs. Forcing update to remote tag.", file=sys.stderr)
+        return remote_bin_sha_commit
+    printer.high_level(f"Our artifact is not newer than theirs. Leaving remote tag as-is.", file=sys.stderr)
+    return None
+
+
+def push_atomic(args, ds: list[dict], rbgit, remote_bin_name):
+    """
+        Push branches, meta-data and tags of artifacts to binary remote in a single atomic push.
+        Costs one round trip, and the artifacts are either fully published or not at all.
+
+        Refs we expect to create must not have appeared meanwhile, and a tag we update must still
+        point to what we compared against; git's leases enforce this on the remote.
+    """
+    remote_refs = rbgit.remote_refs(remote_bin_name)
+    leases = []
+    refspecs = []
+    updates = {}
+
+    for d in ds:
+        for ref, sha in ((f"refs/heads/{d['bin_branch_name']}", d['bin_sha_commit']),
+                         (d['bin_ref_only_metadata'], d['bin_sha_only_metadata'])):
+            if args.force_branch:
+                refspecs.append(f"+{ref}:{ref}")
+            elif remote_refs.get(ref):
+                printer.always(f"Remote artifact-repo already has {ref} -- and we won't force push.")
+                continue
+            else:
+                leases.append(f"--force-with-lease={ref}:")
+                refspecs.append(f"{ref}:{ref}")
+            updates[ref] = sha
+
+    if args.push_tag:
+        with tracer.phase("tag"):
+            # Several tags to compare: Fetch metadata of all the artifacts they point to at once
+            theirs = [rbgit.fetch_current_tag_value(remote_bin_name, d['bin_tag_name']) for d in ds if d['bin_tag_name']]
+            theirs = [sha for sha in theirs if sha]
+            remote_metas = rbgit.fetch_meta_for_commits(remote_bin_name, theirs) if len(theirs) > 1 else None
+            tag_leases = [tag_update_lease(args, d, rbgit, remote_bin_name, remote_metas) for d in ds]
+        for d, tag_lease in zip(ds, tag_leases):
+            if tag_lease is None:
+                continue
+            ref = f"refs/tags/{d['bin_tag_name']}"
+            leases.append(f"--force-with-lease={ref}:{tag_lease}")
+            refspecs.append(f"{ref}:{ref}")
+            updates[ref] = d['bin_sha_commit']
+
+    if not refspecs:
+        printer.high_level("Nothing to publish to remote artifact-repo.", file=sys.stderr)
+        return
+
+    printer.high_level(f"Pushing to remote artifact-repo atomically: {', '.join(updates)}", file=sys.stderr)
+    with tracer.phase("push-atomic"):
+        rbgit.cmd("push", "--atomic", *leases, remote_bin_name, *refspecs, capture_output=False)
+    remote_refs.set_many(updates)
+
+def note_append_push(args, artifacts: list[dict], env: dict = {}):
+    """
+        Add git-notes to local src repository, and push them to src remote.
+        Each note contains a single line of JSON per artifact, pointing to the newly pushed artifact.
+        Such notes makes it discoverable, by simple git-log, where and what artifacts exist.
+
+        Notes of all artifacts are appended locally first, one notes commit per notes ref, then pushed together at once.
+        Many jobs may push notes for the same commit at the same time, so the push is a compare-and-swap: Each ref is
+        only updated if the remote still has the value we expect. Refs rejected as stale are fetched and merged, and
+        pushed again after a randomised, exponentially growing delay, so a herd of jobs spreads out rather than collides.
+        Git runs with env added to its environment, e.g. RbGit.ssh_env.
+    """
+
+    # Many CI systems do not have author configured, and we want to be non-destructive, so use env
+    gitenv = dict(env)
+    if args.user_name:
+        gitenv['GIT_AUTHOR_NAME'] = args.user_name
+        gitenv['GIT_COMMITTER_NAME'] = args.user_name
+    if args.user_email:
+        gitenv['GIT_AUTHOR_EMAIL'] = args.user_email
+        gitenv['GIT_COMMITTER_EMAIL'] = args.user_email
+
+    notes = OrderedDict()  # Notes ref -> lines to append
+    for d in artifacts:
+        git_notes_ref, line = note_line(args, d)
+        notes.setdefault(git_notes_ref, []).append(line)
+
+    leases = {}  # Notes ref -> value we expect the remote to have, empty if absent
+    for git_notes_ref, lines in notes.items():
+        # git-notes assumes refs/notes/commits by default, which we don't want to interfere with,
+        # so we tell git to manipulate our refspec, by the GIT_NOTES_REF environment variable.
+        env = gitenv | {"GIT_NOTES_REF": git_notes_ref}
+        # Our copy is what we last pushed or fetched, if anything. Notes of a new artifact are new on the remote too
+        leases[git_notes_ref] = local_ref_value(git_notes_ref, env)
+        # One message of all lines, as each -m would be a paragraph of its own
+        exec(["git", "notes", "append", "-m", "\n".join(lines), "HEAD"], env=env)
+
+    for attempt in range(NOTES_PUSH_TRIES):
+        rejected = notes_push(args.src_remote_name, leases, gitenv)
+        if not rejected:
+            return
+        delay = random.uniform(0, min(NOTES_BACKOFF_MAX_S, NOTES_BACKOFF_S * 2**attempt))
+        printer.detail(f"Notes on src remote changed meanwhile: {len(rejected)} refs. Merging and retrying in {delay:.2f}s", file=sys.stderr)
+        time.sleep(delay)
+        leases = notes_fetch_merge(args.src_remote_name, rejected, gitenv)
+    raise RuntimeError(f"Failed to push notes to src remote '{args.src_remote_name}' after {NOTES_PUSH_TRIES} tries")
+
+def note_line(args, d) -> tuple[str, str]:
+    """ Notes ref for artifact, and the line of JSON to append to it """
+
+    # Ensure we don't get additional directory levels in note refspec
+    bin_remote_sane = sanitize_slashes(args.remote)
+    name_sane = sanitize_slashes(d['artifact_name_given'])
+
+    # Workspace may have modified tracked files - if so, SHA can't be trusted
+    work_state = "clean" if d['src_status'] == "" else "dirty"
+
+    # This note refspec has some design properties:
+    # - The "notes/artifact/"-prefix permits scoped {ignore,only} fetch of artifact notes.
+    # - The "notes/artifact/{bin_remote_sane}"-prefix permits fetch of only artifacts published on certain binary remotes,
+    #   this reduces git-log spam if some remotes only hold documentation and others hold built images.
+    # - The "notes/artifact/{bin_remote_sane}/{name_sane}"-prefix allows scoping to certain artifacts.
+    # - The final bin_sha_commit level detaches us from retention policy; if all is expired we can delete the note-ref.
+    git_notes_ref = sanitize_branch_name(f"refs/notes/artifact/{bin_remote_sane}/{name_sane}/{d['bin_sha_commit']}-{work_state}")
+
+    # Ensure dumped json is specifically ordered - humans won't look till end of line.
+    # OK to duplicate data from the git note refspec, as either may change.
+    linedata = OrderedDict([
+        # Traceability {what, when, who, from where} published
+        ("date",   d['bin_time_commit']),  # sort chronologically
+        ("name",   d['artifact_name_given']),  # sort similar/rebuilt artifacts together
+        ("user",   get_user()),
+        ("host",   get_hostname()),
+
+        # Retention policy
+        ("expire", d['bin_branch_expire']),
+
+        # Fully qualified 'pointer' to artifact on binary remote
+        ("remote", args.remote),
+        ("commit", d['bin_sha_commit']),  # we only need the artifact commit SHA, not any (expired) branches that point to it
+    ])
+    return git_notes_ref, json.dumps(linedata, separators=(', ', ':'))
+
+def local_ref_value(ref: str, env: dict) -> str:
+    """ SHA of ref in src repo, empty if absent """
+    try:
+        return exec_nostderr(["git", "rev-parse", "--verify", "--quiet", ref], env=env)
+    except subprocess.CalledProcessError:
+        return ""
+
+def notes_push(remote: str, leases: dict[str, str], gitenv: dict) -> list[str]:
+    """
+        Push notes refs in one go, each only if the remote still has the value we lease it at.
+        Returns the refs rejected, as the remote had changed. Other failures raise.
+    """
+    cmd = ["git", "push", "--porcelain", *(f"--force-with-lease={ref}:{sha}" for ref, sha in leases.items()),
+           remote, *(f"{ref}:{ref}" for ref in leases)]
+    try:
+        exec(cmd, env=gitenv)
+        return []
+    except subprocess.CalledProcessError as e:
+        # Porcelain reports each ref as "<flag>\t<from>:<to>\t<summary>", flag '!' if rejected
+        rejected = [line.split("\t")[1].split(":")[1] for line in (e.output or "").splitlines() if line.startswith("!\t")]
+        if not rejected:
+            raise
+        return rejected
+
+def notes_fetch_merge(remote: str, refs: list[str], gitenv: dict) -> dict[str, str]:
+    """
+        Fetch notes refs and merge them into ours. Returns leases for pushing the merged notes: The values fetched,
+        empty for refs the remote no longer has.
+    """
+    fetched = {ref: f"refs/gitrb/notes-fetched/{ref[len('refs/'):]}" for ref in refs}
+    if not notes_fetch(remote, fetched, gitenv):
+        # A ref deleted meanwhile fails the whole fetch: Fetch one by one, so only the missing are expected absent
+        fetched = {ref: tmp for ref, tmp in fetched.items() if notes_fetch(remote, {ref: tmp}, gitenv)}
+    leases = {ref: "" for ref in refs}
+    for ref, tmp in fetched.items():
+        env = gitenv | {"GIT_NOTES_REF": ref}
+        leases[ref] = exec(["git", "rev-parse", tmp], env=env)
+        exec(["git", "notes", "merge", "--quiet", "--strategy", "cat_sort_uniq", tmp], env=env)
+        exec(["git", "update-ref", "-d", tmp], env=env)
+    return leases
+
+def notes_fetch(remote: str, fetched: dict[str, str], gitenv: dict) -> bool:
+    """ Fetch notes refs to their temporary refs, in fetched. False if any is missing on the remote """
+    try:
+        exec_nostderr(["git", "fetch", "--no-tags", remote, *(f"+{ref}:{tmp}" for ref, tmp in fetched.items())], env=gitenv)
+        return True
+    except subprocess.CalledProcessError:
+        return False
@@ -1,32 +1,100 @@
 import os
 import sys
+import shutil
+import hashlib
+import threading
+import tempfile
 import subprocess
 import re
+import shlex
+
+from cat_file import CatFile
+from remote_refs import RemoteRefSnapshot, ls_refs
+from rbgit_cache import RbGitCache
+from tar_import import tar_to_tree
+from tracing import tracer
+
+STREAM_CHUNK = 64 * 1024  # Bytes read at a time by `stream`
+SSH_CONTROL_PERSIST_S = 60  # Lifetime of an idle ssh ControlMaster, should we die before stopping it
+SSH_SOCKET_PATH_MAX = 103  # Longest path of a unix socket, sun_path less its NUL, on macOS. Linux allows 107
 
 class RbGit:
-    def __init__(self, printer, rbgit_dir=None, rbgit_work_tree=None):
+    def __init__(self, printer, rbgit_dir=None, rbgit_work_tree=None, cache_budget=None, ssh_multiplex=False):
         self.printer = printer
         self.rbgit_dir = rbgit_dir if rbgit_dir else os.environ["RBGIT_DIR"]
         self.rbgit_work_tree = rbgit_work_tree if rbgit_work_tree else os.environ["RBGIT_WORK_TREE"]
+        self.cat_file = None  # Started lazily, see `reader`
+        self.snapshots = {}   # Remote name -> RemoteRefSnapshot, see `remote_refs`
+        self.mirror = None    # Host-wide Mirror, see `use_mirror`
+        self.ssh_control_dir = None  # Private dir of our ssh ControlMaster sockets, see `multiplex_ssh`
+        self.ssh_env = {}            # GIT_SSH_COMMAND using them, for all git commands reaching remotes
+        self.meta_lock = threading.Lock()  # Serializes `fetch_meta_for_commits`, whose local refs pushes to several remotes share
         self.init_idempotent()
+        if ssh_multiplex:
+            self.multiplex_ssh()
+        # Kept between invocations if budgeted, see RbGitCache
+        self.cache = RbGitCache(self, cache_budget) if cache_budget is not None else None
+
+    def __enter__(self):
+        return self
 
-    def cmd(self, *args, input=None, capture_output=True):
-        # Override environment variables
-        envcopy = os.environ.copy()
-        envcopy["GIT_DIR"] = self.rbgit_dir
-        envcopy["GIT_WORK_TREE"] = self.rbgit_work_tree
+    def __exit__(self, *exc):
+        self.close()
 
-        # execute the git command with the modified environment
+    def env(self) -> dict:
+        """ Environment for git commands: Ours, but overridden to point at the bin repo and to share ssh connections """
+        return os.environ | self.ssh_env | {"GIT_DIR": self.rbgit_dir, "GIT_WORK_TREE": self.rbgit_work_tree}
+
+    def cmd(self, *args, input=None, capture_output=True, text=True, env={}):
+        # execute the git command with the modified environment, plus any extra variables
         self.printer.debug("Run:", ["rbgit", *args], file=sys.stderr)
-        result = subprocess.run(["git", *args], input=input, env=envcopy, capture_output=capture_output, text=True)
+        span = tracer.begin(["rbgit", *args])
+        result = subprocess.run(["git", *args], input=input, env=self.env() | env, capture_output=capture_output, text=text)
+        tracer.end(span, result.returncode, result.stdout, result.stderr)
 
         # If the subprocess exited with a non-zero return code, raise an error
         if result.returncode != 0:
-            raise RuntimeError(f"RbGit command failed with error: {result.stderr}")
+            stderr = result.stderr if text or result.stderr is None else result.stderr.decode(errors="replace")
+            raise RuntimeError(f"RbGit command failed with error: {stderr}")
 
         # return the result of the command
         return result.stdout
 
+    def stream(self, *args, sep: str | bytes = "\n", env={}):
+        """
+            Iterate the output of a git command record by record as it arrives, rather than capturing it whole,
+            so huge outputs take constant memory. Records are split at sep: str records for a str sep, bytes for a bytes sep.
+            Stopping early, by `close()` or abandoning the iterator, kills the command.
+            Raises RuntimeError like `cmd` if the command fails.
+        """
+        self.printer.debug("Run:", ["rbgit", *args], file=sys.stderr)
+        raw_sep = sep.encode() if isinstance(sep, str) else sep
+        decode = (lambda record: record.decode()) if isinstance(sep, str) else (lambda record: record)
+        with tempfile.TemporaryFile() as stderr:  # A file, so a chatty stderr can't block the command
+            span = tracer.begin(["rbgit", *args])
+            proc = subprocess.Popen(["git", *args], env=self.env() | env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+            finished = False
+            read = 0
+            try:
+                pending = b""
+                while chunk := proc.stdout.read1(STREAM_CHUNK):
+                    read += len(chunk)
+                    *records, pending = (pending + chunk).split(raw_sep)
+                    for record in records:
+                        yield decode(record)
+                if pending:
+                    yield decode(pending)
+                finished = True
+            finally:
+                if not finished:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+                tracer.end(span, proc.returncode, read, stderr.tell())
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(f"RbGit command failed with error: {stderr.read().decode(errors='replace')}")
+
     def init_idempotent(self):
         try:
             # Check if inside git work tree
@@ -37,9 +105,9 @@ class RbGit:
             self.cmd("config", "--local", "core.autocrlf", "false")
             self.cmd("config", "--local", "gc.auto", "0")
 
-        # Exclude .rbgit from version control
+        # Exclude .rbgit from version control, also while being deleted in the background
         with open(f"{self.rbgit_dir}/info/exclude", "w") as file:
-            file.write(".rbgit/\n")
+            file.write(".rbgit/\n.rbgit.*\n")
 
     def checkout_orphan_idempotent(self, branch_name: str):
         try:
@@ -69,6 +137,60 @@ class RbGit:
 
         return changes
 
+    def commit_path(self, branch_name: str, binpath: str, message: str, force: bool = False, env: dict = {}) -> tuple[str, bool]:
+        """
+            Commit binpath onto branch by plumbing only: HEAD, the shared index and the work tree are left alone,
+            so several commits can be made side by side.
+
+            Files are staged in a private index per artifact path. It is kept for the next commit of the same path,
+            so unchanged files need not be hashed again when the bin repo is kept.
+            Returns the commit SHA, and whether a new commit was made.
+        """
+        if not os.path.exists(binpath):
+            raise RuntimeError(f"Artifact '{binpath}' does not exist!")
+
+        indexes = f"{self.rbgit_dir}/gitrb-index"
+        os.makedirs(indexes, exist_ok=True)
+        relpath = os.path.relpath(os.path.abspath(binpath), self.rbgit_work_tree)
+        kept_index = f"{indexes}/{hashlib.sha1(relpath.encode()).hexdigest()}"
+        index = f"{kept_index}.{os.getpid()}.{threading.get_ident()}"
+        if os.path.exists(kept_index):
+            shutil.copyfile(kept_index, index)
+        try:
+            with tracer.phase("add"):
+                env = env | {"GIT_INDEX_FILE": index}
+                self.cmd("add", *(["--force"] if force else []), binpath, env=env)
+                tree = self.cmd("write-tree", env=env).strip()
+            os.replace(index, kept_index)
+        finally:
+            if os.path.exists(index):
+                os.remove(index)
+
+        return self.commit_tree_onto(branch_name, tree, message, env)
+
+    def commit_tar(self, branch_name: str, stream, prefix: str, message: str, env: dict = {}) -> tuple[str, bool]:
+        """ Like `commit_path`, but commits the contents of a tar stream, placed under prefix. Nothing is written to disk """
+        with tracer.phase("add"):
+            tree = tar_to_tree(self, stream, prefix)
+        return self.commit_tree_onto(branch_name, tree, message, env)
+
+    def commit_tree_onto(self, branch_name: str, tree: str, message: str, env: dict = {}) -> tuple[str, bool]:
+        """ Commit tree onto branch, unless branch already has that tree. Returns the commit SHA, and whether a new commit was made """
+        with tracer.phase("commit"):
+            ref = f"refs/heads/{branch_name}"
+            try:
+                parent = self.cmd("rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}").strip()
+            except RuntimeError:
+                parent = None  # New branch, so orphan commit
+            if parent and self.cmd("rev-parse", f"{parent}^{{tree}}").strip() == tree:
+                return parent, False
+
+            # Clean up message like `git commit --file` does, so commits stay reproducible
+            message = self.cmd("stripspace", input=message)
+            commit = self.cmd("commit-tree", tree, *(["-p", parent] if parent else []), "-F", "-", input=message, env=env).strip()
+            self.cmd("update-ref", ref, commit, parent or "")
+            return commit, True
+
     def add_remote_idempotent(self, name: str, url: str):
         try:
             self.cmd("remote", "add", name, url)
@@ -76,6 +198,47 @@ class RbGit:
             # If the remote already exists, set its URL
             self.cmd("remote", "set-url", name, url)
 
+    def enable_partial_clone(self, remote: str):
+        """ Allow fetching from remote without blobs, like a `--filter=blob:none` clone """
+        self.cmd("config", "--local", "core.repositoryformatversion", "1")
+        self.cmd("config", "--local", "extensions.partialClone", remote)
+        self.cmd("config", "--local", f"remote.{remote}.promisor", "true")
+        self.cmd("config", "--local", f"remote.{remote}.partialclonefilter", "blob:none")
+
+    def sparse_checkout(self, patterns: list[str] | None) -> bool:
+        """
+            Limit checkouts to paths matching gitignore-style patterns. No patterns checks out everything.
+            Returns whether an earlier sparse checkout left files out, see check_out_skipped.
+        """
+        path = f"{self.rbgit_dir}/info/sparse-checkout"
+        if patterns:
+            with open(path, "w") as file:
+                file.write("".join(f"{pattern}\n" for pattern in patterns))
+            self.cmd("config", "--local", "core.sparseCheckout", "true")
+        elif os.path.exists(path):
+            # Left by an earlier run in a bin repo we kept. Unlike `sparse-checkout disable`, this writes no files
+            # of the commit we are leaving: The checkout that follows writes those of the commit we want
+            self.cmd("config", "--local", "--unset", "core.sparseCheckout")
+            os.remove(path)
+            return True
+        return False
+
+    def check_out_skipped(self, force: bool = False):
+        """
+            Write files the index still marks as left out by sparse checkout. Checkout keeps those marks for
+            files it does not change. Without force, like checkout, fails rather than overwrite existing files
+        """
+        skipped = [line[2:] for line in self.stream("ls-files", "-t", "-z", sep="\0") if line.startswith("S ")]
+        if skipped:
+            paths = "".join(f"{path}\0" for path in skipped)
+            self.cmd("update-index", "--no-skip-worktree", "-z", "--stdin", input=paths)
+            self.cmd("checkout-index", *(["--force"] if force else []), "-z", "--stdin", input=paths)
+
+    def missing_objects(self, commit: str) -> set[str]:
+        """ Objects of commit not present locally, e.g. blobs left out by a partial fetch. Never fetches them """
+        lines = self.stream("rev-list", "--objects", "--missing=print", commit)
+        return {line[1:] for line in lines if line.startswith("?")}
+
     def fetch_only_tags(self, remote: str):
         self.cmd("fetch", remote, 'refs/tags/*:refs/tags/*')
 
@@ -84,32 +247,143 @@ class RbGit:
 
     def tree_size(self, ref: str = "HEAD") -> int:
         """ Accumulated recursively-walked size of tree. Git stores sparsely and compressed which is not accounted for here """
-        lines = self.cmd("ls-tree", "-lr", ref)
+        lines = self.stream("ls-tree", "-lr", ref)
 
-        # Parse output:
-        # - Split into lines
+        # Parse output, line by line as it arrives:
         # - Extract the 4th column (size) from each line
         # - Convert to int
         # - Sum the sizes
-        sizes = [int(re.split(r'\s+', line)[3]) for line in lines.splitlines()]
-        return sum(sizes)
+        return sum(int(re.split(r'\s+', line)[3]) for line in lines)
+
+    def use_mirror(self, mirror):
+        """ Borrow objects from a host-wide mirror, and download through it """
+        mirror.attach(self.rbgit_dir)
+        self.mirror = mirror
+
+    def ls_refs(self, remote: str, prefixes: list[str]):
+        """ List (sha, name) of remote refs under the prefixes, in a single round trip """
+        return ls_refs(self, remote, prefixes)
+
+    def remote_refs(self, remote: str, prefixes: list[str] = ()) -> RemoteRefSnapshot:
+        """
+            Snapshot of remote refs, shared by everything within this invocation.
+            Name all prefixes you will need up front, so they can be listed in one go.
+        """
+        if remote not in self.snapshots:
+            self.snapshots[remote] = RemoteRefSnapshot(self, remote)
+        snapshot = self.snapshots[remote]
+        snapshot.ensure(prefixes)
+        return snapshot
 
     def remote_already_has_ref(self, remote: str, ref_name: str):
-        """ `ls-remote` is pretty forgiving, e.g. either {master, refs/heads/master} will be found """
-        lines = self.cmd("ls-remote", remote, ref_name)
-        return (lines != "")
+        """ Pretty forgiving like `ls-remote`, e.g. either {master, refs/heads/master} will be found """
+        return self.remote_refs(remote).has(ref_name)
 
     def fetch_current_tag_value(self, remote: str, tag_name: str):
-        lines = self.cmd("ls-remote", "--tags", remote, tag_name)
-        for line in lines.splitlines():
-            cols = line.split()
-            sha = cols[0]
-            tag = cols[1].removeprefix('refs/tags/')
-            if tag == tag_name:
-                return sha
-        return None
+        return self.remote_refs(remote).get(f"refs/tags/{tag_name}")
+
+    def reader(self) -> CatFile:
+        """ Persistent object reader, started on first use and shut down by `close` """
+        if self.cat_file is None:
+            self.cat_file = CatFile(self.printer, self.env())
+        return self.cat_file
+
+    def read_object(self, obj: str) -> bytes | None:
+        return self.reader().read_object(obj)
+
+    def read_many(self, objs: list[str]) -> dict[str, bytes]:
+        return self.reader().read_many(objs)
+
+    def object_size(self, obj: str) -> int | None:
+        return self.reader().object_size(obj)
+
+    def has_object(self, obj: str) -> bool:
+        try:
+            self.cmd("cat-file", "-e", obj)
+            return True
+        except RuntimeError:
+            return False
+
+    def close(self):
+        if self.cat_file is not None:
+            self.cat_file.close()
+            self.cat_file = None
+        if self.ssh_control_dir is not None:
+            self.unmultiplex_ssh()
+
+    def multiplex_ssh(self):
+        """
+            Share one ssh connection per host between all remote operations of ours, through an OpenSSH ControlMaster
+            on a private socket, so only the first connection pays for the key exchange.
+            Set as GIT_SSH_COMMAND in `ssh_env`, which is passed to every git command which may reach a remote, until `close`.
+            Left alone if ssh is configured for git already, by GIT_SSH_COMMAND, GIT_SSH or core.sshCommand,
+            or if the temporary directory is too deep to hold a socket.
+        """
+        if os.name == "nt" or os.environ.get("GIT_SSH_COMMAND") or os.environ.get("GIT_SSH"):
+            self.printer.debug("Not multiplexing ssh: Configured by environment, or unsupported", file=sys.stderr)
+            return
+        try:
+            self.cmd("config", "--get", "core.sshCommand")
+            self.printer.debug("Not multiplexing ssh: Configured by core.sshCommand", file=sys.stderr)
+            return
+        except RuntimeError:
+            pass  # Not configured
+        control_dir = tempfile.mkdtemp(prefix="gitrb-ssh-")  # Only accessible to us
+        # %C expands to 40 hex digits, hash of host, port and user. ssh binds the socket at a 17 character longer name first
+        if len(os.path.join(control_dir, "%C")) - 2 + 40 + 17 > SSH_SOCKET_PATH_MAX:
+            self.printer.debug(f"Not multiplexing ssh: Socket path would be too long in {control_dir}", file=sys.stderr)
+            os.rmdir(control_dir)
+            return
+        self.ssh_control_dir = control_dir
+        control_path = shlex.quote(os.path.join(control_dir, "%C"))
+        self.ssh_env = {"GIT_SSH_COMMAND": f"ssh -o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={SSH_CONTROL_PERSIST_S}"}
+
+    def unmultiplex_ssh(self):
+        """ Stop the ControlMasters we started, rather than leave them idling """
+        for socket in os.listdir(self.ssh_control_dir):
+            self.printer.debug("Run:", ["ssh", "-O", "exit", socket], file=sys.stderr)
+            subprocess.run(["ssh", "-o", f"ControlPath={os.path.join(self.ssh_control_dir, socket)}", "-O", "exit", "gitrb"], capture_output=True)
+        shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+        self.ssh_control_dir = None
+        self.ssh_env = {}
+
+    def fetch_head(self) -> str | None:
+        """ SHA of the first object fetched by latest fetch, if any. Read directly, as FETCH_HEAD is just a file """
+        with open(f"{self.rbgit_dir}/FETCH_HEAD") as file:
+            line = file.readline()
+        return line.split(maxsplit=1)[0] if line.strip() else None
 
     def fetch_cat_pretty(self, remote: str, ref: str) -> str:
         self.cmd("fetch", remote, ref)
-        content = self.cmd("cat-file", "-p", "FETCH_HEAD")
-        return content
+        content = self.read_object(self.fetch_head())
+        return content.decode(errors="replace")
+
+    def fetch_meta_for_commit(self, remote: str, bin_sha_commit: str) -> str:
+        """
+            Meta-data of an artifact commit, from its meta-for-commit ref.
+            The ref is namespaced by a source SHA we don't know, so we fetch by glob. Empty if there is no such ref.
+        """
+        return self.fetch_meta_for_commits(remote, [bin_sha_commit])[bin_sha_commit]
+
+    def fetch_meta_for_commits(self, remote: str, bin_sha_commits: list[str]) -> dict[str, str]:
+        """
+            Like `fetch_meta_for_commit` for many artifact commits, in one fetch. Maps each commit to its meta-data.
+            The fetched refs are looked up rather than FETCH_HEAD, which pushes to other remotes may be rewriting.
+            Calls from several threads take turns, as they may fetch into the same refs.
+        """
+        if not bin_sha_commits:
+            return {}
+        patterns = [f"refs/artifact/meta-for-commit/*/{sha}" for sha in bin_sha_commits]
+        with self.meta_lock:
+            self.cmd("fetch", "--no-tags", remote, *(f"{pattern}:{pattern}" for pattern in patterns))
+            listed = self.cmd("for-each-ref", "--format=%(objectname) %(refname)", *patterns).splitlines()
+        meta_sha_blobs = {ref.rsplit("/", 1)[1]: blob for blob, ref in (line.split(" ", 1) for line in listed)}
+        contents = self.read_many(list(set(meta_sha_blobs.values())))
+        return {sha: contents[meta_sha_blobs[sha]].decode(errors="replace") if sha in meta_sha_blobs else "" for sha in bin_sha_commits}
+
+    def fetch_cat_pretty_many(self, remote: str, objs: list[str]) -> dict[str, str]:
+        """ Like `fetch_cat_pretty` but for many objects: One fetch negotiation and one pass of the reader, however many objects """
+        if not objs:
+            return {}
+        self.cmd("fetch", remote, *objs)
+        return {obj: content.decode(errors="replace") for obj, content in self.read_many(objs).items()}
@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import time
+
+
+class RbGitCache:
+    """
+        Keeps the local bin repo between invocations, bounded by a byte budget.
+
+        Local refs are evicted least-recently-used first, until the object store fits the budget.
+        Objects no longer reachable from any ref are then dropped by repacking.
+        Refs used within this invocation are never evicted.
+    """
+
+    STATE_FILE = "gitrb-cache.json"
+
+    def __init__(self, rbgit, budget: int):
+        self.rbgit = rbgit
+        self.budget = budget
+        self.path = os.path.join(rbgit.rbgit_dir, self.STATE_FILE)
+        self.used = self.load()  # Ref -> Unix time of last use
+        self.touched = set()
+
+        # Reflogs would keep evicted objects alive
+        rbgit.cmd("config", "--local", "core.logAllRefUpdates", "false")
+
+    def load(self) -> dict[str, float]:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.used, file)
+        os.replace(tmp, self.path)
+
+    def touch(self, *refs: str):
+        """ Record use of local refs """
+        now = time.time()
+        for ref in refs:
+            self.used[ref] = now
+            self.touched.add(ref)
+
+    def keep(self, sha: str):
+        """ Keep commit reachable by a ref of its own, so it survives in the cache """
+        ref = f"refs/gitrb/cache/{sha}"
+        self.rbgit.cmd("update-ref", ref, sha)
+        self.touch(ref)
+
+    def size(self) -> int:
+        """ Bytes used by the object store, loose and packed """
+        counts = dict(line.split(": ", 1) for line in self.rbgit.cmd("count-objects", "-v").splitlines())
+        return 1024 * sum(int(counts.get(key, 0)) for key in ("size", "size-pack", "size-garbage"))
+
+    def ref_usage(self, ref: str) -> int:
+        """ Bytes of objects only reachable from ref, thus reclaimed by deleting it """
+        return int(self.rbgit.cmd("rev-list", "--disk-usage", "--objects", ref, "--not", f"--exclude={ref}", "--all").strip() or 0)
+
+    def evict(self) -> list[str]:
+        """ Delete least-recently-used refs until within budget, then drop their objects. Returns deleted refs """
+        total = self.size()
+        refs = self.rbgit.cmd("for-each-ref", "--format=%(refname)").splitlines()
+        self.used = {ref: t for ref, t in self.used.items() if ref in refs}
+
+        evicted = []
+        for ref in sorted(refs, key=lambda ref: self.used.get(ref, 0)):
+            if total <= self.budget:
+                break
+            if ref in self.touched:
+                continue
+            total -= self.ref_usage(ref)
+            self.rbgit.cmd("update-ref", "-d", ref)
+            self.used.pop(ref, None)
+            evicted.append(ref)
+
+        if evicted:
+            self.rbgit.printer.high_level(f"Evicted {len(evicted)} refs from local bin repo cache, to stay within {self.budget} bytes.", file=sys.stderr)
+            self.rbgit.cmd("reflog", "expire", "--expire=now", "--all")
+            self.rbgit.cmd("repack", "-a", "-d", "-l", "-q")  # Local objects only, not those borrowed from a mirror
+            self.rbgit.cmd("prune", "--expire=now")
+        self.save()
+        return evicted
@@ -0,0 +1,355 @@
+import contextlib
+import os
+import re
+import sys
+import heapq
+import bisect
+import tempfile
+import subprocess
+from array import array
+
+from tracing import tracer
+
+SHA_LEN = 40  # hex digits
+SHA_BYTES = SHA_LEN // 2
+
+
+class RemoteRefSnapshot:
+    """
+        Refs of a remote, listed once per invocation and thereafter answered locally.
+
+        Only the ref prefixes asked for are listed, and only once: Queries outside what has been
+        listed so far extend the snapshot with another listing of just the missing prefixes.
+        Our own pushes update the snapshot locally, so it stays truthful without listing again.
+
+        Refs are kept compact for million-ref remotes: Names sorted in one bytes buffer with an offset
+        index and SHAs as 20-byte binary, so prefix queries are a bisection rather than a linear scan.
+
+        Annotated tags also have the commit they point to, as a ref named with a `^{}` suffix like `ls-remote` shows it.
+    """
+
+    def __init__(self, rbgit, remote: str):
+        self.rbgit = rbgit
+        self.remote = remote
+        self.prefixes = []  # Ref prefixes listed so far
+        self.exact = set()  # Refs not listed, but known from our own updates
+        self._pack([])
+
+    def _pack(self, refs):
+        """
+            Replace contents by refs, an iterable of unique (name, binary sha). Refs are packed as they stream in:
+            Listings arrive sorted by name, else only an index is sorted afterwards, and the refs packed again in order.
+        """
+        names = bytearray()
+        offsets = array('Q', [0])
+        shas = bytearray()
+        ordered = True
+        last = None
+        for name, sha in refs:
+            if last is not None and name <= last:
+                if name == last:
+                    raise ValueError(f"Refs not unique at {name}")
+                ordered = False
+            names += name
+            offsets.append(len(names))
+            shas += sha
+            last = name
+        self.names = _Names(names, offsets)
+        self.shas = bytes(shas)
+        if not ordered:
+            order = sorted(range(len(self.names)), key=self.names.__getitem__)
+            self._pack([(self.names[i], self.shas[i*SHA_BYTES:(i+1)*SHA_BYTES]) for i in order])
+
+    def _refs(self):
+        """ Iterate all (name, binary sha), sorted by name """
+        for i in range(len(self.names)):
+            yield self.names[i], self.shas[i*SHA_BYTES:(i+1)*SHA_BYTES]
+
+    def __len__(self):
+        return len(self.names)
+
+    def covers(self, prefix: str) -> bool:
+        return prefix in self.exact or any(prefix.startswith(p) for p in self.prefixes)
+
+    def ensure(self, prefixes: list[str]):
+        """ List the prefixes not yet covered, in a single listing """
+        missing = minimal_prefixes(p for p in prefixes if not self.covers(p))
+        if not missing:
+            return
+
+        listed = ((name.encode(), bytes.fromhex(sha)) for sha, name in self.rbgit.ls_refs(self.remote, missing))
+        if not len(self):
+            self._pack(listed)  # First listing, packed as it streams in
+        else:
+            relisted = tuple(p.encode() for p in missing)
+            keep = (ref for ref in self._refs() if not ref[0].startswith(relisted))
+            self._pack(heapq.merge(keep, sorted(listed)))
+        self.prefixes = minimal_prefixes(self.prefixes + missing)
+
+    def get(self, ref: str) -> str | None:
+        """ SHA of fully qualified ref, or None if the remote does not have it """
+        self.ensure([ref])
+        key = ref.encode()
+        i = bisect.bisect_left(self.names, key)
+        if i < len(self.names) and self.names[i] == key:
+            return self.shas[i*SHA_BYTES:(i+1)*SHA_BYTES].hex()
+        return None
+
+    def has(self, ref: str) -> bool:
+        """ Like `ls-remote`, forgiving about qualification, e.g. either {master, refs/heads/master} will be found """
+        candidates = [ref] if ref.startswith("refs/") else [f"refs/heads/{ref}", f"refs/tags/{ref}"]
+        self.ensure(candidates)
+        return any(self.get(candidate) is not None for candidate in candidates)
+
+    def items(self, prefix: str):
+        """ Iterate (name, sha) of refs starting with prefix, sorted by name """
+        for name, sha in self.binary_items(prefix):
+            yield name.decode(), sha.hex()
+
+    def binary_items(self, prefix: str):
+        """ Iterate (name, sha) of refs starting with prefix, sorted by name, both as bytes as stored: SHAs are 20 bytes """
+        self.ensure([prefix])
+        key = prefix.encode()
+        i = bisect.bisect_left(self.names, key)
+        n = len(self.names)
+        while i < n:
+            name = self.names[i]
+            if not name.startswith(key):
+                break
+            yield name, self.shas[i*SHA_BYTES:(i+1)*SHA_BYTES]
+            i += 1
+
+    def set(self, ref: str, sha: str):
+        """ Record that we have updated ref on the remote """
+        self.set_many({ref: sha})
+
+    def set_many(self, updates: dict[str, str]):
+        """ Record that we have updated refs on the remote. We push no annotated tags, so they have no peeled values anymore """
+        gone = {ref.encode() for ref in updates} | {f"{ref}^{{}}".encode() for ref in updates}
+        kept = (ref for ref in self._refs() if ref[0] not in gone)
+        self._pack(heapq.merge(kept, sorted((ref.encode(), bytes.fromhex(sha)) for ref, sha in updates.items())))
+        self.exact.update(ref for ref in updates if not self.covers(ref))
+
+    def remove_many(self, refs: list[str]):
+        """ Record that we have deleted refs on the remote """
+        gone = {ref.encode() for ref in refs} | {f"{ref}^{{}}".encode() for ref in refs}
+        self._pack(ref for ref in self._refs() if ref[0] not in gone)
+        self.exact.update(ref for ref in refs if not self.covers(ref))
+
+
+class _Names:
+    """ Read-only sequence of sorted names, packed into one buffer. Supports `bisect` """
+
+    def __init__(self, buf: bytearray, offsets: array):
+        self.buf = memoryview(buf)  # The buffer as built, not copied into bytes: Halves peak memory of packing
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self.buf[self.offsets[i]:self.offsets[i+1]])
+
+
+def minimal_prefixes(prefixes) -> list[str]:
+    """ Sorted unique prefixes, without those already covered by a shorter prefix """
+    ret = []
+    for prefix in sorted(set(prefixes)):
+        if not ret or not prefix.startswith(ret[-1]):
+            ret.append(prefix)
+    return ret
+
+
+def ls_refs(rbgit, remote: str, prefixes: list[str]):
+    """
+        List (sha, name) of remote refs starting with any of the prefixes.
+
+        Speaks protocol v2 `ls-refs` directly, so the server only sends refs under the requested prefixes.
+        Plain `ls-remote` can not do this, it only forwards ref-prefix for --heads and --tags.
+        Servers not speaking v2 advertise all their refs instead, which we filter on our side.
+        Remotes we can't reach directly (e.g. http) fall back to `ls-remote`, filtered on our side.
+    """
+    url = remote_url(rbgit, remote)
+    argv = upload_pack_argv(rbgit, url)
+    if argv is None:
+        return ls_refs_fallback(rbgit, remote, prefixes)
+    return ls_refs_v2(rbgit, argv, prefixes)
+
+
+def remote_url(rbgit, remote: str) -> str:
+    try:
+        return rbgit.cmd("remote", "get-url", remote).strip()
+    except RuntimeError:
+        return remote  # Not a configured remote name, so already a URL
+
+
+def upload_pack_argv(rbgit, url: str) -> list[str] | None:
+    """ Command which connects us to the remote's upload-pack, or None if we don't know how """
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    if os.path.isdir(url):
+        return ["git", "upload-pack", url]
+
+    # ssh://[user@]host[:port]/path or scp-like [user@]host:path
+    match = re.match(r"^ssh://(?P<host>[^/:]+)(?::(?P<port>\d+))?(?P<path>/.*)$", url) \
+        or re.match(r"^(?P<host>[^/:]+):(?P<path>(?!//).+)$", url)
+    if not match:
+        return None
+    path = match.group('path')
+    if url.startswith("ssh://") and path.startswith("/~"):
+        path = path[1:]  # Home-relative, like git does
+    port = match.groupdict().get('port')
+
+    ssh = ssh_command(rbgit)
+    program = ssh[3] if ssh[0] == "sh" else ssh[0]
+    if not os.path.basename(program).startswith("ssh"):
+        return None  # Not OpenSSH, so we can't ask for protocol v2 the same way git does
+    quoted_path = "'" + path.replace("'", "'\\''") + "'"
+    return [*ssh, "-o", "SendEnv=GIT_PROTOCOL", *(["-p", port] if port else []), match.group('host'), f"git-upload-pack {quoted_path}"]
+
+
+def ssh_command(rbgit) -> list[str]:
+    """ The ssh program git itself would use. Commands are run by shell, with the program name as $0 """
+    env = os.environ | rbgit.ssh_env
+    if env.get("GIT_SSH_COMMAND"):
+        return ["sh", "-c", f'{env["GIT_SSH_COMMAND"]} "$@"', env["GIT_SSH_COMMAND"].split()[0]]
+    if env.get("GIT_SSH"):
+        return [env["GIT_SSH"]]
+    try:
+        configured = rbgit.cmd("config", "--get", "core.sshCommand").strip()
+    except RuntimeError:
+        configured = ""
+    if configured:
+        return ["sh", "-c", f'{configured} "$@"', configured.split()[0]]
+    return ["ssh"]
+
+
+def pkt_line(data: str) -> bytes:
+    payload = data.encode()
+    return f"{len(payload) + 4:04x}".encode() + payload
+
+
+def pkt_read(stream) -> bytes | None:
+    """ Payload of next pkt-line. None for flush/delim/response-end """
+    header = stream.read(4)
+    if len(header) != 4:
+        raise RuntimeError("Remote hung up unexpectedly")
+    length = int(header, 16)
+    if length < 4:
+        return None
+    return stream.read(length - 4)
+
+
+def ls_refs_v2(rbgit, argv: list[str], prefixes: list[str]):
+    """
+        List refs by protocol v2 `ls-refs`. Returns an iterator of (sha, name) yielding refs as the server
+        streams them, so a huge listing is never held as text. Servers not speaking v2 stream their v0 advertisement.
+    """
+    rbgit.printer.debug("Run:", argv, file=sys.stderr)
+    span = tracer.begin(argv, name="ls-refs", prefixes=prefixes)
+    # Stderr to file, as nobody reads it while refs stream, and a pipe would fill and stall the server
+    stderr_file = tempfile.TemporaryFile()
+    proc = subprocess.Popen(argv, env=os.environ | rbgit.ssh_env | {"GIT_PROTOCOL": "version=2"},
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+    proc.span = span  # Ended with the process, see ls_refs_close
+    proc.stderr_file = stderr_file
+    try:
+        # Capability advertisement
+        line = pkt_read(proc.stdout)
+        if line == b"version 1\n":
+            line = pkt_read(proc.stdout)
+        if line != b"version 2\n":
+            return ls_refs_v0_response(proc, line, prefixes)
+        while pkt_read(proc.stdout) is not None:
+            pass
+
+        request = pkt_line("command=ls-refs\n") + b"0001" + pkt_line("peel\n")
+        request += b"".join(pkt_line(f"ref-prefix {prefix}\n") for prefix in prefixes)
+        proc.stdin.write(request + b"0000")
+        proc.stdin.flush()
+    except RuntimeError:
+        ls_refs_abort(proc)
+        raise
+    return ls_refs_v2_response(proc, prefixes)
+
+
+def ls_refs_v2_response(proc, prefixes: list[str]):
+    """ Iterate (sha, name) of refs in the `ls-refs` response, and (commit sha, name^{}) of annotated tags """
+    prefixes = tuple(prefixes)
+    try:
+        while (line := pkt_read(proc.stdout)) is not None:
+            if line.startswith(b"ERR "):
+                raise RuntimeError(f"RbGit ls-refs failed with error: {line[4:].decode(errors='replace')}")
+            sha, name, *attributes = line.decode().rstrip("\n").split(" ")
+            # The server matches prefixes loosely, e.g. it may ignore them altogether
+            if name.startswith(prefixes):
+                yield sha, name
+                for attribute in attributes:
+                    if attribute.startswith("peeled:"):
+                        yield attribute[len("peeled:"):], f"{name}^{{}}"
+    except RuntimeError:
+        ls_refs_abort(proc)
+        raise
+    finally:
+        ls_refs_close(proc)
+
+
+def ls_refs_v0_response(proc, line: bytes | None, prefixes: list[str]):
+    """
+        Iterate (sha, name) of refs in a v0 advertisement starting with line, which has the capabilities.
+        Annotated tags are followed by their commit as name^{}. The server then waits for our wants: We want none.
+    """
+    prefixes = tuple(prefixes)
+    try:
+        if line is not None:
+            line = line.split(b"\0")[0]
+        while line is not None:
+            if line.startswith(b"ERR "):
+                raise RuntimeError(f"RbGit ls-refs failed with error: {line[4:].decode(errors='replace')}")
+            sha, name = line.decode().rstrip("\n").split(" ", 1)
+            if name.startswith(prefixes):
+                yield sha, name
+            line = pkt_read(proc.stdout)
+        with contextlib.suppress(BrokenPipeError):  # Server already gone: It wanted nothing from us either
+            proc.stdin.write(b"0000")
+            proc.stdin.flush()
+    except RuntimeError:
+        ls_refs_abort(proc)
+        raise
+    finally:
+        ls_refs_close(proc)
+
+
+def ls_refs_abort(proc):
+    """ Kill upload-pack, raising its own error message if it left one """
+    proc.kill()
+    proc.wait()
+    proc.stderr_file.seek(0)
+    stderr = proc.stderr_file.read().decode(errors="replace")
+    proc.stdout.close()
+    proc.stderr_file.close()
+    tracer.end(proc.span, proc.returncode, None, stderr)
+    if stderr:
+        raise RuntimeError(f"RbGit ls-refs failed with error: {stderr}")
+
+
+def ls_refs_close(proc):
+    """ End upload-pack. Closing stdout too ends a server still writing, e.g. when the listing was abandoned """
+    if proc.poll() is None:
+        proc.stdin.close()
+        proc.stdout.close()
+        proc.wait()
+    tracer.end(proc.span, proc.returncode)
+    proc.stdout.close()
+    proc.stderr_file.close()
+
+
+def ls_refs_fallback(rbgit, remote: str, prefixes: list[str]):
+    """ List refs by `ls-remote`, narrowed server-side to --heads/--tags where possible. Annotated tags come peeled too """
+    flags = []
+    if all(p.startswith("refs/heads/") for p in prefixes):
+        flags = ["--heads"]
+    elif all(p.startswith("refs/tags/") for p in prefixes):
+        flags = ["--tags"]
+    refs = (line.split() for line in rbgit.stream("ls-remote", *flags, remote))
+    return ((sha, name) for sha, name in refs if name.startswith(tuple(prefixes)))
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from printer import printer
+from tracing import tracer
+from util import exec
+from util_date import DATE_FMT_GIT
+
+
+class SourceSnapshot:
+    """
+        Metadata of the source repo, as needed for an artifact's commit message, in as few git calls as possible.
+        The commit's SHA, message and times come from one `git log -1`; branch, upstream and ahead/behind from one
+        `git for-each-ref`. The remaining independent queries run concurrently, so the slowest call bounds the time.
+
+        Opt-in fast modes, for big repos:
+            fsmonitor:    Let `git status` ask the file system monitor what changed, rather than stat every file.
+            commit_graph: Write the commit-graph if missing, so ahead/behind walks stop early by generation numbers.
+    """
+
+    def __init__(self, remote_name: str, fsmonitor: bool = False, commit_graph: bool = False):
+        self.remote_name = remote_name
+        self.fsmonitor = fsmonitor
+        self.commit_graph = commit_graph
+        start = time.monotonic()
+        self.fields = self.collect()
+        self.elapsed = time.monotonic() - start  # Seconds
+
+    def collect(self) -> dict[str, str]:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            commit = pool.submit(tracer.inherit(self.head_commit))
+            branch = pool.submit(tracer.inherit(self.branch))
+            url = pool.submit(tracer.inherit(exec), ["git", "config", "--get", f"remote.{self.remote_name}.url"])
+            status = pool.submit(tracer.inherit(self.status))
+
+            d = {}
+            d['src_remote_name'] = self.remote_name
+            d.update(commit.result())
+            d.update(branch.result())
+            d['src_repo_url']    = url.result()
+            d['src_repo']        = os.path.basename(d['src_repo_url'])
+            d['src_status']      = status.result()
+        return d
+
+    def head_commit(self) -> dict[str, str]:
+        """ Sample HEAD once: SHA, times and message all describe the same commit """
+        out = exec(["git", "log", "-1", "--no-show-signature", f"--date=format:{DATE_FMT_GIT}", "--format=%H%x00%ad%x00%cd%x00%B", "HEAD"])
+        sha, time_author, time_commit, msg = out.split("\0", 3)
+        d = {}
+        d['src_sha']          = sha
+        d['src_sha_short']    = sha[:10]
+        d['src_sha_msg']      = msg.strip()
+        d['src_sha_title']    = d['src_sha_msg'].split('\n')[0]  # title is first line of commit-msg
+        # Author time is when the commit was first committed.
+        # Author time is easily set with `git commit --date`.
+        d['src_time_author']  = time_author
+        # Committer time changes every time the commit-SHA changes, for example {rebasing, amending, ...}.
+        # Committer time can be set with $GIT_COMMITTER_DATE or `git rebase --committer-date-is-author-date`.
+        # Committer time is monotonically increasing but sampled locally, so graph could still be non-monotonic if a collaborator has a very wrong clock.
+        d['src_time_commit']  = time_commit
+        return d
+
+    def branch(self) -> dict[str, str]:
+        branch, tree_root = exec(["git", "rev-parse", "--abbrev-ref", "HEAD", "--show-toplevel"]).split("\n")
+        d = {'src_branch': branch, 'src_tree_root': tree_root}
+        if branch == "HEAD":
+            # We are in detached HEAD and thus can't determine the upstream tracking branch
+            return d | {'src_branch_upstream': "", 'src_commits_ahead': "", 'src_commits_behind': ""}
+
+        if self.commit_graph:
+            self.write_commit_graph()
+        out = exec(["git", "for-each-ref", "--format=%(upstream:short)%00%(upstream:track,nobracket)", f"refs/heads/{branch}"])
+        upstream, track = out.split("\0") if out else ("", "")
+        d['src_branch_upstream'] = upstream
+        d['src_commits_ahead'], d['src_commits_behind'] = parse_track(track) if upstream else ("", "")
+        return d
+
+    def status(self) -> str:
+        config = ["-c", "core.fsmonitor=true"] if self.fsmonitor else []
+        return exec(["git", *config, "status", "--porcelain=1", "--untracked-files=no"])
+
+    def write_commit_graph(self):
+        graph = exec(["git", "rev-parse", "--git-path", "objects/info/commit-graph"])
+        if not os.path.exists(graph) and not os.path.isdir(f"{graph}s"):
+            printer.high_level("Writing commit-graph of source repo", file=sys.stderr)
+            exec(["git", "commit-graph", "write", "--reachable", "--no-progress"])
+
+
+def parse_track(track: str) -> tuple[str, str]:
+    """
+        Commits (ahead, behind) from for-each-ref's `%(upstream:track,nobracket)`, e.g. "ahead 2, behind 1".
+        Empty means in sync. A gone upstream has no counts.
+    """
+    if track == "gone":
+        return "", ""
+    counts = {"ahead": "0", "behind": "0"}
+    for part in filter(None, track.split(", ")):
+        what, count = part.split(" ")
+        counts[what] = count
+    return counts["ahead"], counts["behind"]
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import stat
+import time
+import hashlib
+
+
+class StatCache:
+    """
+        Files written by checking out an artifact, with their blob SHAs and stat data at the time.
+        Kept next to .rbgit, so it survives the bin repo being deleted between runs.
+
+        Tells whether the work tree still holds an artifact, without hashing files: Only files whose
+        stat data changed since we wrote them are hashed again -- much like git's own index.
+    """
+
+    KEEP_COMMITS = 8  # Most recently checked out artifacts to remember
+    RACY_NS = 2 * 10**9  # Coarsest file time granularity we expect, e.g. FAT
+
+    def __init__(self, path: str, work_tree: str):
+        self.path = path
+        self.work_tree = work_tree
+        self.commits = self.load()  # Commit SHA -> {"written_ns": int, "files": {path: [mode, blob, mtime_ns, size, ino]}}
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(self.commits, file)
+        os.replace(tmp, self.path)
+
+    def lstat(self, path: str):
+        try:
+            return os.lstat(os.path.join(self.work_tree, path))
+        except OSError:
+            return None
+
+    def record(self, commit: str, entries: list[tuple[str, str, str]]):
+        """ Remember that commit's entries, as (mode, blob, path), were just written to the work tree """
+        files = {}
+        for mode, blob, path in entries:
+            st = self.lstat(path)
+            if st is not None:
+                files[path] = [mode, blob, st.st_mtime_ns, st.st_size, st.st_ino]
+        self.commits.pop(commit, None)
+        self.commits[commit] = {"written_ns": time.time_ns(), "files": files}
+        for old in list(self.commits)[:-self.KEEP_COMMITS]:
+            del self.commits[old]
+        self.save()
+
+    @staticmethod
+    def key(commit: str, only: list[str] | None = None) -> str:
+        """ Commits are remembered per set of sparse checkout patterns, as each writes different files """
+        return "\0".join([commit, *(only or [])])
+
+    def known(self, commit: str) -> bool:
+        return commit in self.commits
+
+    def latest(self) -> str | None:
+        """ Commit most recently written to the work tree """
+        return next(reversed(self.commits), None)
+
+    def files(self, commit: str) -> dict[str, tuple[str, str]]:
+        """ Path -> (mode, blob) of files written for commit """
+        return {path: (mode, blob) for path, (mode, blob, *_) in self.commits[commit]["files"].items()}
+
+    def matches(self, rbgit, commit: str) -> bool:
+        """ Whether the work tree holds all files of commit, as last checked out """
+        entry = self.commits.get(commit)
+        if entry is None:
+            return False
+
+        now = time.time_ns()
+        rehash = []
+        for path, (mode, blob, mtime_ns, size, ino) in entry["files"].items():
+            st = self.lstat(path)
+            if st is None or stat_mode(st) != mode:
+                return False
+            # Files modified within a clock tick of recording them can't be trusted by stat alone
+            if (st.st_mtime_ns, st.st_size, st.st_ino) != (mtime_ns, size, ino) or st.st_mtime_ns >= entry["written_ns"] - self.RACY_NS:
+                rehash.append(path)
+
+        if rehash:
+            rbgit.printer.debug(f"Stat cache: Hashing {len(rehash)} changed files", file=sys.stderr)
+            blobs = self.hash_files(rbgit, rehash, entry["files"])
+            if any(blobs[path] != entry["files"][path][1] for path in rehash):
+                return False
+            # Same content: Remember new stat data, so we don't hash them next time
+            for path in rehash:
+                st = self.lstat(path)
+                entry["files"][path][2:] = [st.st_mtime_ns, st.st_size, st.st_ino]
+            entry["written_ns"] = now
+            self.save()
+        return True
+
+    def adopt(self, rbgit, commit: str, entries: list[tuple[str, str, str]]) -> bool:
+        """ Whether the work tree holds commit's entries, hashing every file. If so, remember them as if we wrote them """
+        files = {}
+        for mode, blob, path in entries:
+            st = self.lstat(path)
+            if st is None or stat_mode(st) != mode:
+                return False
+            files[path] = [mode, blob]
+        blobs = self.hash_files(rbgit, list(files), files)
+        if any(blobs[path] != files[path][1] for path in files):
+            return False
+        self.record(commit, entries)
+        return True
+
+    def hash_files(self, rbgit, paths: list[str], files: dict) -> dict[str, str]:
+        """ Blob SHAs of files as they are now. Regular files by git, honoring attributes; symlinks by their target """
+        blobs = {}
+        regular = [path for path in paths if files[path][0] != "120000"]
+        if regular:
+            out = rbgit.cmd("hash-object", "--stdin-paths",
+                            input="".join(f"{os.path.join(self.work_tree, path)}\n" for path in regular))
+            blobs.update(zip(regular, out.split()))
+        for path in paths:
+            if files[path][0] == "120000":
+                target = os.fsencode(os.readlink(os.path.join(self.work_tree, path)))
+                blobs[path] = hashlib.sha1(b"blob %d\0" % len(target) + target).hexdigest()
+        return blobs
+
+
+def stat_mode(st) -> str:
+    """ Git's mode for a file, from its stat data """
+    if stat.S_ISLNK(st.st_mode):
+        return "120000"
+    return "100755" if st.st_mode & stat.S_IXUSR else "100644"
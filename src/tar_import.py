@@ -0,0 +1,97 @@
+import os
+import sys
+import tarfile
+import posixpath
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+from tracing import tracer
+
+CHUNK = 1024 * 1024  # Bytes copied at a time: Memory use is constant, however big the artifact
+
+
+@contextmanager
+def open_tar(path: str):
+    """ Binary stream of tarball at path, or of stdin if path is '-' """
+    if path == "-":
+        yield sys.stdin.buffer
+    else:
+        with open(path, "rb") as stream:
+            yield stream
+
+
+def quote_path(path: str) -> str:
+    """ C-style quoted path, as fast-import accepts any path that way """
+    return '"' + path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+def member_path(member: tarfile.TarInfo, prefix: str) -> str:
+    path = posixpath.normpath(member.name)
+    if path.startswith("/") or path == ".." or path.startswith("../"):
+        raise RuntimeError(f"Tar member '{member.name}' is outside of the artifact")
+    return path if prefix in ("", ".") else posixpath.join(prefix, path)
+
+
+def tar_to_tree(rbgit, stream, prefix: str) -> str:
+    """
+        Tree SHA of tar stream's contents, placed under prefix. The tar is read once, sequentially, and each
+        file's data is streamed straight into `git fast-import`: Nothing is extracted, nothing is buffered whole.
+    """
+    ref = f"refs/gitrb/import/{os.getpid()}"
+    rbgit.printer.debug("Run:", ["rbgit", "fast-import"], file=sys.stderr)
+    span = tracer.begin(["rbgit", "fast-import"])
+    # Stderr to file, as it is read only once fast-import is done, and a full pipe would stall it before
+    stderr_file = tempfile.TemporaryFile()
+    proc = subprocess.Popen(["git", "fast-import", "--quiet", "--done"], env=rbgit.env(),
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file)
+    try:
+        files = {}  # Path -> (mode, mark)
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for mark, member in enumerate(tar, start=1):
+                if member.isdir():
+                    continue  # Git tracks no directories
+                path = member_path(member, prefix)
+                if member.islnk():
+                    # Hard link: Same content as the member it links to, which came earlier in the stream
+                    target = member_path(tarfile.TarInfo(member.linkname), prefix)
+                    if target not in files:
+                        raise RuntimeError(f"Tar member '{member.name}' links to '{member.linkname}', which is no file earlier in the archive")
+                    files[path] = files[target]
+                elif member.issym():
+                    target = os.fsencode(member.linkname)
+                    proc.stdin.write(b"blob\nmark :%d\ndata %d\n%s\n" % (mark, len(target), target))
+                    files[path] = ("120000", mark)
+                elif member.isfile():
+                    proc.stdin.write(b"blob\nmark :%d\ndata %d\n" % (mark, member.size))
+                    data = tar.extractfile(member)
+                    while chunk := data.read(CHUNK):
+                        proc.stdin.write(chunk)
+                    proc.stdin.write(b"\n")
+                    files[path] = ("100755" if member.mode & 0o100 else "100644", mark)
+                else:
+                    rbgit.printer.debug(f"Skipping tar member '{member.name}', not a file", file=sys.stderr)
+
+        # A throw-away commit, just to have fast-import write the tree
+        proc.stdin.write(f"commit {ref}\ncommitter gitrb <gitrb> 0 +0000\ndata 0\n".encode())
+        for path, (mode, mark) in files.items():
+            proc.stdin.write(f"M {mode} :{mark} {quote_path(path)}\n".encode())
+        proc.stdin.write(b"\ndone\n")
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # fast-import failed, reported below
+    except BaseException:
+        proc.kill()  # Bad tar: Don't leave fast-import waiting for more input
+        raise
+    finally:
+        proc.wait()
+    with stderr_file:
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+    tracer.end(span, proc.returncode, None, stderr)
+    if proc.returncode != 0:
+        raise RuntimeError(f"RbGit fast-import failed with error: {stderr}")
+
+    tree = rbgit.cmd("rev-parse", f"{ref}^{{tree}}").strip()
+    rbgit.cmd("update-ref", "-d", ref)
+    return tree
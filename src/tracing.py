@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Tracer:
+    """
+        Timings of the git commands we run, as spans grouped into phases of our own work, e.g. snapshot, add, push-branch.
+        Written as Chrome trace events, see `write`. Disabled, as by default, recording costs next to nothing.
+
+        Each span records its argv, exit code and stdout/stderr byte counts, where captured.
+        Phases nest, per thread; spans belong to the innermost phase open in their thread at their start.
+        Work handed to another thread runs within the phases open where it was handed over, see `inherit`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.local = threading.local()  # Open phases of each thread, see `phases`
+        self.threads = {}    # Thread ident -> small tid, for a readable trace
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def now(self) -> float:
+        """ Microseconds since start """
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        phases = self.phases()
+        phases.append(name)
+        start = self.now()
+        try:
+            yield
+        finally:
+            phases.pop()
+            self.record(name, "phase", start, {})
+
+    def phases(self) -> list[str]:
+        """ Phases open in the calling thread, innermost last """
+        if not hasattr(self.local, "phases"):
+            self.local.phases = []
+        return self.local.phases
+
+    def inherit(self, fn):
+        """ fn, to run in another thread within the phases open here. E.g. for submitting to a thread pool """
+        if not self.enabled:
+            return fn
+        phases = list(self.phases())
+
+        def run(*args, **kwargs):
+            outer = self.phases()
+            self.local.phases = list(phases)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.phases = outer
+        return run
+
+    def begin(self, argv: list[str], name: str | None = None, **args) -> dict | None:
+        """ Start a span of running argv, named by its subcommand unless named. Pass it to `end` when the command has finished """
+        if not self.enabled:
+            return None
+        return {"name": name or span_name(argv), "argv": [str(arg) for arg in argv], **args,
+                "phase": (self.phases() or [None])[-1], "start": self.now()}
+
+    def end(self, span: dict | None, exit_code: int | None, stdout=None, stderr=None):
+        """ Record span. Output is str, bytes, or its byte count; None if not captured. Ending a span twice records it once """
+        if span is None or "start" not in span:
+            return
+        start = span.pop("start")
+        span |= {"exit_code": exit_code, "stdout_bytes": byte_count(stdout), "stderr_bytes": byte_count(stderr)}
+        self.record(span.pop("name"), "git", start, span)
+
+    def record(self, name: str, category: str, start: float, args: dict):
+        end = self.now()
+        with self.lock:
+            tid = self.threads.setdefault(threading.get_ident(), len(self.threads) + 1)
+            self.events.append({"name": name, "cat": category, "ph": "X", "ts": round(start, 1), "dur": round(end - start, 1),
+                                "pid": os.getpid(), "tid": tid, "args": args})
+
+    def write(self, path: str):
+        """ Chrome trace JSON, to open in https://ui.perfetto.dev or chrome://tracing """
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, indent=1)
+
+    def summary(self) -> str:
+        """ Time spent in git per phase, most first """
+        totals = {}
+        for event in self.events:
+            if event["cat"] == "git":
+                count, dur = totals.get(event["args"]["phase"], (0, 0.0))
+                totals[event["args"]["phase"]] = (count + 1, dur + event["dur"])
+        lines = [f"  {phase or '-'}: {count} git commands, {dur / 1e6:.3f}s" for phase, (count, dur) in sorted(totals.items(), key=lambda t: -t[1][1])]
+        return "\n".join(lines)
+
+
+def span_name(argv: list[str]) -> str:
+    """ Program and subcommand, e.g. "rbgit push" for ["rbgit", "-c", "x=y", "push", "origin"] """
+    words = iter(argv[1:])
+    for word in words:
+        if word in ("-c", "-C"):
+            next(words, None)
+        elif not word.startswith("-"):
+            return f"{os.path.basename(argv[0])} {word}"
+    return os.path.basename(argv[0])
+
+
+def byte_count(output) -> int | None:
+    if output is None or isinstance(output, int):
+        return output
+    return len(output.encode()) if isinstance(output, str) else len(output)
+
+
+tracer = Tracer()
@@ -2,11 +2,22 @@ import sys
 import os
 import subprocess
 from printer import printer
+from tracing import tracer
 
 def exec(command, env={}):
     printer.debug("Run:", command, file=sys.stderr)
-    return subprocess.check_output(command, env=os.environ|env, text=True).strip()
+    return check_output(command, env)
 
 def exec_nostderr(command, env={}):
     printer.debug("Run:", command, file=sys.stderr)
-    return subprocess.check_output(command, env=os.environ|env, text=True, stderr=subprocess.DEVNULL).strip()
+    return check_output(command, env, stderr=subprocess.DEVNULL)
+
+def check_output(command, env, **kwargs):
+    span = tracer.begin(command)
+    try:
+        out = subprocess.check_output(command, env=os.environ|env, text=True, **kwargs)
+    except subprocess.CalledProcessError as e:
+        tracer.end(span, e.returncode, e.output)
+        raise
+    tracer.end(span, 0, out)
+    return out.strip()
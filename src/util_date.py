@@ -2,8 +2,7 @@ import re
 import datetime
 import dateutil.relativedelta
 from dateutil.tz import tzlocal
-import maya
-import dateparser
+# maya and dateparser take ~0.3s to import, so they are imported only when a date is too fuzzy for `parse_simple_time`
 
 # Don't change the date formats! This will break parsing
 DATE_FMT_GIT = "%a, %d %b %Y %H:%M:%S %z"  # E.g. "Thu, 27 Jul 2023 13:15:26 +0200". Git commit times, human readable
@@ -11,15 +10,58 @@ DATE_FMT_EXPIRE_YMD = "%Y-%m-%d"  # E.g. "2023-07-27". Machine sortable. Used in
 DATE_FMT_EXPIRE_HMz = "%H.%M%z"   # E.g. "13.14+0200". Machine sortable
 DATE_FMT_EXPIRE = f"{DATE_FMT_EXPIRE_YMD}/{DATE_FMT_EXPIRE_HMz}"  # E.g. "2023-07-27/13.14+0200". Used in branch-names, machine sortable
 
+RE_RELATIVE = re.compile(r"(?:(?:now )?(?P<future>in) )?(?P<count>\d+) (?P<unit>second|minute|hour|day|week|month|year)s?(?P<past> ago)?")
+
+def parse_simple_time(time_str: str) -> datetime.datetime | None:
+    """
+        Parse the common forms, e.g. "in 30 days" or an ISO date, without the fuzzy date libraries.
+        Relative times mean the same as to dateparser: Future with "in", else past. None if not a common form.
+    """
+    time_str = time_str.strip().lower()
+    match = RE_RELATIVE.fullmatch(time_str)
+    if match:
+        if match.group('future') and match.group('past'):
+            return None
+        count = int(match.group('count')) * (1 if match.group('future') else -1)
+        delta = dateutil.relativedelta.relativedelta(**{f"{match.group('unit')}s": count})
+        # Calendar arithmetic on local wall-clock time, as dateparser does
+        return (datetime.datetime.now() + delta).astimezone()
+
+    try:
+        dt = datetime.datetime.fromisoformat(time_str.upper())
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.astimezone()
+
 def parse_fuzzy_time(fuzzy_time: str) -> datetime:
     """Parse fuzzy time expressions and return a timezone aware ``datetime``."""
 
+    dt = parse_simple_time(fuzzy_time)
+    if dt is not None:
+        return dt
+
+    import dateparser
     dt = dateparser.parse(fuzzy_time, settings={"RETURN_AS_TIMEZONE_AWARE": True})
     if dt is None:
         # Fallback to maya for expressions dateparser does not understand
+        import maya
         dt = maya.when(fuzzy_time).datetime()
     return dt
 
+def date_prefixes_until(day: datetime.date) -> list[str]:
+    """
+        Fewest string prefixes which together match every `DATE_FMT_EXPIRE_YMD` date at or before day.
+        Dates sort as strings, so at each digit, all smaller digits form a prefix, e.g. for 2024-03-15:
+        ["0", "1", "200", "201", "2020", ..., "2023", "2024-00", "2024-01", "2024-02", "2024-03-0", "2024-03-10", ..., "2024-03-15"]
+    """
+    last = day.strftime(DATE_FMT_EXPIRE_YMD)
+    prefixes = []
+    for i, char in enumerate(last):
+        if char.isdigit():
+            prefixes.extend(f"{last[:i]}{digit}" for digit in "0123456789" if digit < char)
+    prefixes.append(last)
+    return prefixes
+
 def parse_expire_date(expiry_formatted: str, prefix_discard: str = "") -> dict:
     """ Parse a string formatted as `DATE_FMT_EXPIRE` with an optional prefix to discard """
     ret = {}
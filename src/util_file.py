@@ -1,5 +1,8 @@
 import os
+import sys
+import time
 import mimetypes
+import subprocess
 from itertools import takewhile
 
 def nca_path(pathA, pathB):
@@ -32,3 +35,16 @@ def classify_path(binpath: str) -> str:
     elif os.path.islink(binpath): return "link"
     elif os.path.ismount(binpath): return "mount"
     else: return "unknown"
+
+
+def rmtree_background(path: str) -> str:
+    """
+        Delete directory tree without waiting for it: Rename it aside, then delete it from a detached process.
+        Renaming is instant, so the path can be reused right away. Returns the temporary name.
+    """
+    trash = f"{path}.trash-{os.getpid()}-{time.monotonic_ns()}"
+    os.rename(path, trash)
+    subprocess.Popen([sys.executable, "-c", "import shutil, sys; shutil.rmtree(sys.argv[1], ignore_errors=True)", trash],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    return trash
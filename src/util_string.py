@@ -81,3 +81,11 @@ def url_redact(url: str, replacement: str = 'REDACTED'):
     ))
 
     return redacted_url
+
+def parse_size(size: str) -> int:
+    """ Bytes from human readable size, e.g. "512", "100M", "1.5GiB". Units are powers of 1024 """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: '{size}'")
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024**exponent)
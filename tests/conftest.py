@@ -0,0 +1,17 @@
+import subprocess
+
+import pytest
+
+
+def git(*args, cwd=None, input=None):
+    """ Output of a git command, stripped. Raises if git fails """
+    return subprocess.run(["git", *args], cwd=cwd, input=input, capture_output=True, text=True, check=True).stdout.strip()
+
+
+@pytest.fixture
+def author_env(monkeypatch):
+    """ Author and committer for commits made by tests, whatever the git config of the host """
+    for var in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+        monkeypatch.setenv(var, 'tester')
+    for var in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        monkeypatch.setenv(var, 'tester@example.com')
@@ -29,8 +29,36 @@ def test_parse_args_push():
     args = run_parse_args(['push', 'https://example.com', '--path', '/tmp/foo', '--name', 'bar'])
     assert args.command == 'push'
     assert args.remote == 'https://example.com'
-    assert args.path == '/tmp/foo'
-    assert args.name == 'bar'
+    assert args.push_artifacts == [('/tmp/foo', 'bar')]
+    assert args.atomic is False
+    assert args.remotes == ['https://example.com']
+
+
+def test_parse_args_push_remotes():
+    args = run_parse_args(['push', 'https://a', 'https://b', '--path', '/tmp/foo', '--name', 'bar', '--jobs', '2'])
+    assert (args.remote, args.remotes, args.jobs) == ('https://a', ['https://a', 'https://b'], 2)
+    assert run_parse_args(['push', 'https://a', '--path', '/tmp/foo', '--name', 'bar', '--jobs', '0']) is None
+
+
+def test_parse_args_push_many(tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text('[{"path": "obj/c", "name": "c"}]')
+    args = run_parse_args(['push', 'https://example.com', '--path', 'obj/a', '--name', 'a', '--path', 'obj/b', '--name', 'b', '--manifest', str(manifest)])
+    assert args.push_artifacts == [('obj/a', 'a'), ('obj/b', 'b'), ('obj/c', 'c')]
+
+
+def test_parse_args_push_mismatch(tmp_path):
+    assert run_parse_args(['push', 'https://example.com', '--path', 'obj/a', '--path', 'obj/b', '--name', 'a']) is None
+    assert run_parse_args(['push', 'https://example.com']) is None
+    assert run_parse_args(['push', 'https://example.com', '--path', 'a', '--name', 'a', '--path', 'b', '--name', 'b', '--from-tar', '-']) is None
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text('[{"path": "obj/c"}]')
+    assert run_parse_args(['push', 'https://example.com', '--manifest', str(manifest)]) is None
+
+
+def test_parse_args_push_atomic():
+    args = run_parse_args(['push', 'https://example.com', '--path', '/tmp/foo', '--name', 'bar', '--atomic'])
+    assert args.atomic is True
 
 
 def test_parse_args_force_tag_requires_force_branch():
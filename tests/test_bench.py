@@ -0,0 +1,21 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "bench.py")
+
+
+def test_bench_smoke(tmp_path):
+    out = tmp_path / "bench.json"
+    subprocess.run([sys.executable, BENCH, "--artifacts", "4", "--shapes", "2x1K", "--out", str(out)], check=True, capture_output=True)
+    report = json.loads(out.read_text())
+    assert report["git"].startswith("git version")
+    scenarios = [r["scenario"] for r in report["results"]]
+    assert scenarios == ["list-all", "list-name", "list-path", "clean", "flush-meta", "push", "download"]
+    for r in report["results"]:
+        assert r["exit_code"] == 0
+        assert r["git_processes"] > 0 and r["wall_s"] > 0 and r["peak_rss_kb"] > 0
+    push = report["results"][5]
+    assert push["params"] == {"files": 2, "size": 1024}
+    assert push["bytes_received"] > 2048
@@ -0,0 +1,77 @@
+import os
+from types import SimpleNamespace
+
+from cat_file import CatFile
+
+from conftest import git
+
+
+def make_reader(tmp_path):
+    git("init", "-q", str(tmp_path))
+    printer = SimpleNamespace(debug=lambda *a, **k: None)
+    return CatFile(printer, os.environ | {"GIT_DIR": str(tmp_path / ".git")})
+
+
+def test_read_object_and_size(tmp_path):
+    reader = make_reader(tmp_path)
+    sha = git("hash-object", "-w", "--stdin", cwd=tmp_path, input="hello\n")
+
+    assert reader.read_object(sha) == b"hello\n"
+    assert reader.object_size(sha) == 6
+    assert reader.read_object("0" * 40) is None
+    assert reader.object_size("0" * 40) is None
+    reader.close()
+
+
+def test_read_many_reuses_process(tmp_path):
+    reader = make_reader(tmp_path)
+    blobs = {git("hash-object", "-w", "--stdin", cwd=tmp_path, input=f"blob {i}\n" * 1000): f"blob {i}\n" * 1000 for i in range(50)}
+
+    res = reader.read_many([*blobs, "missing"])
+    assert res == {sha: content.encode() for sha, content in blobs.items()}
+    proc = reader.procs["--batch"]
+
+    # Objects written after the reader started are found too
+    sha = git("hash-object", "-w", "--stdin", cwd=tmp_path, input="late\n")
+    assert reader.read_object(sha) == b"late\n"
+    assert reader.procs["--batch"] is proc
+    reader.close()
+    assert proc.returncode == 0
+    assert reader.procs == {}
+
+
+def test_lazy_start(tmp_path):
+    reader = make_reader(tmp_path)
+    assert reader.procs == {}
+    reader.close()
+
+
+def test_iter_many_abandoned(tmp_path):
+    reader = make_reader(tmp_path)
+    shas = [git("hash-object", "-w", "--stdin", cwd=tmp_path, input=f"blob {i}\n") for i in range(3)]
+
+    started = []
+    reader._proc = lambda mode: started.append(CatFile._proc(reader, mode)) or started[-1]
+    it = reader.iter_many(shas)
+    assert next(it) == (shas[0], b"blob 0\n")
+    it.close()
+
+    # The abandoned process is reaped, its pipes closed
+    proc, = started
+    assert proc.returncode is not None
+    assert proc.stdin.closed and proc.stdout.closed
+
+    # Reader is still in sync
+    assert reader.read_object(shas[2]) == b"blob 2\n"
+    reader.close()
+
+
+def test_iter_many_reentrant(tmp_path):
+    """ Reads from within the loop get a process of their own, rather than wait for the loop forever """
+    reader = make_reader(tmp_path)
+    shas = [git("hash-object", "-w", "--stdin", cwd=tmp_path, input=f"blob {i}\n") for i in range(3)]
+
+    seen = [(obj, contents, reader.read_object(shas[0]), reader.object_size(obj)) for obj, contents in reader.iter_many(shas)]
+    assert seen == [(sha, f"blob {i}\n".encode(), b"blob 0\n", 7) for i, sha in enumerate(shas)]
+    assert reader.read_many(shas[1:]) == {sha: f"blob {i}\n".encode() for i, sha in enumerate(shas) if i}
+    reader.close()
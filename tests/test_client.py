@@ -0,0 +1,107 @@
+import ast
+import os
+
+import pytest
+
+from client import RecycleBinClient
+
+from conftest import git
+
+
+@pytest.fixture
+def src(tmp_path, monkeypatch, author_env):
+    """ Source repo with a built artifact at obj/, and an empty bin remote """
+    origin, src = tmp_path / 'origin.git', tmp_path / 'src'
+    git("init", "-q", "--bare", "-b", "main", str(origin), cwd=tmp_path)
+    git("init", "-q", "--bare", str(tmp_path / 'bin.git'), cwd=tmp_path)
+    git("clone", "-q", str(origin), str(src), cwd=tmp_path)
+    git("checkout", "-q", "-b", "main", cwd=src)
+    (src / '.gitignore').write_text('obj/\n')
+    git("add", ".gitignore", cwd=src)
+    git("commit", "-q", "-m", "src", cwd=src)
+    git("push", "-q", "-u", "origin", "main", cwd=src)
+    (src / 'obj' / 'docs').mkdir(parents=True)
+    (src / 'obj' / 'docs' / 'index.html').write_text("docs")
+    (src / 'obj' / 'app.bin').write_bytes(b"app")
+    monkeypatch.chdir(src)
+    return src
+
+
+def test_client_session(src, tmp_path):
+    """ One session pushes, lists, downloads and cleans, without setting up again in between """
+    remote = str(tmp_path / 'bin.git')
+    with RecycleBinClient(remote) as client:
+        rbgit = client.rbgit
+        docs, = client.push([("obj/docs", "docs")], add_ignored=True, tag=True)
+        app, = client.push([("obj/app.bin", "app")], add_ignored=True, expire="2 days ago")
+        assert client.rbgit is rbgit
+
+        listed = dict(client.list())
+        assert set(listed) == {docs['bin_sha_commit'], app['bin_sha_commit']}
+        assert listed[docs['bin_sha_commit']]['artifact-name'] == 'docs'
+        assert [sha for sha, _ in client.list(name="app")] == [app['bin_sha_commit']]
+        assert [meta for _, meta in client.list(with_meta=False)] == [{}, {}]
+
+        (src / 'obj' / 'docs' / 'index.html').unlink()
+        client.download([docs['bin_sha_commit']])
+        assert (src / 'obj' / 'docs' / 'index.html').read_text() == "docs"
+
+        (src / 'obj' / 'docs' / 'index.html').write_text("local edit")
+        client.download([docs['bin_sha_commit']], force=True)
+        assert (src / 'obj' / 'docs' / 'index.html').read_text() == "docs"
+
+        client.clean()
+        assert f"refs/heads/{app['bin_branch_name']}" not in git("for-each-ref", cwd=remote)
+        assert f"refs/heads/{docs['bin_branch_name']}" in git("for-each-ref", cwd=remote)
+    assert not os.path.exists(client.rbgit_dir)
+
+
+def test_client_push_failure(src, tmp_path):
+    """ Remotes which fail are named, after the others have been pushed to """
+    good = str(tmp_path / 'bin.git')
+    with RecycleBinClient(good) as client:
+        with pytest.raises(RuntimeError, match="nowhere"):
+            client.push([("obj/app.bin", "app")], remotes=[str(tmp_path / 'nowhere.git')], add_ignored=True)
+    assert "refs/heads/" in git("for-each-ref", cwd=good)
+
+
+def test_client_push_outside(src, tmp_path):
+    """ Artifacts outside the source repo, pushed together, are all placed relative to the root they share """
+    remote = str(tmp_path / 'bin.git')
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'out' / 'o.bin').write_bytes(b"out")
+    far = tmp_path.parent / f"{tmp_path.name}-far"
+    far.mkdir()
+    (far / 'f.bin').write_bytes(b"far")
+    with RecycleBinClient(remote, root=str(tmp_path.parent)) as client:
+        out, far = client.push([("../out", "out"), (str(far / 'f.bin'), "far")], add_ignored=True)
+        assert out['bin_branch_name'].endswith(f"/{{{tmp_path.name}/out}}")
+        assert far['bin_branch_name'].endswith(f"/{{{tmp_path.name}-far/f.bin}}")
+        assert git("ls-tree", "-r", "--name-only", out['bin_sha_commit'], cwd=remote) == f"{tmp_path.name}/out/o.bin"
+        assert git("ls-tree", "-r", "--name-only", far['bin_sha_commit'], cwd=remote) == f"{tmp_path.name}-far/f.bin"
+
+        # Git can't add the source repo's files from above it
+        with pytest.raises(RuntimeError, match="inside and outside"):
+            client.push([("obj/docs", "docs"), ("../out", "out")], add_ignored=True)
+
+
+def test_client_clean_keeps_annotated(src, tmp_path):
+    """ An artifact kept only by an annotated tag keeps its metadata """
+    remote = str(tmp_path / 'bin.git')
+    with RecycleBinClient(remote) as client:
+        app, = client.push([("obj/app.bin", "app")], add_ignored=True)
+    git("tag", "-a", "-m", "release", "release", app['bin_sha_commit'], cwd=remote)
+    git("update-ref", "-d", f"refs/heads/{app['bin_branch_name']}", cwd=remote)
+
+    with RecycleBinClient(remote) as client:
+        client.clean()
+    assert app['bin_ref_only_metadata'] in git("for-each-ref", cwd=remote)
+
+
+def test_modules_installed():
+    """ setup.py installs every module to be imported, as the client needs them all """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, 'setup.py')) as file:
+        setup_call = next(node for node in ast.walk(ast.parse(file.read())) if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'setup')
+    py_modules = next(ast.literal_eval(keyword.value) for keyword in setup_call.keywords if keyword.arg == 'py_modules')
+    assert sorted(py_modules) == sorted(name[:-3] for name in os.listdir(os.path.join(root, 'src')) if name.endswith('.py'))
@@ -1,27 +1,216 @@
+import os
+import shutil
 from types import SimpleNamespace
-from download import download_command
+
+import pytest
+
+from download import download_command, tree_entries
+from rbgit import RbGit
+
+from conftest import git
 
 class DummyRbGit:
-    def __init__(self):
+    def __init__(self, tmp_path):
         self.calls = []
+        self.cache = None
+        self.mirror = None
+        self.rbgit_dir = str(tmp_path / '.rbgit')
+        self.rbgit_work_tree = str(tmp_path)
     def cmd(self, *args):
         self.calls.append(args)
         if args[0] == 'checkout' and args[-1] == 'fail' and '-f' not in args:
             raise RuntimeError('exists')
+        return ''
+    def stream(self, *args, **kwargs):
+        self.calls.append(args)
+        return iter(())
+    def remote_refs(self, remote, prefixes=()):
+        return SimpleNamespace(get=lambda ref: None)
+    def has_object(self, obj):
+        return False
+    def sparse_checkout(self, patterns):
+        pass
+    def fetch_head(self):
+        return 'f' * 40
 
 
-def test_download_force_false_error(capsys):
-    rbgit = DummyRbGit()
-    args = SimpleNamespace(artifacts=['fail'], force=False)
+def test_download_force_false_error(capsys, tmp_path):
+    rbgit = DummyRbGit(tmp_path)
+    args = SimpleNamespace(artifacts=['fail'], force=False, delta=False, only=None)
     ret = download_command(args, rbgit, 'remote')
     assert ret == 1
     assert ('fetch', 'remote', 'fail') in rbgit.calls
     assert ('checkout', 'fail') in rbgit.calls
 
 
-def test_download_force_true():
-    rbgit = DummyRbGit()
-    args = SimpleNamespace(artifacts=['ok'], force=True)
+def test_download_force_true(tmp_path):
+    rbgit = DummyRbGit(tmp_path)
+    args = SimpleNamespace(artifacts=['ok'], force=True, delta=False, only=None)
     ret = download_command(args, rbgit, 'remote')
     assert ret is None
-    assert rbgit.calls == [('fetch', 'remote', 'ok'), ('checkout', '-f', 'ok')]
+    assert rbgit.calls == [('fetch', 'remote', 'ok'), ('checkout', '-f', 'ok'), ('ls-tree', '-r', '-z', '--full-tree', 'f' * 40)]
+
+
+@pytest.fixture
+def bin_remote(tmp_path, author_env):
+    """ Bin remote with one artifact commit, and a workspace to download it to """
+    src = tmp_path / 'src'
+    (src / 'obj').mkdir(parents=True)
+    (src / 'obj' / 'a.bin').write_text('a')
+    (src / 'obj' / 'run.sh').write_text('#!/bin/sh')
+    os.chmod(src / 'obj' / 'run.sh', 0o755)
+    os.symlink('a.bin', src / 'obj' / 'link')
+    remote = tmp_path / 'bin.git'
+    git('init', '-q', '--bare', str(remote))
+    git('init', '-q', str(src))
+    git('add', '.', cwd=src)
+    git('commit', '-q', '-m', 'artifact', cwd=src)
+    git('push', '-q', str(remote), 'HEAD:refs/heads/artifact', cwd=src)
+    commit = git('rev-parse', 'HEAD', cwd=src)
+
+    ws = tmp_path / 'ws'
+    ws.mkdir()
+    printer = SimpleNamespace(debug=lambda *a, **k: None, high_level=lambda *a, **k: None)
+    make_rbgit = lambda: RbGit(printer, rbgit_dir=str(ws / '.rbgit'), rbgit_work_tree=str(ws))
+    rbgit = make_rbgit()
+    rbgit.add_remote_idempotent('recyclebin', str(remote))
+    return make_rbgit, ws, commit
+
+
+def test_download_skipped_when_work_tree_matches(bin_remote, monkeypatch):
+    make_rbgit, ws, commit = bin_remote
+    args = SimpleNamespace(artifacts=[commit], force=True, delta=False, only=None)
+    download_command(args, make_rbgit(), 'recyclebin')
+    assert (ws / 'obj' / 'a.bin').read_text() == 'a'
+    assert os.path.exists(ws / '.rbgit.statcache')
+
+    # Unchanged work tree: No fetch, no checkout, no hashing
+    calls = []
+    rbgit = make_rbgit()
+    real_cmd = rbgit.cmd
+    rbgit.cmd = lambda *a, **k: calls.append(a) or real_cmd(*a, **k)
+    monkeypatch.setattr('stat_cache.StatCache.RACY_NS', 0)
+    assert download_command(args, rbgit, 'recyclebin') is None
+    assert calls == []
+
+    # Touched but same content: Hashed, not downloaded
+    os.utime(ws / 'obj' / 'a.bin', ns=(1, 1))
+    assert download_command(args, rbgit, 'recyclebin') is None
+    assert [c[0] for c in calls] == ['hash-object']
+
+    # Changed content: Downloaded again
+    calls.clear()
+    (ws / 'obj' / 'a.bin').write_text('changed')
+    download_command(args, rbgit, 'recyclebin')
+    assert 'checkout' in [c[0] for c in calls]
+    assert (ws / 'obj' / 'a.bin').read_text() == 'a'
+
+
+def test_download_skipped_by_name(bin_remote):
+    make_rbgit, ws, commit = bin_remote
+    args = SimpleNamespace(artifacts=['artifact'], force=True, delta=False, only=None)
+    download_command(args, make_rbgit(), 'recyclebin')
+
+    calls = []
+    rbgit = make_rbgit()
+    real_cmd = rbgit.cmd
+    rbgit.cmd = lambda *a, **k: calls.append(a) or real_cmd(*a, **k)
+    assert download_command(args, rbgit, 'recyclebin') is None
+    assert 'fetch' not in [c[0] for c in calls]
+    assert 'checkout' not in [c[0] for c in calls]
+
+
+def test_download_delta(bin_remote, tmp_path):
+    make_rbgit, ws, a = bin_remote
+    remote = tmp_path / 'bin.git'
+    src = tmp_path / 'src'
+    git('--git-dir', str(remote), 'config', 'uploadpack.allowFilter', 'true')
+
+    # Artifact B: One file changed, one added, one removed, one changed mode only
+    (src / 'obj' / 'big.bin').write_bytes(os.urandom(100_000))
+    git('add', '.', cwd=src)
+    git('commit', '-q', '-m', 'artifact a2', cwd=src)
+    a = git('rev-parse', 'HEAD', cwd=src)
+    (src / 'obj' / 'a.bin').write_text('b')
+    (src / 'obj' / 'new.bin').write_text('new')
+    os.remove(src / 'obj' / 'link')
+    os.chmod(src / 'obj' / 'run.sh', 0o644)
+    git('add', '-A', '.', cwd=src)
+    git('commit', '-q', '-m', 'artifact b', cwd=src)
+    git('push', '-q', str(remote), 'HEAD:refs/heads/artifact', cwd=src)
+    b = git('rev-parse', 'HEAD', cwd=src)
+
+    download_command(SimpleNamespace(artifacts=[a], force=True, delta=True, only=None), make_rbgit(), 'recyclebin')
+    big = os.stat(ws / 'obj' / 'big.bin')
+    shutil.rmtree(ws / '.rbgit')  # As by --rm-tmp: No objects of A left locally
+
+    rbgit = make_rbgit()
+    rbgit.add_remote_idempotent('recyclebin', str(remote))
+    download_command(SimpleNamespace(artifacts=[b], force=False, delta=True, only=None), rbgit, 'recyclebin')
+
+    assert (ws / 'obj' / 'a.bin').read_text() == 'b'
+    assert (ws / 'obj' / 'new.bin').read_text() == 'new'
+    assert not os.path.lexists(ws / 'obj' / 'link')
+    assert not os.access(ws / 'obj' / 'run.sh', os.X_OK)
+    # Unchanged files were neither transferred nor written
+    assert os.stat(ws / 'obj' / 'big.bin').st_ino == big.st_ino
+    big_blob = rbgit.cmd('rev-parse', f'{b}:obj/big.bin').strip()
+    assert big_blob in rbgit.missing_objects(b)
+    # Bin repo agrees with the work tree
+    assert rbgit.cmd('rev-parse', 'HEAD').strip() == b
+    assert rbgit.cmd('diff-index', '--cached', '--name-only', b) == ''
+
+
+def test_download_delta_needs_current_artifact(bin_remote):
+    make_rbgit, ws, commit = bin_remote
+    rbgit = make_rbgit()
+    calls = []
+    real_cmd = rbgit.cmd
+    rbgit.cmd = lambda *a, **k: calls.append(a) or real_cmd(*a, **k)
+
+    # Nothing in the work tree yet: Full download
+    download_command(SimpleNamespace(artifacts=[commit], force=True, delta=True, only=None), rbgit, 'recyclebin')
+    assert ('checkout', '-f', commit) in calls
+    assert (ws / 'obj' / 'a.bin').read_text() == 'a'
+
+
+def test_download_only(bin_remote, tmp_path):
+    make_rbgit, ws, _ = bin_remote
+    remote = tmp_path / 'bin.git'
+    src = tmp_path / 'src'
+    git('--git-dir', str(remote), 'config', 'uploadpack.allowFilter', 'true')
+    (src / 'obj' / 'doc' / 'html').mkdir(parents=True)
+    (src / 'obj' / 'doc' / 'html' / 'index.html').write_text('<html/>')
+    (src / 'obj' / 'big.bin').write_bytes(os.urandom(100_000))
+    git('add', '.', cwd=src)
+    git('commit', '-q', '-m', 'artifact', cwd=src)
+    git('push', '-q', str(remote), 'HEAD:refs/heads/artifact', cwd=src)
+    commit = git('rev-parse', 'HEAD', cwd=src)
+
+    rbgit = make_rbgit()
+    args = SimpleNamespace(artifacts=[commit], force=False, delta=False, only=['obj/doc/html/', '*.sh'])
+    assert download_command(args, rbgit, 'recyclebin') is None
+    assert (ws / 'obj' / 'doc' / 'html' / 'index.html').read_text() == '<html/>'
+    assert (ws / 'obj' / 'run.sh').exists()
+    assert not os.path.lexists(ws / 'obj' / 'big.bin')
+    assert not os.path.lexists(ws / 'obj' / 'a.bin')
+
+    # Only matching blobs crossed the network
+    missing = rbgit.missing_objects(commit)
+    assert rbgit.cmd('rev-parse', f'{commit}:obj/big.bin').strip() in missing
+    assert rbgit.cmd('rev-parse', f'{commit}:obj/doc/html/index.html').strip() not in missing
+
+    # Same sparse download again is a no-op, but the full artifact is not in the work tree
+    calls = []
+    real_cmd = rbgit.cmd
+    rbgit.cmd = lambda *a, **k: calls.append(a) or real_cmd(*a, **k)
+    download_command(args, rbgit, 'recyclebin')
+    assert 'checkout' not in [c[0] for c in calls]
+
+    # Full download: Files left out come back, without first checking out everything of the current commit
+    calls.clear()
+    download_command(SimpleNamespace(artifacts=[commit], force=True, delta=False, only=None), rbgit, 'recyclebin')
+    rbgit.cmd = real_cmd
+    assert (ws / 'obj' / 'big.bin').exists()
+    assert 'sparse-checkout' not in [c[0] for c in calls]
+    assert rbgit.cmd('ls-files', '-t').split()[::2] == ['H'] * len(tree_entries(rbgit, commit))
@@ -1,18 +1,35 @@
+import os
+import time
 import datetime
+import tracemalloc
 from types import SimpleNamespace
-import git_recycle_bin as grb
+import push
+import clean
+from remote_refs import RemoteRefSnapshot
+
+
+def snapshot_of(*lines):
+    """ Snapshot of a remote having the refs, given as 'sha<TAB>ref' lines """
+    refs = [line.split() for line in lines]
+    lister = SimpleNamespace(ls_refs=lambda remote, prefixes: [(sha, ref) for sha, ref in refs if any(ref.startswith(p) for p in prefixes)])
+    return RemoteRefSnapshot(lister, 'remote')
 
 
 def test_push_branch_force(monkeypatch):
     calls = []
+    snapshot = snapshot_of()
     dummy = SimpleNamespace(
-        cmd=lambda *a, **k: calls.append(a)
+        cmd=lambda *a, **k: calls.append(a),
+        remote_refs=lambda remote: snapshot,
     )
     args = SimpleNamespace(force_branch=True)
-    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'm'}
-    grb.push_branch(args, d, dummy, 'remote')
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'm', 'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40}
+    push.push_branch(args, d, dummy, 'remote')
     assert ('push', '--force', 'remote', 'b') in calls
     assert ('push', '--force', 'remote', 'm') in calls
+    # Snapshot is updated with our pushes, without listing again
+    assert snapshot.get('refs/heads/b') == 'c' * 40
+    assert snapshot.get('m') == 'd' * 40
 
 
 def test_push_branch_skip_existing(monkeypatch):
@@ -24,12 +41,15 @@ def test_push_branch_skip_existing(monkeypatch):
             return ''
 
         def remote_already_has_ref(self, remote, ref):
-            return ref == 'b'
+            return ref == 'refs/heads/b'
+
+        def remote_refs(self, remote):
+            return snapshot_of()
 
     dummy = Dummy()
     args = SimpleNamespace(force_branch=False)
-    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'm'}
-    grb.push_branch(args, d, dummy, 'remote')
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'm', 'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40}
+    push.push_branch(args, d, dummy, 'remote')
     assert ('push', 'remote', 'm') in calls
     assert ('push', 'remote', 'b') not in calls
 
@@ -37,6 +57,8 @@ def test_push_branch_skip_existing(monkeypatch):
 def test_push_tag_new(monkeypatch):
     calls = []
 
+    snapshot = snapshot_of()
+
     class Dummy:
         def fetch_current_tag_value(self, r, t):
             return None
@@ -45,16 +67,20 @@ def test_push_tag_new(monkeypatch):
             calls.append(a)
             return ''
 
+        def remote_refs(self, remote):
+            return snapshot
+
     dummy = Dummy()
     args = SimpleNamespace(force_tag=False)
     d = {
         'bin_tag_name': 'tag',
         'src_commits_ahead': '',
-        'bin_sha_commit': 'sha',
+        'bin_sha_commit': 'a' * 40,
         'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000',
     }
-    grb.push_tag(args, d, dummy, 'remote')
+    push.push_tag(args, d, dummy, 'remote')
     assert ('push', 'remote', 'tag') in calls
+    assert snapshot.get('refs/tags/tag') == 'a' * 40
 
 
 def test_push_tag_force_when_newer(monkeypatch):
@@ -64,65 +90,302 @@ def test_push_tag_force_when_newer(monkeypatch):
         def fetch_current_tag_value(self, r, t):
             return 'abc'
 
-        def fetch_cat_pretty(self, r, ref):
+        def fetch_meta_for_commit(self, r, sha):
+            assert sha == 'abc'
             return 'src-git-commit-time-commit: Wed, 21 Jun 2023 11:00:00 +0000'
 
         def cmd(self, *a, **k):
             calls.append(a)
             return ''
 
+        def remote_refs(self, remote):
+            return snapshot_of()
+
     dummy = Dummy()
     args = SimpleNamespace(force_tag=False)
     d = {
         'bin_tag_name': 'tag',
         'src_commits_ahead': '',
-        'bin_sha_commit': 'ours',
+        'bin_sha_commit': 'a' * 40,
         'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000',
     }
-    grb.push_tag(args, d, dummy, 'remote')
+    push.push_tag(args, d, dummy, 'remote')
     assert ('push', '--force', 'remote', 'tag') in calls
 
 
-def test_remote_delete_expired_branches(monkeypatch):
-    lines = (
-        'sha1\trefs/heads/artifact/expire/9999-01-01/00.00+0000/foo',
-        'sha2\trefs/heads/artifact/expire/2000-01-01/00.00+0000/foo',
-    )
+def test_push_tag_keep_when_older(monkeypatch):
     calls = []
 
     class Dummy:
+        def fetch_current_tag_value(self, r, t):
+            return 'abc'
+
+        def fetch_meta_for_commit(self, r, sha):
+            return 'src-git-commit-time-commit: Wed, 21 Jun 2023 13:00:00 +0000'
+
         def cmd(self, *a, **k):
-            if a[:3] == ('ls-remote', '--heads', 'remote'):
-                return '\n'.join(lines)
             calls.append(a)
             return ''
 
-    dummy = Dummy()
-    grb.remote_delete_expired_branches(dummy, 'remote')
-    assert ('push', 'remote', '--delete', 'refs/heads/artifact/expire/2000-01-01/00.00+0000/foo') in calls
-    assert ('push', 'remote', '--delete', 'refs/heads/artifact/expire/9999-01-01/00.00+0000/foo') not in calls
+    args = SimpleNamespace(force_tag=False)
+    d = {
+        'bin_tag_name': 'tag',
+        'src_commits_ahead': '',
+        'bin_sha_commit': 'a' * 40,
+        'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000',
+    }
+    push.push_tag(args, d, Dummy(), 'remote')
+    assert calls == []
 
 
-def test_remote_flush_meta_for_commit(monkeypatch):
-    sha1 = 'a' * 40
-    sha2 = 'b' * 40
+def atomic_dummy(snapshot, calls, tag_meta=''):
+    class Dummy:
+        def cmd(self, *a, **k):
+            calls.append(a)
+            return ''
+
+        def remote_refs(self, remote):
+            return snapshot
+
+        def fetch_current_tag_value(self, remote, tag):
+            return snapshot.get(f'refs/tags/{tag}')
+
+        def fetch_meta_for_commit(self, remote, sha):
+            return tag_meta
+
+        def fetch_meta_for_commits(self, remote, shas):
+            calls.append(('fetch-metas', *shas))
+            return {sha: tag_meta for sha in shas}
+
+    return Dummy()
+
+
+def test_push_atomic_new(monkeypatch):
+    calls = []
+    snapshot = snapshot_of()
+    args = SimpleNamespace(force_branch=False, force_tag=False, push_tag=True)
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'refs/artifact/m', 'bin_tag_name': 't', 'src_commits_ahead': '',
+         'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40, 'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000'}
+    push.push_atomic(args, [d], atomic_dummy(snapshot, calls), 'remote')
+
+    # Single push, refs to be created must not exist
+    assert calls == [('push', '--atomic',
+                      '--force-with-lease=refs/heads/b:', '--force-with-lease=refs/artifact/m:', '--force-with-lease=refs/tags/t:',
+                      'remote',
+                      'refs/heads/b:refs/heads/b', 'refs/artifact/m:refs/artifact/m', 'refs/tags/t:refs/tags/t')]
+    assert snapshot.get('refs/heads/b') == 'c' * 40
+    assert snapshot.get('refs/artifact/m') == 'd' * 40
+    assert snapshot.get('refs/tags/t') == 'c' * 40
+
+
+def test_push_atomic_existing(monkeypatch):
+    calls = []
+    snapshot = snapshot_of(f'{"c" * 40}\trefs/heads/b', f'{"d" * 40}\trefs/artifact/m', f'{"e" * 40}\trefs/tags/t')
+    args = SimpleNamespace(force_branch=False, force_tag=False, push_tag=True)
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'refs/artifact/m', 'bin_tag_name': 't', 'src_commits_ahead': '',
+         'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40, 'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000'}
+    push.push_atomic(args, [d], atomic_dummy(snapshot, calls, 'src-git-commit-time-commit: Wed, 21 Jun 2023 11:00:00 +0000'), 'remote')
+
+    # Existing branch and meta-data are left alone, tag is only moved from the value we compared against
+    assert calls == [('push', '--atomic', f'--force-with-lease=refs/tags/t:{"e" * 40}', 'remote', 'refs/tags/t:refs/tags/t')]
+
+
+def test_push_atomic_nothing(monkeypatch):
     calls = []
+    snapshot = snapshot_of(f'{"c" * 40}\trefs/heads/b', f'{"d" * 40}\trefs/artifact/m')
+    args = SimpleNamespace(force_branch=False, force_tag=False, push_tag=False)
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'refs/artifact/m', 'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40}
+    push.push_atomic(args, [d], atomic_dummy(snapshot, calls), 'remote')
+    assert calls == []
 
+
+def test_push_atomic_force_branch(monkeypatch):
+    calls = []
+    snapshot = snapshot_of(f'{"1" * 40}\trefs/heads/b')
+    args = SimpleNamespace(force_branch=True, force_tag=False, push_tag=False)
+    d = {'bin_branch_name': 'b', 'bin_ref_only_metadata': 'refs/artifact/m', 'bin_sha_commit': 'c' * 40, 'bin_sha_only_metadata': 'd' * 40}
+    push.push_atomic(args, [d], atomic_dummy(snapshot, calls), 'remote')
+    assert calls == [('push', '--atomic', 'remote', '+refs/heads/b:refs/heads/b', '+refs/artifact/m:refs/artifact/m')]
+
+
+def test_push_atomic_many(monkeypatch):
+    calls = []
+    snapshot = snapshot_of(f'{"e" * 40}\trefs/tags/t1', f'{"f" * 40}\trefs/tags/t2')
+    args = SimpleNamespace(force_branch=False, force_tag=False, push_tag=True)
+    d = {'src_commits_ahead': '', 'bin_sha_only_metadata': 'd' * 40, 'src_time_commit': 'Wed, 21 Jun 2023 12:00:00 +0000'}
+    ds = [d | {'bin_branch_name': f'b{i}', 'bin_ref_only_metadata': f'refs/artifact/m{i}', 'bin_tag_name': f't{i}', 'bin_sha_commit': str(i) * 40}
+          for i in (1, 2)]
+    push.push_atomic(args, ds, atomic_dummy(snapshot, calls, 'src-git-commit-time-commit: Wed, 21 Jun 2023 11:00:00 +0000'), 'remote')
+
+    # Metadata behind both remote tags in one fetch, then all refs of both artifacts in one push
+    assert calls == [('fetch-metas', 'e' * 40, 'f' * 40),
+                     ('push', '--atomic',
+                      '--force-with-lease=refs/heads/b1:', '--force-with-lease=refs/artifact/m1:',
+                      '--force-with-lease=refs/heads/b2:', '--force-with-lease=refs/artifact/m2:',
+                      f'--force-with-lease=refs/tags/t1:{"e" * 40}', f'--force-with-lease=refs/tags/t2:{"f" * 40}',
+                      'remote',
+                      'refs/heads/b1:refs/heads/b1', 'refs/artifact/m1:refs/artifact/m1',
+                      'refs/heads/b2:refs/heads/b2', 'refs/artifact/m2:refs/artifact/m2',
+                      'refs/tags/t1:refs/tags/t1', 'refs/tags/t2:refs/tags/t2')]
+
+
+def clean_dummy(snapshot, calls):
     class Dummy:
         def cmd(self, *a, **k):
-            if a[:4] == ('ls-remote', '--refs', 'remote', 'refs/artifact/meta-for-commit/*'):
-                return f'{sha1}\trefs/artifact/meta-for-commit/{sha1}\n{sha2}\trefs/artifact/meta-for-commit/{sha2}'
-            if a[:3] == ('ls-remote', '--heads', 'remote'):
-                return f'{sha2}\trefs/heads/main'
-            if a[:3] == ('ls-remote', '--tags', 'remote'):
-                return ''
             calls.append(a)
             return ''
 
-    dummy = Dummy()
-    grb.remote_flush_meta_for_commit(dummy, 'remote')
-    assert ('push', 'remote', '--delete', 'refs/artifact/meta-for-commit/' + sha1) in calls
-    assert all('refs/artifact/meta-for-commit/' + sha2 not in a for a in calls)
+        def remote_refs(self, remote, prefixes=()):
+            return snapshot
+
+    return Dummy()
+
+
+def test_remote_clean_expired_branches(monkeypatch):
+    snapshot = snapshot_of(
+        f'{"1" * 40}\trefs/heads/artifact/expire/9999-01-01/00.00+0000/foo',
+        f'{"2" * 40}\trefs/heads/artifact/expire/2000-01-01/00.00+0000/foo',
+        f'{"3" * 40}\trefs/heads/artifact/expire/2000-01-02/00.00+0000/foo',
+    )
+    calls = []
+    clean.remote_clean(clean_dummy(snapshot, calls), 'remote', rm_expired=True, flush_meta=False)
+
+    # All expired branches in one push
+    assert calls == [('push', 'remote', '--delete',
+                      'refs/heads/artifact/expire/2000-01-01/00.00+0000/foo',
+                      'refs/heads/artifact/expire/2000-01-02/00.00+0000/foo')]
+    # Deletions recorded. The branch expiring in the future was never listed
+    assert [ref for ref, _ in snapshot._refs()] == []
+
+
+def test_remote_expired_branches_lists_only_past_dates(monkeypatch):
+    refs = [
+        f'{"1" * 40}\trefs/heads/artifact/expire/2000-01-01/00.00+0000/old',
+        f'{"2" * 40}\trefs/heads/artifact/expire/2999-01-01/00.00+0000/future',
+        f'{"3" * 40}\trefs/heads/artifact/expire/garbage',
+    ]
+    snapshot = snapshot_of(*refs)
+    monkeypatch.setattr(clean.printer, 'verbosity', 0)
+    expired = clean.remote_expired_branches(clean_dummy(snapshot, []), 'remote')
+
+    # Branches expiring in the future are not even transferred
+    assert [ref for ref, _ in snapshot._refs()] == [b'refs/heads/artifact/expire/2000-01-01/00.00+0000/old']
+    assert expired == ['refs/heads/artifact/expire/2000-01-01/00.00+0000/old']
+
+
+def test_remote_flush_meta_for_commit(monkeypatch):
+    sha1 = 'a' * 40
+    sha2 = 'b' * 40
+    sha3 = 'c' * 40
+    src = 'f' * 40
+    snapshot = snapshot_of(
+        f'{sha1}\trefs/artifact/meta-for-commit/{sha1}',
+        f'{sha2}\trefs/artifact/meta-for-commit/{sha2}',
+        f'{sha3}\trefs/artifact/meta-for-commit/{src}/{sha3}',
+        f'{sha2}\trefs/heads/main',
+    )
+    calls = []
+    clean.remote_clean(clean_dummy(snapshot, calls), 'remote', rm_expired=False, flush_meta=True)
+    assert calls == [('push', 'remote', '--delete', 'refs/artifact/meta-for-commit/' + sha1, f'refs/artifact/meta-for-commit/{src}/{sha3}')]
+    assert [ref for ref, _ in snapshot.items('refs/artifact/meta-for-commit/')] == ['refs/artifact/meta-for-commit/' + sha2]
+
+
+def test_remote_clean_same_batch(monkeypatch):
+    alive = 'a' * 40
+    expiring = 'b' * 40
+    src = 'f' * 40
+    snapshot = snapshot_of(
+        f'{alive}\trefs/heads/artifact/expire/9999-01-01/00.00+0000/foo',
+        f'{expiring}\trefs/heads/artifact/expire/2000-01-01/00.00+0000/foo',
+        f'{alive}\trefs/artifact/meta-for-commit/{src}/{alive}',
+        f'{expiring}\trefs/artifact/meta-for-commit/{src}/{expiring}',
+    )
+    calls = []
+    clean.remote_clean(clean_dummy(snapshot, calls), 'remote', rm_expired=True, flush_meta=True)
+
+    # Meta-data of the artifact whose branch expires now is flushed in the same push
+    assert calls == [('push', 'remote', '--delete',
+                      'refs/heads/artifact/expire/2000-01-01/00.00+0000/foo',
+                      f'refs/artifact/meta-for-commit/{src}/{expiring}')]
+
+
+def test_remote_clean_chunked(monkeypatch):
+    refs = [f'{i:040x}\trefs/heads/artifact/expire/2000-01-01/00.00+0000/{i:05}' for i in range(3000)]
+    snapshot = snapshot_of(*refs)
+    calls = []
+    monkeypatch.setattr(clean, 'DELETE_BATCH_MAX_BYTES', 100 * 1024)
+    monkeypatch.setattr(clean.printer, 'verbosity', 0)
+    clean.remote_clean(clean_dummy(snapshot, calls), 'remote', rm_expired=True, flush_meta=False)
+
+    assert len(calls) == 2
+    for call in calls:
+        assert sum(len(arg) + 1 for arg in call[3:]) <= 100 * 1024
+    assert sum(len(call) - 3 for call in calls) == 3000
+    assert len(snapshot) == 0
+
+
+def test_remote_clean_dry_run(monkeypatch, capsys):
+    refs = [f'{i:040x}\trefs/heads/artifact/expire/2000-01-01/00.00+0000/{i:05}' for i in range(10)]
+    snapshot = snapshot_of(*refs)
+    calls = []
+    monkeypatch.setattr(clean, 'delete_batches', lambda refs: [refs[:6], refs[6:]])
+    monkeypatch.setattr(clean.printer, 'colorize', False)
+    clean.remote_clean(clean_dummy(snapshot, calls), 'remote', rm_expired=True, flush_meta=True, dry_run=True)
+
+    assert calls == []
+    assert len(snapshot) == 10
+    err = capsys.readouterr().err
+    assert 'Would delete 10 expired branches and 0 meta-for-commit refs, in 2 pushes' in err
+    assert 'Push 1/2 would delete 6 refs' in err
+    assert 'Push 2/2 would delete 4 refs' in err
+
+
+def flush_meta_bench(artifacts: int) -> tuple[float, int, int]:
+    """
+        Flush meta-for-commit on a remote with `artifacts` meta refs, a quarter of them orphaned, and as many other refs.
+        Returns seconds taken, number of refs deleted, and bytes of ref names listed.
+    """
+    src = 'f' * 40
+    def ls_refs(remote, prefixes):
+        for i in range(artifacts):
+            yield f'{i:040x}', f'refs/artifact/meta-for-commit/{src}/{i:040x}'
+        for i in range(1, artifacts, 2):
+            yield f'{i:040x}', f'refs/heads/artifact/expire/2999-01-01/00.00+0000/repo@{src}/{{obj/{i:08}}}'
+        for i in range(artifacts // 2):
+            yield f'{i:040x}', f'refs/tags/artifact/latest/repo@branch-{i:08}/{{obj}}'
+    snapshot = RemoteRefSnapshot(SimpleNamespace(ls_refs=ls_refs), 'remote')
+    deleted = []
+    rbgit = SimpleNamespace(cmd=lambda *a, **k: deleted.extend(a[3:]), remote_refs=lambda remote, prefixes=(): (snapshot.ensure(prefixes), snapshot)[1])
+
+    start = time.monotonic()
+    clean.remote_clean(rbgit, 'remote', rm_expired=False, flush_meta=True)
+    return time.monotonic() - start, len(deleted), len(snapshot.names.buf) + sum(len(ref) for ref in deleted)
+
+
+def test_flush_meta_bench(monkeypatch):
+    """ Set GITRB_BENCH_REFS=1000000 for the real thing """
+    artifacts = int(os.getenv('GITRB_BENCH_REFS', '100000'))
+    monkeypatch.setattr(clean.printer, 'verbosity', 0)
+
+    seconds, deleted, _ = flush_meta_bench(artifacts)
+    assert deleted == artifacts // 4  # Odd ones are kept by branches, the first half by tags
+    assert seconds < 20e-6 * 2 * artifacts  # 20µs per ref
+
+    # Peak memory is a small multiple of the ref names themselves
+    tracemalloc.start()
+    try:
+        _, _, names_bytes = flush_meta_bench(artifacts // 10)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 5 * names_bytes
+
+
+def test_delete_batches():
+    assert clean.delete_batches([]) == []
+    assert clean.delete_batches(['aaaa', 'bbbb', 'cccc'], max_bytes=10) == [['aaaa', 'bbbb'], ['cccc']]
+    # A single ref larger than the budget still gets its own batch
+    assert clean.delete_batches(['a' * 20, 'b'], max_bytes=10) == [['a' * 20], ['b']]
 
 
 def test_note_append_push(monkeypatch):
@@ -136,14 +399,13 @@ def test_note_append_push(monkeypatch):
         calls.append(("exec_nostderr", cmd, env))
         return ''
 
-    monkeypatch.setattr(grb, 'exec', fake_exec)
-    monkeypatch.setattr(grb, 'exec_nostderr', fake_exec_nostderr)
-    monkeypatch.setattr(grb, 'get_user', lambda: 'u')
-    monkeypatch.setattr(grb, 'get_hostname', lambda: 'h')
+    monkeypatch.setattr(push, 'exec', fake_exec)
+    monkeypatch.setattr(push, 'exec_nostderr', fake_exec_nostderr)
+    monkeypatch.setattr(push, 'get_user', lambda: 'u')
+    monkeypatch.setattr(push, 'get_hostname', lambda: 'h')
 
     args = SimpleNamespace(
         remote='https://remote',
-        name='artifact',
         src_remote_name='origin',
         user_name='me',
         user_email='me@example.com',
@@ -153,15 +415,17 @@ def test_note_append_push(monkeypatch):
         'bin_time_commit': 't',
         'bin_branch_expire': 'exp',
         'bin_sha_commit': 'sha',
+        'artifact_name_given': 'artifact',
     }
 
-    grb.note_append_push(args, d)
+    push.note_append_push(args, [d])
 
     gitenv = calls[0][2]
-    expected_ref = grb.sanitize_branch_name(
-        f"refs/notes/artifact/{grb.sanitize_slashes(args.remote)}/{grb.sanitize_slashes(args.name)}/{d['bin_sha_commit']}-clean"
+    expected_ref = push.sanitize_branch_name(
+        f"refs/notes/artifact/{push.sanitize_slashes(args.remote)}/{push.sanitize_slashes(d['artifact_name_given'])}/{d['bin_sha_commit']}-clean"
     )
     assert gitenv['GIT_NOTES_REF'] == expected_ref
     assert gitenv['GIT_AUTHOR_NAME'] == 'me'
     assert any(c[1][:2] == ['git', 'notes'] and 'append' in c[1] for c in calls)
-    assert any(c[1][:2] == ['git', 'push'] for c in calls)
+    pushes = [c[1] for c in calls if c[1][:2] == ['git', 'push']]
+    assert pushes == [['git', 'push', '--porcelain', f'--force-with-lease={expected_ref}:', 'origin', f'{expected_ref}:{expected_ref}']]
@@ -1,46 +1,33 @@
+import time
 import pytest
 from types import SimpleNamespace
-import git_recycle_bin as grb
+import push
 
 
 def test_create_artifact_commit_missing(tmp_path):
     missing = tmp_path / "nope.bin"
     with pytest.raises(RuntimeError):
-        grb.create_artifact_commit(SimpleNamespace(), 'name', str(missing), '1d', False, 'origin')
+        push.create_artifact_commit(SimpleNamespace(), 'name', str(missing), '1d', False, 'origin')
 
 
 def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
     path = tmp_path / "file.txt"
     path.write_text('data')
 
-    def fake_exec(cmd):
-        if cmd[:3] == ['git', 'rev-parse', 'HEAD']:
-            return 'sha'
-        if '--format=%B' in cmd:
-            return 'msg\n'
-        if '--format=%ad' in cmd or '--format=%cd' in cmd:
-            return 'Wed, 01 Jan 2020 00:00:00 +0000'
-        if cmd[:3] == ['git', 'rev-parse', '--abbrev-ref']:
-            return 'main'
-        if cmd[:3] == ['git', 'config', '--get']:
-            return 'https://example.com/repo.git'
-        if cmd[:3] == ['git', 'rev-parse', '--show-toplevel']:
-            return '/src/root'
-        if cmd[:2] == ['git', 'status']:
-            return ''
-        if cmd and cmd[1] == 'for-each-ref':
-            return 'origin/main'
-        if cmd and cmd[0:2] == ['git', 'rev-list']:
-            return '0'
-        return ''
-
-    monkeypatch.setattr(grb, 'exec', fake_exec)
-    monkeypatch.setattr(grb, 'classify_path', lambda p: 'file')
-    monkeypatch.setattr(grb, 'nca_path', lambda a, b: '/nca')
-    monkeypatch.setattr(grb, 'rel_dir', lambda **k: 'rel')
-    monkeypatch.setattr(grb, 'date_fuzzy2expiryformat', lambda x: '2024-01-01/00.00+0000')
-    monkeypatch.setattr(grb, 'emit_commit_msg', lambda d: 'commit msg')
-    monkeypatch.setattr(grb, 'printer', SimpleNamespace(always=lambda *a, **k: None,
+    fields = {
+        'src_remote_name': 'origin', 'src_sha': 'sha', 'src_sha_short': 'sha', 'src_sha_msg': 'msg', 'src_sha_title': 'msg',
+        'src_time_author': 'Wed, 01 Jan 2020 00:00:00 +0000', 'src_time_commit': 'Wed, 01 Jan 2020 00:00:00 +0000',
+        'src_branch': 'main', 'src_tree_root': '/src/root', 'src_branch_upstream': 'origin/main',
+        'src_commits_ahead': '0', 'src_commits_behind': '0',
+        'src_repo_url': 'https://example.com/repo.git', 'src_repo': 'repo.git', 'src_status': '',
+    }
+    monkeypatch.setattr(push, 'SourceSnapshot', lambda remote, **k: SimpleNamespace(fields=fields, elapsed=0.1))
+    monkeypatch.setattr(push, 'classify_path', lambda p: 'file')
+    monkeypatch.setattr(push, 'nca_path', lambda a, b: '/nca')
+    monkeypatch.setattr(push, 'rel_dir', lambda **k: 'rel')
+    monkeypatch.setattr(push, 'date_fuzzy2expiryformat', lambda x: '2024-01-01/00.00+0000')
+    monkeypatch.setattr(push, 'emit_commit_msg', lambda d: 'commit msg')
+    monkeypatch.setattr(push, 'printer', SimpleNamespace(always=lambda *a, **k: None,
                                                        high_level=lambda *a, **k: None,
                                                        detail=lambda *a, **k: None,
                                                        debug=lambda *a, **k: None))
@@ -49,11 +36,10 @@ def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
         def __init__(self):
             self.calls = []
             self.rbgit_dir = '/rbgit'
-        def checkout_orphan_idempotent(self, b):
-            self.calls.append(('checkout', b))
-        def add(self, p, force):
-            self.calls.append(('add', p, force))
-            return True
+            self.cache = None
+        def commit_path(self, b, p, message, force, env):
+            self.calls.append(('commit_path', b, p, message, force, env))
+            return 'sha', True
         def cmd(self, *a, input=None, capture_output=True):
             self.calls.append(('cmd', a))
             if a[:2] == ('rev-parse', 'HEAD'):
@@ -65,16 +51,17 @@ def test_create_artifact_commit_sanitizes_name(tmp_path, monkeypatch):
             self.calls.append(('set_tag', tag_name, tag_val))
 
     rbgit = Dummy()
-    d = grb.create_artifact_commit(rbgit, 'bad name?', str(path), 'tomorrow', False, 'origin')
+    d = push.create_artifact_commit(rbgit, 'bad name?', str(path), 'tomorrow', False, 'origin')
 
     assert d['artifact_name'] == 'bad_name_'
+    assert d['artifact_name_given'] == 'bad name?'
     assert any(c[0] == 'set_tag' for c in rbgit.calls)
 
 
 def test_push_command(monkeypatch):
     calls = []
 
-    def fake_create(r, name, path, expire, add_ignored, src_remote):
+    def fake_create(r, name, path, expire, add_ignored, src_remote, **kwargs):
         calls.append(('create', name, path, expire, add_ignored, src_remote))
         return {
             'bin_branch_name': 'b',
@@ -85,30 +72,102 @@ def test_push_command(monkeypatch):
             'src_time_commit': 'time',
         }
 
-    monkeypatch.setattr(grb, 'create_artifact_commit', fake_create)
-    monkeypatch.setattr(grb, 'push_branch', lambda a, b, c, d: calls.append('push_branch'))
-    monkeypatch.setattr(grb, 'push_tag', lambda a, b, c, d: calls.append('push_tag'))
-    monkeypatch.setattr(grb, 'note_append_push', lambda a, b: calls.append('note'))
-    monkeypatch.setattr(grb, 'remote_delete_expired_branches', lambda c, d: calls.append('rm_expired'))
-    monkeypatch.setattr(grb, 'remote_flush_meta_for_commit', lambda c, d: calls.append('flush_meta'))
-    monkeypatch.setattr(grb, 'printer', SimpleNamespace(high_level=lambda *a, **k: None, detail=lambda *a, **k: None))
+    monkeypatch.setattr(push, 'create_artifact_commit', fake_create)
+    monkeypatch.setattr(push, 'sample_source', lambda *a: SimpleNamespace(fields={'src_tree_root': '/'}))
+    monkeypatch.setattr(push, 'push_branch', lambda a, b, c, d: calls.append('push_branch'))
+    monkeypatch.setattr(push, 'push_tag', lambda a, b, c, d: calls.append('push_tag'))
+    monkeypatch.setattr(push, 'note_append_push', lambda a, b, env: calls.append('note'))
+    monkeypatch.setattr(push, 'remote_clean', lambda c, d, rm_expired, flush_meta: calls.append(('clean', rm_expired, flush_meta)))
+    monkeypatch.setattr(push, 'printer', SimpleNamespace(high_level=lambda *a, **k: None, detail=lambda *a, **k: None))
 
     class DummyRb:
         def __init__(self):
             self.calls = []
             self.rbgit_dir = '/r'
+            self.rbgit_work_tree = '/'
+            self.ssh_env = {}
         def add_remote_idempotent(self, name, url):
             calls.append(('add_remote', name, url))
+        def remote_refs(self, remote, prefixes=()):
+            calls.append(('remote_refs', remote, tuple(prefixes)))
         def cmd(self, *a, **k):
             calls.append(('cmd', a))
             return ''
 
-    args = SimpleNamespace(name='n', expire='e', add_ignored=False, src_remote_name='origin',
+    args = SimpleNamespace(expire='e', add_ignored=False, src_remote_name='origin',
                            push_tag=True, push_note=True, rm_expired=True, flush_meta=True,
-                           remote='r')
+                           atomic=False, remote='r', remotes=['r'], jobs=4, from_tar=None,
+                           src_fsmonitor=False, src_commit_graph=False)
 
-    grb.push_command(args, DummyRb(), 'bin', '/p')
+    push.push_command(args, DummyRb(), 'bin', [('/p', 'n')])
 
     assert ('add_remote', 'bin', 'r') in calls
-    for op in ['push_branch', 'push_tag', 'note', 'rm_expired', 'flush_meta']:
+    # All remote refs needed are listed up front, in one go
+    assert ('remote_refs', 'bin', ('refs/heads/b', 'm', 'refs/tags/t', *push.expired_branch_prefixes(), *push.FLUSH_META_PREFIXES)) in calls
+    for op in ['push_branch', 'push_tag', 'note', ('clean', True, True)]:
         assert op in calls
+
+
+def test_push_command_atomic(monkeypatch):
+    calls = []
+
+    monkeypatch.setattr(push, 'sample_source', lambda *a: SimpleNamespace(fields={'src_tree_root': '/'}))
+    monkeypatch.setattr(push, 'create_artifact_commit', lambda r, name, *a, **k: {
+        'bin_branch_name': f'b-{name}',
+        'bin_ref_only_metadata': 'm',
+        'bin_tag_name': 't',
+    })
+    monkeypatch.setattr(push, 'push_atomic', lambda a, b, c, d: calls.append('push_atomic'))
+    monkeypatch.setattr(push, 'push_branch', lambda a, b, c, d: calls.append('push_branch'))
+    monkeypatch.setattr(push, 'push_tag', lambda a, b, c, d: calls.append('push_tag'))
+    monkeypatch.setattr(push, 'printer', SimpleNamespace(high_level=lambda *a, **k: None, detail=lambda *a, **k: None))
+
+    rbgit = SimpleNamespace(rbgit_dir='/r', rbgit_work_tree='/', cmd=lambda *a, **k: '',
+                            add_remote_idempotent=lambda name, url: None,
+                            remote_refs=lambda remote, prefixes=(): None)
+    args = SimpleNamespace(expire='e', add_ignored=False, src_remote_name='origin',
+                           push_tag=True, push_note=False, rm_expired=False, flush_meta=False,
+                           atomic=True, remote='r', remotes=['r'], jobs=4, from_tar=None,
+                           src_fsmonitor=False, src_commit_graph=False)
+
+    push.push_command(args, rbgit, 'bin', [('/p', 'n')])
+    assert calls == ['push_atomic']
+
+    # Several artifacts are always pushed atomically, and must not share a branch
+    args.atomic = False
+    push.push_command(args, rbgit, 'bin', [('/p', 'n'), ('/q', 'o')])
+    assert calls == ['push_atomic', 'push_atomic']
+    with pytest.raises(RuntimeError):
+        push.push_command(args, rbgit, 'bin', [('/p', 'n'), ('/p', 'n')])
+
+
+def test_push_command_remotes(monkeypatch):
+    """ Several remotes: Commit once, push to all at the same time, report each failure """
+    created, pushed, remotes = [], [], []
+    monkeypatch.setattr(push, 'sample_source', lambda *a: SimpleNamespace(fields={'src_tree_root': '/'}))
+    monkeypatch.setattr(push, 'create_artifact_commit', lambda *a, **k: created.append(a) or {'bin_branch_name': 'b'})
+    monkeypatch.setattr(push, 'printer', SimpleNamespace(high_level=lambda *a, **k: None, detail=lambda *a, **k: None, error=lambda *a, **k: None))
+
+    def fake_push_remote(args, ds, rbgit, name):
+        time.sleep(0.2)
+        if args.remote == 'bad':
+            raise RuntimeError('rejected')
+        pushed.append((name, args.remote))
+
+    monkeypatch.setattr(push, 'push_remote', fake_push_remote)
+    rbgit = SimpleNamespace(rbgit_dir='/r', rbgit_work_tree='/', cmd=lambda *a, **k: '', add_remote_idempotent=lambda name, url: remotes.append((name, url)))
+    args = SimpleNamespace(expire='e', add_ignored=False, src_remote_name='origin', from_tar=None,
+                           src_fsmonitor=False, src_commit_graph=False, remote='r1', remotes=['r1', 'r2', 'r3'], jobs=4)
+
+    start = time.monotonic()
+    assert push.push_command(args, rbgit, 'bin', [('/p', 'n')]) == 0
+    assert time.monotonic() - start < 0.5
+    assert len(created) == 1
+    assert remotes == [('bin', 'r1'), ('bin2', 'r2'), ('bin3', 'r3')]
+    assert sorted(pushed) == remotes
+    assert args.remote == 'r1'
+
+    pushed.clear()
+    args.remotes = ['r1', 'bad']
+    assert push.push_command(args, rbgit, 'bin', [('/p', 'n')]) == 1
+    assert pushed == [('bin', 'r1')]
@@ -0,0 +1,107 @@
+import sys
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+import push
+
+from conftest import git
+
+JOBS = 12  # Concurrent CI jobs publishing notes for the same artifact
+
+WORKER = """
+import sys
+from types import SimpleNamespace
+import push
+
+job = int(sys.argv[1])
+push.get_hostname = lambda: f"host{job}"
+push.NOTES_BACKOFF_S = 0.05
+args = SimpleNamespace(remote='https://bin', src_remote_name='origin', user_name=None, user_email=None)
+d = {'src_status': '', 'bin_time_commit': 't', 'bin_branch_expire': 'exp', 'bin_sha_commit': 'c' * 40, 'artifact_name_given': 'artifact'}
+push.note_append_push(args, [d])
+"""
+
+
+@pytest.fixture
+def origin(tmp_path, author_env):
+    origin, src = tmp_path / 'origin.git', tmp_path / 'src'
+    git("init", "-q", "--bare", "-b", "main", str(origin), cwd=tmp_path)
+    git("clone", "-q", str(origin), str(src), cwd=tmp_path)
+    git("commit", "-q", "--allow-empty", "-m", "src", cwd=src)
+    git("push", "-q", "origin", "HEAD:main", cwd=src)
+    return origin
+
+
+def clone(origin, name):
+    path = origin.parent / name
+    git("clone", "-q", str(origin), str(path), cwd=origin.parent)
+    return path
+
+
+def notes_ref():
+    return push.sanitize_branch_name(f"refs/notes/artifact/https:__bin/artifact/{'c' * 40}-clean")
+
+
+def test_notes_concurrent_jobs(origin):
+    """ Jobs racing to append to the same notes ref all end up in it, none is lost """
+    jobs = [subprocess.Popen([sys.executable, "-c", WORKER, str(job)], cwd=clone(origin, f"job{job}"),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            for job in range(JOBS)]
+    for job in jobs:
+        _, stderr = job.communicate(timeout=120)
+        assert job.returncode == 0, stderr
+
+    note = git("notes", f"--ref={notes_ref()}", "show", "main", cwd=origin)
+    hosts = sorted(line.split('"host":"')[1].split('"')[0] for line in note.splitlines() if line)
+    assert hosts == sorted(f"host{job}" for job in range(JOBS))
+
+
+def test_notes_rejected_then_merged(origin, monkeypatch):
+    """ A stale lease is rejected, then the remote's notes are merged and pushed with the fetched value as lease """
+    other = clone(origin, "other")
+    subprocess.run([sys.executable, "-c", WORKER, "1"], cwd=other, check=True, capture_output=True)
+
+    monkeypatch.chdir(clone(origin, "ours"))
+    monkeypatch.setattr(push, 'get_hostname', lambda: "host2")
+    monkeypatch.setattr(push, 'NOTES_BACKOFF_S', 0)
+    pushes = []
+    notes_push = push.notes_push
+    monkeypatch.setattr(push, 'notes_push', lambda remote, leases, env: pushes.append(dict(leases)) or notes_push(remote, leases, env))
+    args = SimpleNamespace(remote='https://bin', src_remote_name='origin', user_name=None, user_email=None)
+    push.note_append_push(args, [{'src_status': '', 'bin_time_commit': 't', 'bin_branch_expire': 'exp', 'bin_sha_commit': 'c' * 40, 'artifact_name_given': 'artifact'}])
+
+    theirs = git("rev-parse", f"{notes_ref()}", cwd=other)
+    assert pushes == [{notes_ref(): ""}, {notes_ref(): theirs}]
+    note = git("notes", f"--ref={notes_ref()}", "show", "main", cwd=origin)
+    assert '"host":"host1"' in note and '"host":"host2"' in note
+
+
+def test_notes_fetch_merge_missing(origin, monkeypatch):
+    """ A ref gone from the remote is expected absent, without losing the leases of the others """
+    other = clone(origin, "other")
+    subprocess.run([sys.executable, "-c", WORKER, "1"], cwd=other, check=True, capture_output=True)
+    monkeypatch.chdir(clone(origin, "ours"))
+
+    missing = "refs/notes/artifact/https:__bin/gone/" + "d" * 40 + "-clean"
+    leases = push.notes_fetch_merge("origin", [notes_ref(), missing], {})
+    assert leases == {notes_ref(): git("rev-parse", notes_ref(), cwd=other), missing: ""}
+    assert '"host":"host1"' in git("notes", f"--ref={notes_ref()}", "show", "HEAD", cwd=".")
+
+
+def test_notes_batched(monkeypatch):
+    """ Notes of several artifacts: One notes commit per ref, all refs pushed at once """
+    calls = []
+    monkeypatch.setattr(push, 'exec', lambda cmd, env=None: calls.append((cmd, env)) or '')
+    monkeypatch.setattr(push, 'exec_nostderr', lambda cmd, env=None: '')
+    args = SimpleNamespace(remote='https://bin', src_remote_name='origin', user_name=None, user_email=None)
+    d = {'src_status': '', 'bin_time_commit': 't', 'bin_branch_expire': 'exp', 'artifact_name_given': 'artifact'}
+    push.note_append_push(args, [d | {'bin_sha_commit': 'a' * 40}, d | {'bin_sha_commit': 'b' * 40}, d | {'bin_sha_commit': 'a' * 40}])
+
+    appends = [(cmd[3:], env['GIT_NOTES_REF']) for cmd, env in calls if cmd[:3] == ['git', 'notes', 'append']]
+    # One message per ref, a line per artifact
+    assert [len(message.splitlines()) for (flag, message, _), _ in appends] == [2, 1]
+    pushes = [cmd for cmd, _ in calls if cmd[:2] == ['git', 'push']]
+    assert len(pushes) == 1
+    assert [arg for arg in pushes[0] if arg.startswith('--force-with-lease')] == [f'--force-with-lease={ref}:' for _, ref in appends]
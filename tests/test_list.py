@@ -1,19 +1,22 @@
 from types import SimpleNamespace
 import list as list_mod
+from remote_refs import RemoteRefSnapshot
 
 
 def test_remote_artifacts(monkeypatch):
     # patch util.exec to return known sha
     monkeypatch.setattr(list_mod, 'exec', lambda cmd: 'abcd')
+    m1, m2 = 'a1' * 20, 'b2' * 20
 
-    def fake_cmd(*args, **kwargs):
-        if args[:3] == ('ls-remote', '--refs', 'remote'):
-            return 'm1 refs/artifact/meta-for-commit/abcd/sha1\nm2 refs/artifact/meta-for-commit/abcd/sha2\n'
-        raise AssertionError('unexpected')
+    def fake_ls_refs(remote, prefixes):
+        assert remote == 'remote'
+        assert prefixes == ['refs/artifact/meta-for-commit/abcd/']
+        return [(m1, 'refs/artifact/meta-for-commit/abcd/sha1'), (m2, 'refs/artifact/meta-for-commit/abcd/sha2')]
 
-    dummy = SimpleNamespace(cmd=fake_cmd)
-    res = list_mod.remote_artifacts(dummy, 'remote')
-    assert res == [('m1', 'sha1'), ('m2', 'sha2')]
+    dummy = SimpleNamespace(ls_refs=fake_ls_refs)
+    dummy.remote_refs = lambda remote: RemoteRefSnapshot(dummy, remote)
+    res = list(list_mod.remote_artifacts(dummy, 'remote'))
+    assert res == [(m1, 'sha1'), (m2, 'sha2')]
 
 
 def test_filter_artifacts_by_name_and_path(monkeypatch):
@@ -22,10 +25,13 @@ def test_filter_artifacts_by_name_and_path(monkeypatch):
         'm2': 'artifact-name: bar\nsrc-git-relpath: path2',
     }
 
-    def fake_fetch(remote, ref):
-        return msgs[ref]
+    fetches = []
 
-    dummy = SimpleNamespace(fetch_cat_pretty=lambda r, ref: fake_fetch(r, ref))
+    def fake_fetch_many(remote, refs):
+        fetches.append(refs)
+        return {ref: msgs[ref] for ref in refs}
+
+    dummy = SimpleNamespace(fetch_cat_pretty_many=fake_fetch_many)
     artifacts = [('m1', 'sha1'), ('m2', 'sha2')]
 
     filtered = list_mod.filter_artifacts(
@@ -37,3 +43,12 @@ def test_filter_artifacts_by_name_and_path(monkeypatch):
         dummy, 'r', 'path2', artifacts, list_mod.filter_funcs['path']
     )
     assert filtered == [('m2', 'sha2')]
+
+    # Meta-data of all candidates is fetched in one go per query
+    assert fetches == [['m1', 'm2'], ['m1', 'm2']]
+
+
+def test_filter_artifacts_all_fetches_nothing():
+    dummy = SimpleNamespace()
+    artifacts = [('m1', 'sha1'), ('m2', 'sha2')]
+    assert list(list_mod.filter_artifacts(dummy, 'r', None, artifacts, list_mod.filter_funcs['all'])) == artifacts
@@ -1,14 +1,21 @@
+import os
+import subprocess
+import tempfile
+import threading
+from types import SimpleNamespace
 import pytest
 
 from rbgit import RbGit
 
+from conftest import git
+
 class DummyRbGit:
-    def cmd(self, *args, **kwargs):
+    def stream(self, *args, **kwargs):
         if args[:2] == ("ls-tree", "-lr"):
-            return (
-                "100644 blob aaaaaa 123\tfile1\n"
-                "100644 blob bbbbbb 456\tfile2\n"
-            )
+            return iter([
+                "100644 blob aaaaaa 123\tfile1",
+                "100644 blob bbbbbb 456\tfile2",
+            ])
         raise RuntimeError("Unexpected command")
 
 def test_tree_size_sum():
@@ -17,44 +24,110 @@ def test_tree_size_sum():
     assert size == 579
 
 
-def test_remote_already_has_ref():
-    class D:
-        def cmd(self, *args):
-            if args[0] == 'ls-remote':
-                return 'sha\tref' if args[-1] == 'ref' else ''
-            raise RuntimeError('bad')
+class RefsDummy:
+    """ Lists refs from a dict of name -> sha, counting listings """
+    def __init__(self, refs):
+        self.refs = refs
+        self.snapshots = {}
+        self.listings = []
 
-    dummy = D()
+    def ls_refs(self, remote, prefixes):
+        self.listings.append(prefixes)
+        return [(sha, name) for name, sha in self.refs.items() if any(name.startswith(p) for p in prefixes)]
+
+    def remote_refs(self, remote, prefixes=()):
+        return RbGit.remote_refs(self, remote, prefixes)
+
+
+def test_remote_already_has_ref():
+    dummy = RefsDummy({'refs/heads/ref': 'a1' * 20})
     assert RbGit.remote_already_has_ref(dummy, 'origin', 'ref') is True
+    assert RbGit.remote_already_has_ref(dummy, 'origin', 'refs/heads/ref') is True
     assert RbGit.remote_already_has_ref(dummy, 'origin', 'missing') is False
 
 
 def test_fetch_current_tag_value():
+    dummy = RefsDummy({'refs/tags/v1': 'a1' * 20, 'refs/tags/v2': 'b2' * 20})
+    assert RbGit.fetch_current_tag_value(dummy, 'origin', 'v2') == 'b2' * 20
+    assert RbGit.fetch_current_tag_value(dummy, 'origin', 'v3') is None
+
+
+def test_remote_refs_shared_per_remote():
+    dummy = RefsDummy({'refs/heads/a': 'a1' * 20, 'refs/tags/t': 'b2' * 20})
+    snapshot = RbGit.remote_refs(dummy, 'origin', ['refs/heads/', 'refs/tags/'])
+    assert RbGit.remote_refs(dummy, 'origin') is snapshot
+    assert RbGit.remote_already_has_ref(dummy, 'origin', 'a') is True
+    assert RbGit.fetch_current_tag_value(dummy, 'origin', 't') == 'b2' * 20
+    assert dummy.listings == [['refs/heads/', 'refs/tags/']]
+
+
+def test_fetch_meta_for_commit():
+    calls = []
+
     class D:
-        def cmd(self, *args):
-            if args[:3] == ('ls-remote', '--tags', 'origin'):
-                return 'a1\trefs/tags/v1\nb2\trefs/tags/v2'
-            raise RuntimeError('bad')
+        meta_lock = threading.Lock()
 
-    dummy = D()
-    assert RbGit.fetch_current_tag_value(dummy, 'origin', 'v2') == 'b2'
+        def cmd(self, *args, **kwargs):
+            calls.append(args)
+            return "m1 refs/artifact/meta-for-commit/src/abc\n" if args[0] == 'for-each-ref' and args[-1].endswith('abc') else ''
 
+        def read_many(self, objs):
+            return {obj: {'m1': b'meta'}[obj] for obj in objs}
 
-def test_fetch_cat_pretty():
+    dummy = D()
+    dummy.fetch_meta_for_commits = lambda remote, shas: RbGit.fetch_meta_for_commits(dummy, remote, shas)
+    assert RbGit.fetch_meta_for_commit(dummy, 'origin', 'abc') == 'meta'
+    assert calls[0] == ('fetch', '--no-tags', 'origin', 'refs/artifact/meta-for-commit/*/abc:refs/artifact/meta-for-commit/*/abc')
+    assert RbGit.fetch_meta_for_commit(dummy, 'origin', 'none') == ''
+
+
+def test_fetch_meta_for_commits_concurrently(tmp_path):
+    """ Pushes to several remotes may compare tags at once, fetching into the same local refs """
+    printer = SimpleNamespace(debug=lambda *a, **k: None)
+    remote = tmp_path / 'remote.git'
+    git('init', '-q', '--bare', str(remote))
+    metas = {}
+    for i in range(20):
+        blob = git('--git-dir', str(remote), 'hash-object', '-w', '--stdin', input=f'meta {i}')
+        sha = f'{i:040x}'
+        git('--git-dir', str(remote), 'update-ref', f'refs/artifact/meta-for-commit/src/{sha}', blob)
+        metas[sha] = f'meta {i}'
+
+    rbgit = RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path))
+    names = [f'bin{i}' for i in range(6)]
+    for name in names:
+        rbgit.add_remote_idempotent(name=name, url=str(remote))
+    results = {}
+    threads = [threading.Thread(target=lambda name=name: results.__setitem__(name, rbgit.fetch_meta_for_commits(name, list(metas)))) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rbgit.close()
+    assert results == {name: metas for name in names}
+
+
+def test_fetch_cat_pretty(tmp_path):
     calls = []
+    (tmp_path / 'FETCH_HEAD').write_text("abc123\t\t'ref' of origin\n")
 
     class D:
+        rbgit_dir = str(tmp_path)
+
         def cmd(self, *args, **kwargs):
             calls.append(args)
             if args[0] == 'fetch':
                 return ''
-            if args[:2] == ('cat-file', '-p'):
-                return 'content'
             raise RuntimeError('bad')
 
+        def read_object(self, obj):
+            calls.append(('read_object', obj))
+            return b'content'
+
     dummy = D()
+    dummy.fetch_head = lambda: RbGit.fetch_head(dummy)
     res = RbGit.fetch_cat_pretty(dummy, 'origin', 'ref')
-    assert calls[0] == ('fetch', 'origin', 'ref')
+    assert calls == [('fetch', 'origin', 'ref'), ('read_object', 'abc123')]
     assert res == 'content'
 
 
@@ -137,3 +210,121 @@ def test_fetch_only_tags_and_set_tag():
     RbGit.set_tag(dummy, 'v1', 'sha')
     assert ('fetch', 'origin', 'refs/tags/*:refs/tags/*') in calls
     assert ('tag', '--force', 'v1', 'sha') in calls
+
+
+def test_fetch_cat_pretty_many():
+    calls = []
+
+    class D:
+        def cmd(self, *args, **kwargs):
+            calls.append(args)
+            if args[0] == 'fetch':
+                return ''
+            raise RuntimeError('bad')
+
+        def read_many(self, objs):
+            calls.append(('read_many', objs))
+            return {'m1': b'foo', 'm3': b'b\xc3\xa6r\n'}
+
+    res = RbGit.fetch_cat_pretty_many(D(), 'origin', ['m1', 'm2', 'm3'])
+    assert calls == [('fetch', 'origin', 'm1', 'm2', 'm3'), ('read_many', ['m1', 'm2', 'm3'])]
+    assert res == {'m1': 'foo', 'm3': 'bær\n'}
+
+
+def test_fetch_cat_pretty_many_empty():
+    class D:
+        def cmd(self, *args, **kwargs):
+            raise RuntimeError('no commands expected')
+
+    assert RbGit.fetch_cat_pretty_many(D(), 'origin', []) == {}
+
+
+def test_commit_path(tmp_path, monkeypatch, author_env):
+    monkeypatch.chdir(tmp_path)
+    for name in ('a', 'b'):
+        (tmp_path / 'obj' / name).mkdir(parents=True)
+        (tmp_path / 'obj' / name / 'file').write_text(name)
+    printer = type('P', (), {'debug': lambda *a, **k: None})()
+    rbgit = RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path))
+    dates = {'GIT_AUTHOR_DATE': 'Thu, 27 Jul 2023 13:15:26 +0200', 'GIT_COMMITTER_DATE': 'Thu, 27 Jul 2023 13:15:26 +0200'}
+
+    # Side by side, without checking out
+    a, changes = rbgit.commit_path('artifact/a', 'obj/a', 'a\n\n\n', env=dates)
+    assert changes
+    b, _ = rbgit.commit_path('artifact/b', 'obj/b', 'b', env=dates)
+    assert rbgit.cmd('ls-tree', '-r', '--name-only', a).split() == ['obj/a/file']
+    assert rbgit.cmd('ls-tree', '-r', '--name-only', b).split() == ['obj/b/file']
+    assert rbgit.cmd('rev-parse', 'refs/heads/artifact/a').strip() == a
+    assert rbgit.cmd('log', '-1', '--format=%B', a) == 'a\n\n'  # Cleaned up like `git commit`
+    with pytest.raises(RuntimeError):
+        rbgit.cmd('rev-parse', '--verify', 'HEAD')
+    assert rbgit.cmd('ls-files') == ''
+
+    # Same content again: Nothing to commit
+    assert rbgit.commit_path('artifact/a', 'obj/a', 'a', env=dates) == (a, False)
+
+    # Changed content: Committed on top
+    (tmp_path / 'obj' / 'a' / 'file').write_text('changed')
+    a2, changes = rbgit.commit_path('artifact/a', 'obj/a', 'a', env=dates)
+    assert changes
+    assert rbgit.cmd('rev-parse', f'{a2}^').strip() == a
+
+    # Reproducible
+    other = RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit2'), rbgit_work_tree=str(tmp_path))
+    assert other.commit_path('artifact/b', 'obj/b', 'b', env=dates) == (b, True)
+
+
+def test_stream(tmp_path, monkeypatch):
+    printer = type('P', (), {'debug': lambda *a, **k: None})()
+    rbgit = RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path))
+    blobs = [rbgit.cmd('hash-object', '-w', '--stdin', input=f'{i}\n' * 100000).strip() for i in range(3)]
+    tree = rbgit.cmd('mktree', input=''.join(f'100644 blob {blob}\tf{i}\n' for i, blob in enumerate(blobs))).strip()
+
+    assert list(rbgit.stream('ls-tree', '--name-only', tree)) == ['f0', 'f1', 'f2']
+    assert list(rbgit.stream('ls-tree', '--name-only', '-z', tree, sep=b'\0')) == [b'f0', b'f1', b'f2']
+    # Records spanning many reads
+    assert sum(1 for _ in rbgit.stream('cat-file', 'blob', blobs[1])) == 100000
+    assert rbgit.tree_size(tree) == 3 * 200000
+
+    with pytest.raises(RuntimeError, match='not a tree object'):
+        list(rbgit.stream('ls-tree', 'f' * 40))
+
+    # Stopping early kills the command, and raises nothing
+    procs = []
+    popen = subprocess.Popen
+    monkeypatch.setattr(subprocess, 'Popen', lambda *a, **k: procs.append(popen(*a, **k)) or procs[-1])
+    lines = rbgit.stream('cat-file', 'blob', blobs[0])
+    assert next(lines) == '0'
+    lines.close()
+    assert procs[0].returncode is not None
+
+
+def test_ssh_multiplex(tmp_path, monkeypatch):
+    monkeypatch.delenv('GIT_SSH_COMMAND', raising=False)
+    monkeypatch.delenv('GIT_SSH', raising=False)
+    printer = SimpleNamespace(debug=lambda *a, **k: None)
+
+    monkeypatch.setattr(tempfile, 'tempdir', '/tmp')
+    with RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path), ssh_multiplex=True) as rbgit:
+        control_dir = rbgit.ssh_control_dir
+        assert oct(os.stat(control_dir).st_mode & 0o777) == '0o700'
+        assert f"ControlPath={control_dir}/%C" in rbgit.env()['GIT_SSH_COMMAND']
+        assert 'GIT_SSH_COMMAND' not in os.environ  # Ours alone, not of other code in the process
+    assert 'GIT_SSH_COMMAND' not in rbgit.env()
+    assert not os.path.exists(control_dir)
+
+    # Too deep for a socket path
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / ('d' * 100)))
+    os.mkdir(tempfile.tempdir)
+    with RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path), ssh_multiplex=True) as rbgit:
+        assert rbgit.ssh_control_dir is None and 'GIT_SSH_COMMAND' not in rbgit.env()
+    assert os.listdir(tempfile.tempdir) == []
+
+    # Ssh configured for git already: Left as is
+    with RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path)) as rbgit:
+        rbgit.cmd("config", "--local", "core.sshCommand", "ssh -i key")
+        rbgit.multiplex_ssh()
+        assert rbgit.ssh_control_dir is None and 'GIT_SSH_COMMAND' not in rbgit.env()
+    monkeypatch.setenv('GIT_SSH_COMMAND', 'ssh -F config')
+    with RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path), ssh_multiplex=True) as rbgit:
+        assert rbgit.ssh_control_dir is None and rbgit.env()['GIT_SSH_COMMAND'] == 'ssh -F config'
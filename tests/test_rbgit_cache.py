@@ -0,0 +1,58 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from rbgit import RbGit
+
+
+@pytest.fixture
+def rbgit(tmp_path, author_env):
+    printer = SimpleNamespace(debug=lambda *a, **k: None, high_level=lambda *a, **k: None)
+    return lambda budget: RbGit(printer, rbgit_dir=str(tmp_path / '.rbgit'), rbgit_work_tree=str(tmp_path), cache_budget=budget)
+
+
+def commit_random(rbgit, ref, size):
+    """ Commit of one incompressible file, referenced by ref """
+    blob = rbgit.cmd("hash-object", "-w", "--stdin", input=os.urandom(size), text=False).decode().strip()
+    tree = rbgit.cmd("mktree", input=f"100644 blob {blob}\tfile\n").strip()
+    commit = rbgit.cmd("commit-tree", tree, "-m", ref).strip()
+    rbgit.cmd("update-ref", ref, commit)
+    return commit
+
+
+def test_cache_survives_and_evicts_lru(rbgit, tmp_path):
+    first = rbgit(10**9)
+    commit_random(first, 'refs/heads/old', 300_000)
+    first.cache.touch('refs/heads/old')
+    assert first.cache.evict() == []
+
+    # Next invocation: Same repo, same objects, usage remembered
+    second = rbgit(500_000)
+    assert second.cache.used.keys() == {'refs/heads/old'}
+    assert second.has_object('refs/heads/old')
+    commit_random(second, 'refs/heads/new', 300_000)
+    second.cache.touch('refs/heads/new')
+
+    # Over budget: Least recently used goes, and its objects with it
+    assert second.cache.evict() == ['refs/heads/old']
+    assert second.cmd("for-each-ref", "--format=%(refname)").split() == ['refs/heads/new']
+    assert second.cache.size() < 500_000
+    assert second.cmd("config", "core.logAllRefUpdates").strip() == 'false'
+
+
+def test_cache_keeps_refs_used_now(rbgit):
+    cached = rbgit(1000)
+    commit_random(cached, 'refs/heads/a', 300_000)
+    cached.cache.touch('refs/heads/a')
+    assert cached.cache.evict() == []
+    assert cached.has_object('refs/heads/a')
+
+
+def test_cache_keep(rbgit):
+    cached = rbgit(10**9)
+    commit = commit_random(cached, 'refs/heads/a', 10)
+    cached.cmd("update-ref", "-d", "refs/heads/a")
+    cached.cache.keep(commit)
+    assert cached.cmd("rev-parse", f"refs/gitrb/cache/{commit}").strip() == commit
+    assert f"refs/gitrb/cache/{commit}" in cached.cache.touched
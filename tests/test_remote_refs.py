@@ -0,0 +1,191 @@
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import remote_refs
+from remote_refs import RemoteRefSnapshot, minimal_prefixes, upload_pack_argv, ls_refs
+
+from conftest import git
+
+
+class Lister:
+    """ Lists refs from a dict of name -> sha, counting listings """
+    def __init__(self, refs):
+        self.refs = refs
+        self.listings = []
+
+    def ls_refs(self, remote, prefixes):
+        self.listings.append(prefixes)
+        return [(sha, name) for name, sha in self.refs.items() if any(name.startswith(p) for p in prefixes)]
+
+
+def test_minimal_prefixes():
+    assert minimal_prefixes(["refs/tags/a", "refs/heads/", "refs/heads/x", "refs/tags/a"]) == ["refs/heads/", "refs/tags/a"]
+
+
+def test_snapshot_lists_once():
+    lister = Lister({'refs/heads/b': '1' * 40, 'refs/heads/a': '2' * 40, 'refs/tags/t': '3' * 40, 'refs/notes/n': '4' * 40})
+    snapshot = RemoteRefSnapshot(lister, 'remote')
+    snapshot.ensure(['refs/heads/', 'refs/tags/'])
+
+    assert list(snapshot.items('refs/heads/')) == [('refs/heads/a', '2' * 40), ('refs/heads/b', '1' * 40)]
+    assert snapshot.get('refs/tags/t') == '3' * 40
+    assert snapshot.get('refs/tags/missing') is None
+    assert snapshot.has('a') and not snapshot.has('c')
+    assert len(snapshot) == 3
+    assert lister.listings == [['refs/heads/', 'refs/tags/']]
+
+    # Uncovered queries extend the snapshot by listing only what is missing
+    assert snapshot.get('refs/notes/n') == '4' * 40
+    assert lister.listings[1:] == [['refs/notes/n']]
+    assert len(snapshot) == 4
+
+
+def test_snapshot_local_updates():
+    lister = Lister({'refs/heads/a': '1' * 40})
+    snapshot = RemoteRefSnapshot(lister, 'remote')
+    snapshot.ensure(['refs/heads/'])
+
+    snapshot.set('refs/heads/b', '2' * 40)
+    snapshot.set('refs/heads/a', '3' * 40)
+    assert list(snapshot.items('refs/heads/')) == [('refs/heads/a', '3' * 40), ('refs/heads/b', '2' * 40)]
+
+    snapshot.remove_many(['refs/heads/a'])
+    assert list(snapshot.items('refs/heads/')) == [('refs/heads/b', '2' * 40)]
+
+    # Refs we updated ourselves are known, without listing
+    snapshot.set('refs/tags/t', '4' * 40)
+    assert snapshot.get('refs/tags/t') == '4' * 40
+    assert lister.listings == [['refs/heads/']]
+
+    # Several updates are recorded at once, in any order
+    snapshot.set_many({'refs/heads/c': '5' * 40, 'refs/heads/b': '6' * 40, 'refs/notes/n': '7' * 40})
+    assert list(snapshot.items('refs/heads/')) == [('refs/heads/b', '6' * 40), ('refs/heads/c', '5' * 40)]
+    assert snapshot.get('refs/notes/n') == '7' * 40
+    assert lister.listings == [['refs/heads/']]
+
+
+def test_snapshot_prefix_bisect():
+    refs = {f'refs/heads/artifact/expire/{i:06}': f'{i:040x}' for i in range(10000)}
+    snapshot = RemoteRefSnapshot(Lister(refs), 'remote')
+    snapshot.ensure(['refs/heads/'])
+    assert [ref for ref, _ in snapshot.items('refs/heads/artifact/expire/00999')] == ['refs/heads/artifact/expire/009990', *[f'refs/heads/artifact/expire/00999{i}' for i in range(1, 10)]]
+    assert snapshot.get('refs/heads/artifact/expire/001234') == f'{1234:040x}'
+
+
+def test_upload_pack_argv(tmp_path, monkeypatch):
+    monkeypatch.delenv('GIT_SSH_COMMAND', raising=False)
+    monkeypatch.delenv('GIT_SSH', raising=False)
+
+    def cmd(*args):
+        raise RuntimeError('not configured')
+    rbgit = SimpleNamespace(cmd=cmd, ssh_env={})
+
+    assert upload_pack_argv(rbgit, str(tmp_path)) == ['git', 'upload-pack', str(tmp_path)]
+    assert upload_pack_argv(rbgit, f'file://{tmp_path}') == ['git', 'upload-pack', str(tmp_path)]
+    assert upload_pack_argv(rbgit, 'git@host:group/repo.git') == ['ssh', '-o', 'SendEnv=GIT_PROTOCOL', 'git@host', "git-upload-pack 'group/repo.git'"]
+    assert upload_pack_argv(rbgit, 'ssh://git@host:2222/repo.git') == ['ssh', '-o', 'SendEnv=GIT_PROTOCOL', '-p', '2222', 'git@host', "git-upload-pack '/repo.git'"]
+    assert upload_pack_argv(rbgit, 'https://host/repo.git') is None
+
+    monkeypatch.setenv('GIT_SSH', 'plink')
+    assert upload_pack_argv(rbgit, 'git@host:repo.git') is None
+
+
+@pytest.fixture
+def bare_remote(tmp_path, author_env):
+    remote = tmp_path / 'remote.git'
+    git('init', '-q', '--bare', str(remote))
+    tree = git('--git-dir', str(remote), 'hash-object', '-t', 'tree', '-w', '/dev/null')  # empty tree
+    commit = git('--git-dir', str(remote), 'commit-tree', tree, '-m', 'c')
+    for ref in ('refs/heads/main', 'refs/heads/artifact/expire/2020-01-01/x', 'refs/tags/artifact/latest/x', 'refs/artifact/meta-for-commit/a/b'):
+        git('--git-dir', str(remote), 'update-ref', ref, commit)
+    return remote, commit
+
+
+def test_ls_refs_v2_server_side_prefix(bare_remote, monkeypatch):
+    remote, commit = bare_remote
+    fallback = []
+    monkeypatch.setattr(remote_refs, 'ls_refs_fallback', lambda *a: fallback.append(a))
+    rbgit = SimpleNamespace(cmd=lambda *a: str(remote), ssh_env={}, printer=SimpleNamespace(debug=lambda *a, **k: None))
+
+    refs = list(ls_refs(rbgit, 'recyclebin', ['refs/heads/artifact/', 'refs/artifact/']))
+    assert refs == [(commit, 'refs/artifact/meta-for-commit/a/b'), (commit, 'refs/heads/artifact/expire/2020-01-01/x')]
+    assert fallback == []
+
+
+def test_ls_refs_fallback(bare_remote):
+    remote, commit = bare_remote
+
+    def stream(*args):
+        assert args == ('ls-remote', '--tags', 'recyclebin')
+        return iter(git('ls-remote', '--tags', str(remote)).splitlines())
+
+    refs = list(remote_refs.ls_refs_fallback(SimpleNamespace(stream=stream), 'recyclebin', ['refs/tags/artifact/']))
+    assert refs == [(commit, 'refs/tags/artifact/latest/x')]
+
+    # Annotated tags come with the commit they point to
+    git('--git-dir', str(remote), 'tag', '-a', '-m', 'annotated', 'artifact/annotated', commit)
+    tag = git('--git-dir', str(remote), 'rev-parse', 'refs/tags/artifact/annotated')
+    refs = list(remote_refs.ls_refs_fallback(SimpleNamespace(stream=stream), 'recyclebin', ['refs/tags/artifact/']))
+    assert refs == [(tag, 'refs/tags/artifact/annotated'), (commit, 'refs/tags/artifact/annotated^{}'), (commit, 'refs/tags/artifact/latest/x')]
+
+
+def test_ls_refs_v2_peeled(bare_remote, monkeypatch):
+    remote, commit = bare_remote
+    git('--git-dir', str(remote), 'tag', '-a', '-m', 'annotated', 'artifact/annotated', commit)
+    tag = git('--git-dir', str(remote), 'rev-parse', 'refs/tags/artifact/annotated')
+    monkeypatch.setattr(remote_refs, 'ls_refs_fallback', lambda *a: pytest.fail('fell back'))
+    rbgit = SimpleNamespace(cmd=lambda *a: str(remote), ssh_env={}, printer=SimpleNamespace(debug=lambda *a, **k: None))
+
+    snapshot = RemoteRefSnapshot(SimpleNamespace(ls_refs=lambda remote, prefixes: ls_refs(rbgit, remote, prefixes)), 'recyclebin')
+    assert list(snapshot.items('refs/tags/')) == [('refs/tags/artifact/annotated', tag), ('refs/tags/artifact/annotated^{}', commit),
+                                                  ('refs/tags/artifact/latest/x', commit)]
+    # Replaced by a tag of ours, which is not annotated
+    snapshot.set('refs/tags/artifact/annotated', commit)
+    assert list(snapshot.items('refs/tags/')) == [('refs/tags/artifact/annotated', commit), ('refs/tags/artifact/latest/x', commit)]
+
+
+def test_ls_refs_v0_server_large_advertisement():
+    # A v0 server advertises more refs than a pipe holds, then waits for our wants
+    server = ("import sys\n"
+              "line = lambda s: f'{len(s) + 4:04x}{s}'.encode()\n"
+              "for i in range(5000): sys.stdout.buffer.write(line(f'{i:040x} refs/heads/artifact/expire/{i:06}\\n'))\n"
+              "sys.stdout.buffer.write(b'0000'); sys.stdout.flush(); sys.stdin.read()\n")
+    argv = [sys.executable, '-c', server]
+    rbgit = SimpleNamespace(ssh_env={}, printer=SimpleNamespace(debug=lambda *a, **k: None))
+
+    start = time.monotonic()
+    refs = list(remote_refs.ls_refs_v2(rbgit, argv, ['refs/heads/artifact/expire/00499']))
+    assert refs == [(f'{i:040x}', f'refs/heads/artifact/expire/{i:06}') for i in range(4990, 5000)]
+    assert time.monotonic() - start < 10
+
+
+def test_ls_refs_v0_server(bare_remote, monkeypatch):
+    remote, commit = bare_remote
+    git('--git-dir', str(remote), 'tag', '-a', '-m', 'annotated', 'artifact/annotated', commit)
+    tag = git('--git-dir', str(remote), 'rev-parse', 'refs/tags/artifact/annotated')
+    # Real upload-pack, not told to speak v2
+    v0 = ("import os, subprocess\n"
+          "env = {k: v for k, v in os.environ.items() if k != 'GIT_PROTOCOL'}\n"
+          f"subprocess.run(['git', 'upload-pack', {str(remote)!r}], env=env, check=True)\n")
+    monkeypatch.setattr(remote_refs, 'upload_pack_argv', lambda rbgit, url: [sys.executable, '-c', v0])
+    monkeypatch.setattr(remote_refs, 'ls_refs_fallback', lambda *a: pytest.fail('fell back'))
+    rbgit = SimpleNamespace(cmd=lambda *a: str(remote), ssh_env={}, printer=SimpleNamespace(debug=lambda *a, **k: None))
+
+    assert list(ls_refs(rbgit, 'recyclebin', ['refs/tags/'])) == [(tag, 'refs/tags/artifact/annotated'), (commit, 'refs/tags/artifact/annotated^{}'),
+                                                                 (commit, 'refs/tags/artifact/latest/x')]
+    assert list(ls_refs(rbgit, 'recyclebin', ['refs/heads/main'])) == [(commit, 'refs/heads/main')]
+
+
+def test_ls_refs_v2_chatty_stderr(bare_remote, monkeypatch):
+    remote, commit = bare_remote
+    # Server writing more to stderr than a pipe holds, before it answers
+    chatty = ("import subprocess, sys\n"
+              "sys.stderr.write('x' * 200000); sys.stderr.flush()\n"
+              f"subprocess.run(['git', 'upload-pack', {str(remote)!r}])\n")
+    monkeypatch.setattr(remote_refs, 'upload_pack_argv', lambda rbgit, url: [sys.executable, '-c', chatty])
+    rbgit = SimpleNamespace(cmd=lambda *a: str(remote), ssh_env={}, printer=SimpleNamespace(debug=lambda *a, **k: None))
+
+    assert list(ls_refs(rbgit, 'recyclebin', ['refs/tags/'])) == [(commit, 'refs/tags/artifact/latest/x')]
@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import pytest
+
+from conftest import git
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# Stand-in for ssh: Runs the remote command locally, after the latency of setting up a connection,
+# logging each connection. Named ssh so it's taken for OpenSSH, by git and by us.
+SSH_SHIM = """#!/bin/sh
+while [ $# -gt 2 ]; do shift; done  # Options, e.g. -o SendEnv=GIT_PROTOCOL -p 22
+echo "$2" >> "$GITRB_TEST_SSH_LOG"
+sleep "$GITRB_TEST_SSH_LATENCY"
+exec sh -c "$2"
+"""
+LATENCY = 0.05  # Seconds per connection
+
+# Stand-in for OpenSSH with connection sharing: The first connection through a ControlPath socket
+# makes a handshake, later ones reuse it until told to exit. Logs handshakes apart from connections.
+SSH_MULTIPLEX_SHIM = """#!/bin/sh
+control=""; op=""
+while [ $# -gt 2 ]; do
+    case "$1" in
+        -o) case "$2" in ControlPath=*) control="${2#ControlPath=}";; esac; shift 2;;
+        -O|-p) [ "$1" = "-O" ] && op="$2"; shift 2;;
+        *) shift;;
+    esac
+done
+socket="$control"
+case "$control" in *%C) socket="${control%'%C'}$(printf %s "$1" | cksum | cut -d' ' -f1)";; esac
+if [ "$op" = "exit" ]; then
+    rm "$socket"; echo "exit" >> "$GITRB_TEST_SSH_HANDSHAKES"; exit 0
+fi
+echo "$2" >> "$GITRB_TEST_SSH_LOG"
+if [ -z "$control" ] || [ ! -e "$socket" ]; then
+    echo "handshake" >> "$GITRB_TEST_SSH_HANDSHAKES"
+    sleep "$GITRB_TEST_SSH_LATENCY"
+    [ -n "$control" ] && touch "$socket"
+fi
+exec sh -c "$2"
+"""
+
+
+class LatentRemote:
+    """ Bare bin repo behind an ssh:// URL whose connections are slow and counted """
+
+    def __init__(self, tmp_path, src):
+        self.src = src
+        self.log = tmp_path / "connections.log"
+        self.path = tmp_path / "bin.git"
+        self.url = f"ssh://latent.example{self.path}"
+        git("init", "-q", "--bare", str(self.path), cwd=tmp_path)
+        shim = tmp_path / "shim" / "ssh"
+        shim.parent.mkdir()
+        shim.write_text(SSH_SHIM)
+        shim.chmod(0o755)
+        self.env = os.environ | {
+            "GIT_SSH": str(shim), "GIT_SSH_VARIANT": "ssh",
+            "GITRB_TEST_SSH_LOG": str(self.log), "GITRB_TEST_SSH_LATENCY": str(LATENCY),
+        }
+
+    def connections(self) -> list[str]:
+        """ Services connected to so far, e.g. ['git-upload-pack', 'git-receive-pack'] """
+        if not self.log.exists():
+            return []
+        return [line.split(" ")[0] for line in self.log.read_text().splitlines()]
+
+    def run(self, *args) -> tuple[str, list[str]]:
+        """ Run the CLI on this remote. Returns its output and the connections it made """
+        self.log.unlink(missing_ok=True)
+        result = subprocess.run([sys.executable, os.path.join(SRC, "git_recycle_bin.py"), *args, "--color=false"],
+                                cwd=self.src, env=self.env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        return result.stdout + result.stderr, self.connections()
+
+
+@pytest.fixture
+def remote(tmp_path, author_env):
+    """ Source repo with a built artifact at obj/, and a latent bin remote """
+    origin, src = tmp_path / 'origin.git', tmp_path / 'src'
+    git("init", "-q", "--bare", "-b", "main", str(origin), cwd=tmp_path)
+    git("clone", "-q", str(origin), str(src), cwd=tmp_path)
+    git("checkout", "-q", "-b", "main", cwd=src)
+    (src / '.gitignore').write_text('obj/\n')
+    git("add", ".gitignore", cwd=src)
+    git("commit", "-q", "-m", "src", cwd=src)
+    git("push", "-q", "-u", "origin", "main", cwd=src)
+    (src / 'obj').mkdir()
+    (src / 'obj' / 'a.bin').write_bytes(os.urandom(1000))
+    return LatentRemote(tmp_path, src)
+
+
+def push(remote, *args):
+    out, connections = remote.run("push", remote.url, "--path", "obj", "--name", "a", "--add-ignored", *args)
+    return re.search(r"Artifact commit: ([0-9a-f]{40})", out).group(1), connections
+
+
+# Round-trip budgets: Connections each command may open to the remote, in order.
+# Raise a budget only knowingly, each connection costs a round trip or more in production.
+UPLOAD, RECEIVE = "git-upload-pack", "git-receive-pack"
+
+
+@pytest.mark.parametrize("args, budget", [
+    ([],                              [UPLOAD, RECEIVE, RECEIVE]),  # Branch before its metadata
+    (["--tag"],                       [UPLOAD, RECEIVE, RECEIVE, RECEIVE]),
+    (["--atomic"],                    [UPLOAD, RECEIVE]),
+    (["--tag", "--atomic"],           [UPLOAD, RECEIVE]),
+    (["--rm-expired", "--flush-meta"], [UPLOAD, RECEIVE, RECEIVE]),  # Nothing to clean, so no extra push
+])
+def test_push_round_trips(remote, args, budget):
+    _, connections = push(remote, *args)
+    assert connections == budget
+
+    # Already on the remote: One listing tells so. A tag also needs the metadata of the artifact it points at
+    _, connections = push(remote, *args)
+    assert connections == ([UPLOAD, UPLOAD] if "--tag" in args else [UPLOAD])
+
+
+def test_push_many_round_trips(remote):
+    """ Artifacts of one build share the listing and the push """
+    (remote.src / 'obj' / 'docs').mkdir()
+    (remote.src / 'obj' / 'docs' / 'index.html').write_text("docs")
+    out, connections = remote.run("push", remote.url, "--path", "obj/a.bin", "--name", "a", "--path", "obj/docs", "--name", "docs", "--add-ignored", "--tag")
+    assert connections == [UPLOAD, RECEIVE]
+    assert len(set(re.findall(r"Artifact commit: ([0-9a-f]{40})", out))) == 2
+
+
+def test_push_remotes_round_trips(remote, tmp_path):
+    """ Each remote costs the same as alone; they are pushed to side by side """
+    other = tmp_path / "other.git"
+    git("init", "-q", "--bare", str(other), cwd=tmp_path)
+    out, connections = remote.run("push", remote.url, f"ssh://latent.example{other}", "--path", "obj", "--name", "a", "--add-ignored", "--atomic")
+    assert sorted(connections) == sorted([UPLOAD, RECEIVE] * 2)
+    sha = re.search(r"Artifact commit: ([0-9a-f]{40})", out).group(1)
+    for bare in (remote.path, other):
+        assert sha in git("for-each-ref", "--format=%(objectname)", "refs/heads/", cwd=bare)
+
+
+def test_push_force_tag_round_trips(remote):
+    push(remote, "--tag", "--atomic")
+    (remote.src / 'obj' / 'b.bin').write_bytes(b"changed")
+    _, connections = push(remote, "--tag", "--atomic", "--force-branch", "--force-tag")
+    assert connections == [UPLOAD, UPLOAD, RECEIVE]
+
+
+def test_read_round_trips(remote):
+    sha, _ = push(remote)
+    assert remote.run("list", remote.url)[1] == [UPLOAD]
+    # Filters fetch the metadata of listed artifacts
+    assert remote.run("list", remote.url, "--name", "a")[1] == [UPLOAD, UPLOAD]
+    assert remote.run("list", remote.url, "--path", "obj")[1] == [UPLOAD, UPLOAD]
+    assert remote.run("download", remote.url, sha, "--force")[1] == [UPLOAD]
+
+
+def test_clean_round_trips(remote):
+    push(remote, "--expire", "2 days ago")
+    assert remote.run("clean", remote.url)[1] == [UPLOAD, RECEIVE]
+    # Nothing left to delete
+    assert remote.run("clean", remote.url)[1] == [UPLOAD]
+
+
+def test_latency_is_felt(remote):
+    """ The stand-in really is slow, so chatter shows in wall time too """
+    start = time.monotonic()
+    _, connections = remote.run("list", remote.url)
+    assert time.monotonic() - start >= LATENCY * len(connections)
+
+
+@pytest.fixture
+def multiplexed(remote, tmp_path):
+    """ The latent remote, reached through `ssh` on PATH which shares connections like OpenSSH's ControlMaster """
+    shim = tmp_path / "multiplex" / "ssh"
+    shim.parent.mkdir()
+    shim.write_text(SSH_MULTIPLEX_SHIM)
+    shim.chmod(0o755)
+    remote.tmpdir = tempfile.mkdtemp(dir="/tmp")  # Where our control sockets go, short enough to hold them
+    remote.handshakes = tmp_path / "handshakes.log"
+    remote.env = {k: v for k, v in remote.env.items() if k not in ("GIT_SSH", "GIT_SSH_VARIANT", "GIT_SSH_COMMAND")} | {
+        "PATH": f"{shim.parent}{os.pathsep}{os.environ['PATH']}",
+        "TMPDIR": remote.tmpdir,
+        "GITRB_TEST_SSH_HANDSHAKES": str(remote.handshakes),
+    }
+    yield remote
+    shutil.rmtree(remote.tmpdir)
+
+
+def handshakes(remote) -> list[str]:
+    lines = remote.handshakes.read_text().splitlines() if remote.handshakes.exists() else []
+    remote.handshakes.unlink(missing_ok=True)
+    return lines
+
+
+def test_ssh_multiplexed(multiplexed):
+    """ One handshake per run, however many connections; the master is stopped at the end """
+    _, connections = push(multiplexed, "--tag")
+    assert connections == [UPLOAD, RECEIVE, RECEIVE, RECEIVE]
+    assert handshakes(multiplexed) == ["handshake", "exit"]
+    assert os.listdir(multiplexed.tmpdir) == []
+
+    _, connections = multiplexed.run("list", multiplexed.url, "--name", "a")
+    assert connections == [UPLOAD, UPLOAD]
+    assert handshakes(multiplexed) == ["handshake", "exit"]
+
+
+def test_ssh_multiplex_opt_out(multiplexed):
+    _, connections = push(multiplexed, "--tag", "--ssh-multiplex=false")
+    assert handshakes(multiplexed) == ["handshake"] * len(connections)
+
+    # Users who configure ssh themselves keep their own
+    multiplexed.env["GIT_SSH_COMMAND"] = "ssh"
+    _, connections = push(multiplexed, "--force-branch")
+    assert handshakes(multiplexed) == ["handshake"] * len(connections)
+
+
+def test_ssh_multiplex_deep_tmpdir(multiplexed, tmp_path):
+    """ Sockets can't be made in a directory too deep, so connections aren't shared there """
+    deep = tmp_path / ("d" * 60)
+    deep.mkdir()
+    multiplexed.env["TMPDIR"] = str(deep)
+    _, connections = push(multiplexed, "--tag")
+    assert handshakes(multiplexed) == ["handshake"] * len(connections)
+    assert os.listdir(deep) == []
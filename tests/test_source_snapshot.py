@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from source_snapshot import SourceSnapshot, parse_track
+
+from conftest import git
+
+
+@pytest.fixture
+def src(tmp_path, monkeypatch, author_env):
+    """ Clone whose main is 2 commits ahead and 1 behind its upstream """
+    monkeypatch.setenv('GIT_AUTHOR_DATE', 'Thu, 27 Jul 2023 13:15:26 +0200')
+    origin, src = tmp_path / 'origin.git', tmp_path / 'src'
+    git("init", "-q", "--bare", "-b", "main", str(origin), cwd=tmp_path)
+    git("clone", "-q", str(origin), str(src), cwd=tmp_path)
+    git("checkout", "-q", "-b", "main", cwd=src)
+    git("commit", "-q", "--allow-empty", "-m", "base", cwd=src)
+    git("push", "-q", "origin", "main", cwd=src)
+    git("commit", "-q", "--allow-empty", "-m", "theirs", cwd=src)
+    git("push", "-q", "origin", "main", cwd=src)
+    git("reset", "-q", "--hard", "HEAD^", cwd=src)
+    git("branch", "-q", "-u", "origin/main", cwd=src)
+    git("commit", "-q", "--allow-empty", "-m", "ours 1", cwd=src)
+    git("commit", "-q", "--allow-empty", "-m", "ours 2\n\nbody", cwd=src)
+    (src / 'file').write_text('x')
+    git("add", "file", cwd=src)
+    git("commit", "-q", "-m", "file", cwd=src)
+    (src / 'file').write_text('dirty')
+    monkeypatch.chdir(src)
+    return src
+
+
+def test_snapshot_fields(src):
+    snapshot = SourceSnapshot('origin')
+    d = snapshot.fields
+    assert d['src_sha'] == git("rev-parse", "HEAD", cwd=src)
+    assert d['src_sha_short'] == d['src_sha'][:10]
+    assert d['src_sha_msg'] == 'file'
+    assert d['src_time_author'] == 'Thu, 27 Jul 2023 13:15:26 +0200'
+    assert d['src_branch'] == 'main'
+    assert d['src_branch_upstream'] == 'origin/main'
+    assert (d['src_commits_ahead'], d['src_commits_behind']) == ('3', '1')
+    assert d['src_repo'] == 'origin.git'
+    assert d['src_tree_root'] == str(src)
+    assert d['src_status'] == 'M file'
+    assert snapshot.elapsed > 0
+
+
+def test_snapshot_fast_modes(src):
+    d = SourceSnapshot('origin', fsmonitor=True, commit_graph=True).fields
+    assert os.path.exists(src / '.git' / 'objects' / 'info' / 'commit-graph')
+    assert (d['src_commits_ahead'], d['src_commits_behind']) == ('3', '1')
+    assert d['src_status'] == 'M file'
+
+
+def test_snapshot_detached_and_untracked(src):
+    git("checkout", "-q", "--detach", cwd=src)
+    d = SourceSnapshot('origin').fields
+    assert (d['src_branch'], d['src_branch_upstream'], d['src_commits_ahead']) == ('HEAD', '', '')
+
+    git("checkout", "-q", "-b", "local", cwd=src)
+    d = SourceSnapshot('origin').fields
+    assert (d['src_branch'], d['src_branch_upstream'], d['src_commits_behind']) == ('local', '', '')
+
+
+def test_parse_track():
+    assert parse_track("") == ("0", "0")
+    assert parse_track("ahead 2") == ("2", "0")
+    assert parse_track("behind 1") == ("0", "1")
+    assert parse_track("ahead 2, behind 1") == ("2", "1")
+    assert parse_track("gone") == ("", "")
@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+HEAVY = {"maya", "dateparser", "pendulum"}
+BUDGET_US = 250_000  # Was ~370ms with maya and dateparser imported up front
+
+
+def import_times(*args) -> dict[str, int]:
+    """ Cumulative import time in microseconds of each top-level module, when running the CLI with args """
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=SRC, capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.rstrip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("command", ["push", "list", "download", "clean"])
+def test_startup_import_time(command):
+    times = import_times("git_recycle_bin.py", command, "--help")
+    modules = {name.strip() for name in times}
+    assert "rbgit" in modules
+    assert not modules & HEAVY
+    top_level = sum(t for name, t in times.items() if not name.startswith("  "))
+    assert top_level < BUDGET_US
+
+
+def test_default_expiry_needs_no_fuzzy_parser():
+    times = import_times("-c", "import util_date; util_date.date_fuzzy2expiryformat('in 30 days')")
+    assert not {name.strip() for name in times} & HEAVY
@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tarfile
+from types import SimpleNamespace
+
+import pytest
+
+from rbgit import RbGit
+from tar_import import member_path, tar_to_tree
+
+
+DATES = {'GIT_AUTHOR_DATE': 'Thu, 27 Jul 2023 13:15:26 +0200', 'GIT_COMMITTER_DATE': 'Thu, 27 Jul 2023 13:15:26 +0200'}
+
+
+@pytest.fixture
+def rbgit(tmp_path, monkeypatch, author_env):
+    monkeypatch.chdir(tmp_path)
+    printer = SimpleNamespace(debug=lambda *a, **k: None)
+    return lambda name: RbGit(printer, rbgit_dir=str(tmp_path / name), rbgit_work_tree=str(tmp_path))
+
+
+def make_tar(members) -> io.BytesIO:
+    """ In-memory tarball of (TarInfo, data) pairs """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for info, data in members:
+            info.size = len(data) if data else 0
+            tar.addfile(info, io.BytesIO(data) if data else None)
+    buf.seek(0)
+    return buf
+
+
+def info(name, kind=tarfile.REGTYPE, mode=0o644, linkname=""):
+    member = tarfile.TarInfo(name)
+    member.type, member.mode, member.linkname = kind, mode, linkname
+    return member
+
+
+def test_tar_to_tree_modes(rbgit):
+    stream = make_tar([
+        (info("./", tarfile.DIRTYPE, 0o755), None),
+        (info("./run.sh", mode=0o755), b"#!/bin/sh\n"),
+        (info("./sub/data.bin"), os.urandom(3000)),
+        (info("./link", tarfile.SYMTYPE, linkname="sub/data.bin"), None),
+        (info("./hard", tarfile.LNKTYPE, linkname="./run.sh"), None),
+        (info("./fifo", tarfile.FIFOTYPE), None),
+    ])
+    repo = rbgit('.rbgit')
+    tree = tar_to_tree(repo, stream, "obj/a")
+
+    listing = [line.split("\t") for line in repo.cmd("ls-tree", "-r", tree).splitlines()]
+    modes = {path: info.split()[0] for info, path in listing}
+    assert modes == {'obj/a/hard': '100755', 'obj/a/link': '120000', 'obj/a/run.sh': '100755', 'obj/a/sub/data.bin': '100644'}
+    assert repo.cmd("cat-file", "blob", f"{tree}:obj/a/link") == "sub/data.bin"
+    assert repo.cmd("rev-parse", f"{tree}:obj/a/hard") == repo.cmd("rev-parse", f"{tree}:obj/a/run.sh")
+    # Throw-away import ref is gone
+    assert repo.cmd("for-each-ref") == ""
+
+
+def test_commit_tar_same_as_commit_path(rbgit, tmp_path):
+    (tmp_path / 'obj' / 'a' / 'sub').mkdir(parents=True)
+    (tmp_path / 'obj' / 'a' / 'file').write_text('hello')
+    (tmp_path / 'obj' / 'a' / 'sub' / 'run').write_text('#!/bin/sh\n')
+    os.chmod(tmp_path / 'obj' / 'a' / 'sub' / 'run', 0o755)
+    os.symlink('file', tmp_path / 'obj' / 'a' / 'link')
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        tar.add(tmp_path / 'obj' / 'a', arcname='.')
+    buf.seek(0)
+
+    from_tar = rbgit('.rbgit-tar').commit_tar('artifact/a', buf, 'obj/a', 'a', env=DATES)
+    from_path = rbgit('.rbgit-path').commit_path('artifact/a', 'obj/a', 'a', env=DATES)
+    assert from_tar == from_path
+
+
+def test_tar_outside_artifact(rbgit):
+    with pytest.raises(RuntimeError, match="outside"):
+        tar_to_tree(rbgit('.rbgit'), make_tar([(info("../x"), b"x")]), "obj/a")
+    assert member_path(info("./a/../b"), ".") == "b"
+    with pytest.raises(RuntimeError):
+        member_path(info("/etc/passwd"), "obj")
+
+
+def test_tar_dangling_hard_link(rbgit):
+    for target in ("missing", "./dir"):
+        tar = make_tar([(info("./dir", tarfile.DIRTYPE, 0o755), None), (info("./hard", tarfile.LNKTYPE, linkname=target), None)])
+        with pytest.raises(RuntimeError, match=f"'./hard' links to '{target}'"):
+            tar_to_tree(rbgit('.rbgit'), tar, "obj/a")
+
+
+def test_tar_to_tree_chatty_stderr(rbgit, tmp_path, monkeypatch):
+    # fast-import writing more to stderr than a pipe holds, while we still feed it the tar
+    real_git = shutil.which('git')
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'git').write_text('#!/bin/sh\n'
+                                 'if [ "$1" = fast-import ]; then head -c 200000 /dev/zero >&2; fi\n'
+                                 f'exec {real_git} "$@"\n')
+    (bin_dir / 'git').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    data = os.urandom(300_000)
+    tree = tar_to_tree(rbgit('.rbgit'), make_tar([(info("./big.bin"), data)]), "obj/a")
+    assert rbgit('.rbgit').cmd('cat-file', 'blob', f'{tree}:obj/a/big.bin', text=False) == data
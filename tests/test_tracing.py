@@ -0,0 +1,104 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from rbgit import RbGit
+from tracing import Tracer, span_name, tracer as global_tracer
+
+
+def spans(tracer, category="git"):
+    return [event for event in tracer.events if event["cat"] == category]
+
+
+def test_disabled_records_nothing():
+    tracer = Tracer()
+    with tracer.phase("push"):
+        span = tracer.begin(["git", "status"])
+        tracer.end(span, 0, "out")
+    assert span is None
+    assert tracer.events == []
+
+
+def test_spans_in_phases(tmp_path):
+    tracer = Tracer()
+    tracer.enabled = True
+    with tracer.phase("push"):
+        with tracer.phase("snapshot"):
+            span = tracer.begin(["git", "log", "-1"])
+            # Work handed to a thread inherits the phase
+            worker = threading.Thread(target=tracer.inherit(lambda: tracer.end(tracer.begin(["git", "status"]), 0, b"x")))
+            worker.start()
+            worker.join()
+            tracer.end(span, 0, "héllo", "")
+            tracer.end(span, 1)  # Already ended
+        tracer.end(tracer.begin(["git", "push"]), 128, None, "fatal")
+
+    log, push, status = sorted(spans(tracer), key=lambda e: e["name"])
+    assert log["name"] == "git log" and log["args"] == {"argv": ["git", "log", "-1"], "phase": "snapshot", "exit_code": 0, "stdout_bytes": 6, "stderr_bytes": 0}
+    assert status["args"]["phase"] == "snapshot" and status["tid"] != log["tid"]
+    assert push["args"] == {"argv": ["git", "push"], "phase": "push", "exit_code": 128, "stdout_bytes": None, "stderr_bytes": 5}
+    assert [e["name"] for e in spans(tracer, "phase")] == ["snapshot", "push"]
+
+    path = tmp_path / "trace.json"
+    tracer.write(str(path))
+    events = json.loads(path.read_text())["traceEvents"]
+    assert [e["ts"] for e in events] == sorted(e["ts"] for e in events)
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert "snapshot: 2 git commands" in tracer.summary()
+
+
+def test_phases_per_thread():
+    tracer = Tracer()
+    tracer.enabled = True
+    started, done = threading.Barrier(2), threading.Barrier(2)
+
+    def work(name):
+        with tracer.phase(name):
+            started.wait()  # Both phases open at once
+            tracer.end(tracer.begin(["git", name]), 0)
+            done.wait()
+
+    with tracer.phase("push"):
+        workers = [threading.Thread(target=tracer.inherit(work), args=(name,)) for name in ("fetch", "status")]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        tracer.end(tracer.begin(["git", "push"]), 0)
+    # Not handed over: No phase
+    worker = threading.Thread(target=lambda: tracer.end(tracer.begin(["git", "gc"]), 0))
+    worker.start()
+    worker.join()
+
+    assert {e["name"]: e["args"]["phase"] for e in spans(tracer)} == {"git fetch": "fetch", "git status": "status", "git push": "push", "git gc": None}
+
+
+def test_span_name():
+    assert span_name(["rbgit", "-c", "core.fsmonitor=true", "status", "--porcelain"]) == "rbgit status"
+    assert span_name(["/usr/bin/git", "--no-pager", "log"]) == "git log"
+    assert span_name(["git"]) == "git"
+
+
+@pytest.fixture
+def traced(monkeypatch):
+    monkeypatch.setattr(global_tracer, "enabled", True)
+    monkeypatch.setattr(global_tracer, "events", [])
+    return global_tracer
+
+
+def test_rbgit_commands_traced(tmp_path, monkeypatch, traced):
+    monkeypatch.chdir(tmp_path)
+    rbgit = RbGit(SimpleNamespace(debug=lambda *a, **k: None), rbgit_dir=str(tmp_path / ".rbgit"), rbgit_work_tree=str(tmp_path))
+    traced.events.clear()
+
+    rbgit.cmd("hash-object", "--stdin", input="x")
+    assert list(rbgit.stream("ls-files", "-z", sep="\0")) == []
+    with pytest.raises(RuntimeError):
+        rbgit.cmd("rev-parse", "--verify", "nope")
+
+    hashed, listed, failed = spans(traced)
+    assert (hashed["name"], hashed["args"]["exit_code"], hashed["args"]["stdout_bytes"]) == ("rbgit hash-object", 0, 41)
+    assert (listed["name"], listed["args"]["exit_code"], listed["args"]["stdout_bytes"]) == ("rbgit ls-files", 0, 0)
+    assert failed["args"]["exit_code"] == 128 and failed["args"]["stderr_bytes"] > 0
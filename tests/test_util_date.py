@@ -1,4 +1,5 @@
 import datetime
+import pytest
 from dateutil.tz import tzlocal
 from util_date import (
     parse_fuzzy_time,
@@ -7,7 +8,10 @@ from util_date import (
     format_timespan,
     DATE_FMT_GIT,
     date_fuzzy2expiryformat,
+    parse_simple_time,
+    date_prefixes_until,
 )
+import dateparser
 
 
 def test_parse_fuzzy_time_now():
@@ -44,3 +48,26 @@ def test_date_fuzzy2expiryformat_relative():
     parsed = parse_expire_date(res)
     assert parsed['date'] is not None
 
+
+
+@pytest.mark.parametrize('fuzzy', ['in 30 days', 'In 2 Weeks', 'now in 3 week', 'in 1 month', 'in 1 hour', '1 month', '2 days ago',
+                                   '2024-01-02', '2024-01-02 12:00', '2024-01-02T12:00:00+02:00'])
+def test_parse_simple_time_agrees_with_dateparser(fuzzy):
+    expected = dateparser.parse(fuzzy, settings={"RETURN_AS_TIMEZONE_AWARE": True})
+    assert abs((parse_simple_time(fuzzy) - expected).total_seconds()) < 5
+
+
+@pytest.mark.parametrize('fuzzy', ['tomorrow', 'next month', 'in 1 day ago', '2024-01-02 12:00 UTC'])
+def test_parse_simple_time_leaves_fuzzy_to_libraries(fuzzy):
+    assert parse_simple_time(fuzzy) is None
+
+
+def test_date_prefixes_until():
+    last = datetime.date(2024, 3, 15)
+    prefixes = date_prefixes_until(last)
+    day = datetime.date(1999, 1, 1)
+    while day < datetime.date(2031, 1, 1):
+        covered = any(day.isoformat().startswith(p) for p in prefixes)
+        assert covered == (day <= last), day
+        day += datetime.timedelta(days=1)
+    assert len(prefixes) < 30
@@ -1,5 +1,6 @@
 import os
-from util_file import nca_path, rel_dir, classify_path
+import time
+from util_file import nca_path, rel_dir, classify_path, rmtree_background
 
 
 def test_nca_and_rel(tmp_path):
@@ -16,3 +17,19 @@ def test_classify_path(tmp_path):
     assert classify_path(str(f)) == ('text/plain', None)
     assert classify_path(str(tmp_path)) == 'directory'
     assert classify_path(str(tmp_path / 'missing')) == 'unknown'
+
+
+def test_rmtree_background(tmp_path):
+    tree = tmp_path / '.rbgit'
+    (tree / 'objects').mkdir(parents=True)
+    (tree / 'objects' / 'pack').write_text('x')
+
+    trash = rmtree_background(str(tree))
+    # Path is free right away, deletion happens elsewhere
+    assert not tree.exists()
+    assert os.path.basename(trash).startswith('.rbgit.trash-')
+    for _ in range(100):
+        if not os.path.exists(trash):
+            break
+        time.sleep(0.05)
+    assert not os.path.exists(trash)
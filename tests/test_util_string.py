@@ -1,3 +1,4 @@
+import pytest
 from util_string import (
     remove_empty_lines,
     sanitize_slashes,
@@ -5,6 +6,7 @@ from util_string import (
     trim_all_lines,
     prefix_lines,
     string_trunc_ellipsis,
+    parse_size,
 )
 
 
@@ -38,3 +40,12 @@ def test_string_trunc_ellipsis():
     long = 'abcdefg'
     assert string_trunc_ellipsis(10, long) == long
     assert string_trunc_ellipsis(5, long) == 'ab...'
+
+
+def test_parse_size():
+    assert parse_size('512') == 512
+    assert parse_size('100M') == 100 * 1024**2
+    assert parse_size('1.5GiB') == 1536 * 1024**2
+    assert parse_size('2k') == 2048
+    with pytest.raises(ValueError):
+        parse_size('lots')